@@ -4,20 +4,16 @@ from code_generators.cpp.cpp_parse_node import CppParseNodeType
 
 class Api:
     def __init__(self, text):
-        self.parse_tree = CppParse(text=text).parse()
-        self._parse_api(self.parse_tree.get_root_node())
         self.params = []
         self.func_name = None
         self.func_ret = None
+        self.parse_tree = CppParse(text=text).parse()
+        self._parse_api(self.parse_tree)
 
-    def _parse_api(self, root_node):
-        i = 0
-        while i < root_node.size():
-            node = root_node[i]
-            if node.node_type == CppParseNodeType.FUNCTION_DEF:
-                self._parse_function(node)
-                break
-            i += 1
+    def _parse_api(self, parse_tree):
+        func_nodes = parse_tree.find_all(CppParseNodeType.FUNCTION_DEF)
+        if len(func_nodes):
+            self._parse_function(func_nodes[0])
 
     def _parse_function(self, func_node):
         i = 0
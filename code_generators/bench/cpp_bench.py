@@ -0,0 +1,222 @@
+"""
+Benchmark the parser and the generators on a synthetic corpus
+
+    python3 -m code_generators.bench.cpp_bench [--prototypes N] [--depth D]
+        [--comments F] [--macros F] [--templates F] [--ifdefs F] [--seed S]
+        [--files N] [--repeat R] [--json FILE]
+
+Times each phase of CppParse, the parse with fold_conditionals, invert()
+and ApiClass generation over headers from CppCorpus, and prints the median
+time and the throughput of each in MB/s and nodes/s. Only the standard
+library is used, and nothing is downloaded, so runs on different machines
+or parser versions differ only in what is measured.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from code_generators.adapter.api_class import ApiClass
+from code_generators.bench.cpp_corpus import CppCorpus
+from code_generators.cpp.cpp_parse import CppParse, PARSER_VERSION
+from code_generators.cpp.cpp_parse_profile import PHASES
+from code_generators.cpp.cpp_parse_state import CppParseState
+from code_generators.singleton.generator import SingletonType
+
+
+class CppBench:
+    def __init__(self, corpus=None, files=1, repeat=5):
+        """
+        :param corpus: the CppCorpus to generate each file with. File i uses
+        its seed + i.
+        :param files: the number of files
+        :param repeat: the number of times each stage is timed. The median
+        is reported.
+        """
+        self.corpus = corpus if corpus is not None else CppCorpus()
+        self.files = files
+        self.repeat = repeat
+        # The time of each run of each stage
+        self.times = {}
+        self.bytes = 0
+        self.nodes = 0
+
+    def run(self):
+        """
+        :return: the report (see get_report())
+        """
+        self.times = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            paths, apis = self._write_corpus(tmp)
+            for _ in range(self.repeat):
+                state = self._time_parse(paths)
+                self._time_parse_folded(paths)
+                self._time_invert(state, paths)
+                self._time_api_class(apis, tmp)
+        return self.get_report()
+
+    def _write_corpus(self, tmp):
+        paths = []
+        apis = []
+        seed = self.corpus.seed
+        self.bytes = 0
+        try:
+            for i in range(self.files):
+                self.corpus.seed = seed + i
+                text = self.corpus.generate()
+                apis += self.corpus.apis
+                paths.append(os.path.join(tmp, f"bench{i}.h"))
+                with open(paths[-1], 'w') as fp:
+                    fp.write(text)
+                self.bytes += len(text.encode('utf-8'))
+        finally:
+            self.corpus.seed = seed
+        return paths, apis
+
+    def _add_time(self, stage, seconds):
+        self.times.setdefault(stage, []).append(seconds)
+
+    def _time_parse(self, paths):
+        state = CppParseState()
+        start = time.perf_counter()
+        CppParse(paths=paths, state=state, keep_phases=False,
+                 profile=True).parse()
+        self._add_time('parse', time.perf_counter() - start)
+        phases = {}
+        self.nodes = 0
+        for path in paths:
+            stats = state.parse_trees[path].stats
+            self.nodes += stats.nodes
+            for name, totals in stats.phases.items():
+                phases[name] = phases.get(name, 0) + totals['wall']
+        for name, seconds in phases.items():
+            self._add_time(name, seconds)
+        return state
+
+    def _time_parse_folded(self, paths):
+        """
+        Parse with the branches of conditionals which aren't taken skipped
+        by the lexer pass
+        """
+        start = time.perf_counter()
+        CppParse(paths=paths, state=CppParseState(), keep_phases=False,
+                 fold_conditionals=True).parse()
+        self._add_time('parse_folded', time.perf_counter() - start)
+
+    def _time_invert(self, state, paths):
+        start = time.perf_counter()
+        for path in paths:
+            state.parse_trees[path].invert()
+        self._add_time('invert', time.perf_counter() - start)
+
+    def _time_api_class(self, apis, tmp):
+        start = time.perf_counter()
+        # ApiClass prints the files it creates
+        with contextlib.redirect_stdout(io.StringIO()):
+            ApiClass("bench", "bench", "<singleton.h>", "bench",
+                     "Singleton", SingletonType.UNIQUE_PTR, apis, [], [],
+                     dir=tmp, create_h=True, create_cc=True)
+        self._add_time('api_class', time.perf_counter() - start)
+
+    def get_report(self):
+        """
+        :return: a dict which can be saved as JSON, with the machine, the
+        corpus, and the median and minimum time and the throughput of each
+        stage
+        """
+        stages = {}
+        for name in _sort_stages(self.times):
+            median = statistics.median(self.times[name])
+            stages[name] = {
+                'median': median,
+                'min': min(self.times[name]),
+                'mb_per_s': self.bytes / median / 1e6 if median else None,
+                'nodes_per_s': self.nodes / median if median else None,
+            }
+        return {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'parser_version': PARSER_VERSION,
+            'corpus': {
+                'prototypes': self.corpus.prototypes,
+                'depth': self.corpus.depth,
+                'comment_density': self.corpus.comment_density,
+                'macro_density': self.corpus.macro_density,
+                'template_density': self.corpus.template_density,
+                'ifdef_density': self.corpus.ifdef_density,
+                'seed': self.corpus.seed,
+                'files': self.files,
+            },
+            'repeat': self.repeat,
+            'bytes': self.bytes,
+            'nodes': self.nodes,
+            'stages': stages,
+        }
+
+
+def _sort_stages(names):
+    order = ['parse'] + PHASES + ['parse_folded', 'invert', 'api_class']
+    return sorted(names, key=lambda name: (
+        order.index(name) if name in order else len(order), name))
+
+
+def print_report(report, fp=None):
+    fp = fp if fp is not None else sys.stdout
+    print(f"{report['bytes']} bytes, {report['nodes']} nodes, "
+          f"median of {report['repeat']} runs", file=fp)
+    print(f"{'stage':<12}{'median ms':>12}{'MB/s':>10}{'nodes/s':>14}",
+          file=fp)
+    for name, stage in report['stages'].items():
+        mb_per_s = stage['mb_per_s'] or 0
+        nodes_per_s = stage['nodes_per_s'] or 0
+        print(f"{name:<12}{stage['median'] * 1000:>12.2f}"
+              f"{mb_per_s:>10.2f}{nodes_per_s:>14.0f}", file=fp)
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the parser on a synthetic C++ corpus")
+    parser.add_argument('--prototypes', type=int, default=1000,
+                        help="the number of prototypes in each file")
+    parser.add_argument('--depth', type=int, default=2,
+                        help="how deep namespaces and classes are nested")
+    parser.add_argument('--comments', type=float, default=0.25,
+                        help="the fraction of prototypes with a comment")
+    parser.add_argument('--macros', type=float, default=0.1,
+                        help="the fraction of prototypes with a macro")
+    parser.add_argument('--templates', type=float, default=0.1,
+                        help="the fraction of prototypes which are "
+                             "templates")
+    parser.add_argument('--ifdefs', type=float, default=0,
+                        help="the fraction of scopes in an #ifdef which "
+                             "is never taken")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--files', type=int, default=1,
+                        help="the number of files")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="the number of times each stage is timed")
+    parser.add_argument('--json', default=None,
+                        help="save the report to this JSON file")
+    return parser
+
+
+def main(argv=None):
+    args = make_arg_parser().parse_args(argv)
+    corpus = CppCorpus(args.prototypes, args.depth, args.comments,
+                       args.macros, args.templates, args.seed, args.ifdefs)
+    report = CppBench(corpus, args.files, args.repeat).run()
+    print_report(report)
+    if args.json is not None:
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
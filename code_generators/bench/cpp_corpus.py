@@ -0,0 +1,133 @@
+"""
+Generate synthetic C++ headers to benchmark the parser with
+
+The same parameters and seed always generate the same text, so parser
+versions can be compared on the same input.
+"""
+
+import random
+
+TYPES = ['int', 'char', 'double', 'size_t', 'bool', 'std::string',
+         'std::vector<int>']
+WORDS = ['open', 'read', 'write', 'seek', 'close', 'sync', 'stat', 'flush',
+         'map', 'lock']
+
+
+class CppApi:
+    """
+    A generated function prototype, with the attributes ApiClass expects of
+    an API
+    """
+    def __init__(self, ret, name, params):
+        """
+        :param ret: the return type
+        :param name: the name of the function
+        :param params: a list of (type, name) pairs
+        """
+        self.ret = ret
+        self.name = name
+        self.params = params
+        self.real_name = f"{name}_"
+        self.type = f"{name}_t"
+        self.api_str = f"{ret} {name}({self.get_args()})"
+
+    def get_args(self):
+        return ", ".join(f"{type} {name}" for type, name in self.params)
+
+    def pass_args(self):
+        return ", ".join(name for _, name in self.params)
+
+
+class CppCorpus:
+    def __init__(self, prototypes=1000, depth=2, comment_density=0.25,
+                 macro_density=0.1, template_density=0.1, seed=0,
+                 ifdef_density=0):
+        """
+        :param prototypes: the number of function prototypes
+        :param depth: how deep the namespaces and classes holding the
+        prototypes are nested
+        :param comment_density: the fraction of prototypes with a comment
+        :param macro_density: the fraction of prototypes preceded by a
+        macro definition, or wrapped in an #ifdef
+        :param template_density: the fraction of prototypes which are
+        templates
+        :param seed: the seed of the random choices
+        :param ifdef_density: the fraction of the outermost scopes wrapped
+        in an #ifdef of a macro which is never defined
+        """
+        self.prototypes = prototypes
+        self.depth = depth
+        self.comment_density = comment_density
+        self.macro_density = macro_density
+        self.template_density = template_density
+        self.seed = seed
+        self.ifdef_density = ifdef_density
+        # The prototypes of the last generate()
+        self.apis = []
+
+    def generate(self):
+        """
+        :return: the text of the header
+        """
+        rand = random.Random(self.seed)
+        self.apis = []
+        lines = ["#include <string>", "#include <vector>", ""]
+        # Each scope at the innermost depth holds about 50 prototypes
+        scopes = max(1, self.prototypes // 50)
+        for scope in range(scopes):
+            count = self.prototypes // scopes + \
+                (scope < self.prototypes % scopes)
+            # No choice is drawn without ifdef_density, so the text of the
+            # other parameters doesn't change
+            guard = self.ifdef_density > 0 and \
+                rand.random() < self.ifdef_density
+            if guard:
+                lines.append(f"#ifdef SCOPE{scope}_ENABLED")
+            self._add_scope(rand, lines, scope, count)
+            if guard:
+                lines.append(f"#endif  // SCOPE{scope}_ENABLED")
+        lines.append("")
+        return "\n".join(lines)
+
+    def _add_scope(self, rand, lines, scope, count):
+        indent = ""
+        closers = []
+        for level in range(self.depth):
+            # Alternate namespaces and classes, outermost first
+            if level % 2 == 0:
+                lines.append(f"{indent}namespace ns{scope}_{level} {{")
+                closers.append(f"{indent}}}  // namespace ns{scope}_{level}")
+            else:
+                lines.append(f"{indent}class Class{scope}_{level} {{")
+                lines.append(f"{indent} public:")
+                closers.append(f"{indent}}};")
+            indent += "  "
+        for i in range(count):
+            self._add_prototype(rand, lines, indent, f"{scope}_{i}")
+        for closer in reversed(closers):
+            lines.append(closer)
+
+    def _add_prototype(self, rand, lines, indent, suffix):
+        name = f"{rand.choice(WORDS)}_{suffix}"
+        params = [(rand.choice(TYPES), f"arg{j}")
+                  for j in range(rand.randint(0, 4))]
+        api = CppApi(rand.choice(TYPES), name, params)
+        self.apis.append(api)
+        if rand.random() < self.comment_density:
+            if rand.random() < 0.5:
+                lines.append(f"{indent}/** Calls {name} */")
+            else:
+                lines.append(f"{indent}// {name}: see the docs")
+        guard = None
+        if rand.random() < self.macro_density:
+            macro = f"{name.upper()}_ENABLED"
+            if rand.random() < 0.5:
+                lines.append(f"#define {macro}(x) ((x) + 1)")
+            else:
+                guard = macro
+                lines.append(f"#ifdef {guard}")
+        if rand.random() < self.template_density:
+            lines.append(f"{indent}template<typename T>")
+        lines.append(f"{indent}{api.api_str};")
+        if guard is not None:
+            lines.append(f"#endif  // {guard}")
@@ -1,3 +1,9 @@
+import asyncio
+import contextlib
+import io
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
 from .cpp_parse0 import CppParse0
 from .cpp_parse1 import CppParse1
 from .cpp_parse2 import CppParse2
@@ -5,51 +11,593 @@ from .cpp_parse3 import CppParse3
 from .cpp_parse4 import CppParse4
 from .cpp_parse5 import CppParse5
 from .cpp_parse_state import CppParseState
+from .cpp_parse_index import CppParseIndex
+from .cpp_parse_node import CppParseNodeType
+from .cpp_parse_query import compile_query, find_all_many
+from .cpp_parse_cache import CppParseCache
+from .cpp_parse_pipeline import CppParsePipeline
+from .cpp_parse_edit import CppParseEdit, CppSourceMap, CppEditFallback
+from .cpp_parse_profile import CppParseProfile
+from .cpp_parse_macro import CppMacro
+from .cpp_parse_snapshot import CppParseSnapshot
+from . import cpp_parse_serial
+
+# Bump whenever the parse trees produced for the same input change, so that
+# cached parse trees of older versions are not used
+PARSER_VERSION = 3
+# The number of pieces the text may be split into by apply_edit() before the
+# spans are rewritten to a single source (see normalize_spans())
+MAX_EDIT_PIECES = 1024
+# The phase timer used when profiling is off
+_NO_PHASE = contextlib.nullcontext()
 
 
 class CppParse:
     def __init__(self, paths=None, path=None, text=None, state=None,
-                 do_preprocess=True):
+                 do_preprocess=True, typed_lex=True, use_mmap=False,
+                 keep_phases=True, macros=None, include_dirs=None,
+                 cache=None, jobs=1, prefetch=0, profile=False,
+                 profile_memory=False, fold_conditionals=False,
+                 snapshot=None):
+        """
+        :param typed_lex: whether to use the single-pass typed lexer. If
+        False, the text is split into strings and labeled by CppParse1.
+        :param use_mmap: lex files straight from an mmap instead of reading
+        them into a string. Requires typed_lex.
+        :param keep_phases: whether to keep the text and the intermediate
+        phase outputs (phase0, phase1, phase2) after parsing. If False, each
+        is dropped as soon as the next phase has consumed it.
+        :param macros: a dict of the macros defined before parsing
+        :param include_dirs: the directories to search for includes. If
+        given (even empty), includes are followed: each header is parsed
+        once per state and the macros it defines apply to its includers.
+        Quoted includes are looked for next to the includer first.
+        :param cache: a CppParseCache or the directory of one. Files whose
+        content and configuration were parsed before are loaded from it
+        instead of being parsed.
+        :param jobs: the number of processes to parse paths with. Each
+        worker parses its files and sends back the serialized parse trees.
+        :param prefetch: if > 0 (and jobs is 1), paths are read by a reader
+        thread up to this many files ahead of the parse (see
+        CppParsePipeline)
+        :param profile: whether to record the statistics of each phase in
+        stats (see CppParseProfile)
+        :param profile_memory: profile, and also trace the memory of each
+        phase
+        :param fold_conditionals: replace the branches of #if which are not
+        taken by MACRO_INACTIVE nodes which span their text (see CppParse3)
+        :param snapshot: a CppParseSnapshot or the path of a saved one. The
+        text starts with its macros (with macros defined over them), and
+        includes of its guarded headers are skipped.
+        """
         self.paths = paths if paths is not None else []
         self.path = path
         self.text = text
         self.parse_tree = None
         self.state = state
         self.do_preprocess = do_preprocess
+        self.typed_lex = typed_lex
+        self.use_mmap = use_mmap and typed_lex
+        self.keep_phases = keep_phases
+        self.macros = macros if macros is not None else {}
+        self.include_dirs = include_dirs if include_dirs is not None else []
+        self.follow_includes = include_dirs is not None
+        if isinstance(cache, str):
+            cache = CppParseCache(cache)
+        self.cache = cache
+        self.jobs = jobs
+        self.prefetch = prefetch
+        self.pipeline = None
+        self.index = None
+        # The CppSourceMap of the text after apply_edit(), or None if every
+        # node spans one source
+        self.source_map = None
+        # The number of edits applied incrementally and by a full reparse
+        self.edit_counts = {'incremental': 0, 'full': 0}
+        # Whether the text was edited since it was read from path
+        self.edited = False
+        # Whether the state evicted the parse tree (see CppParseTrees), and
+        # the cache key it was stored under
+        self.evicted = False
+        self.evicted_key = None
+        self.profile = profile or profile_memory
+        self.profile_memory = profile_memory
+        self.fold_conditionals = fold_conditionals
+        if isinstance(snapshot, str):
+            path = snapshot
+            snapshot = CppParseSnapshot.load(path)
+            if snapshot is None:
+                raise Exception(f"The snapshot {path} is missing or out "
+                                f"of date")
+        self.snapshot = snapshot
+        self.snapshot_digest = snapshot.get_digest() \
+            if snapshot is not None else None
+        self.stats = CppParseProfile(path, profile_memory) \
+            if self.profile else None
+        # Whether macros are defined in or before the text, or None if
+        # unknown (e.g., the tree was loaded)
+        self.uses_macros = None
+        # The CppMacroTable the text starts with instead of macros and the
+        # snapshot, for a header parsed with the macros of its includer
+        self.macro_table = None
 
     def parse(self):
         self._preprocess()
         #self._parse()
+        return self
 
     def _preprocess(self):
         # Create the state used to track all parse trees
         if self.state is None:
             self.state = CppParseState()
         # Create parse trees for input paths
-        if len(self.paths) > 1:
-            for path in self.paths:
-                CppParse(path=path, state=self.state)
+        paths = [path for path in dict.fromkeys(self.paths)
+                 if path not in self.state.parse_trees]
+        if self.jobs > 1 and len(paths) > 1:
+            self._preprocess_parallel(paths)
+        elif self.prefetch > 0 and len(paths) > 1:
+            self.pipeline = CppParsePipeline(self, paths,
+                                             self.prefetch).run()
+        else:
+            for path in paths:
+                self._make_parser(path).parse()
+        if self.path is None and self.text is None:
+            return self
         # Verify that this path has not already been parsed
         if self.path not in self.state.parse_trees:
             self.state.parse_trees[self.path] = self
         else:
             return self.state.parse_trees[self.path]
-        # Create parse tree for this input path
-        if self.path is not None:
-            with open(self.path) as fp:
-                self.text = fp.read()
         # Create parse tree for this path
-        self._preprocess_text(self.text)
+        if self.path is not None:
+            self._preprocess_path(self.path)
+        else:
+            self._preprocess_text(self.text)
         return self
 
+    def _make_parser(self, path):
+        """
+        Create a parser for one of the paths, with the same configuration
+        """
+        return CppParse(path=path, state=self.state,
+                        do_preprocess=self.do_preprocess,
+                        typed_lex=self.typed_lex, use_mmap=self.use_mmap,
+                        keep_phases=self.keep_phases, macros=self.macros,
+                        include_dirs=self._get_include_dirs(),
+                        cache=self.cache,
+                        profile=self.profile,
+                        profile_memory=self.profile_memory,
+                        fold_conditionals=self.fold_conditionals,
+                        snapshot=self.snapshot)
+
+    def _preprocess_parallel(self, paths):
+        """
+        Parse paths in a pool of processes and merge the parse trees into
+        the state
+        """
+        options = self._worker_options()
+        jobs = min(self.jobs, len(paths))
+        chunksize = max(1, len(paths) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(_parse_worker, paths,
+                               [options] * len(paths), chunksize=chunksize)
+            for buf, hits, misses, stats in results:
+                self._merge_worker_result(buf, hits, misses, self.state,
+                                          stats)
+
+    def _worker_options(self):
+        """
+        The configuration of this parser, in a form which can be sent to
+        _parse_worker
+        """
+        options = {
+            'do_preprocess': self.do_preprocess,
+            'typed_lex': self.typed_lex,
+            'use_mmap': self.use_mmap,
+            'macros': self.macros,
+            'include_dirs': self._get_include_dirs(),
+            'profile': self.profile,
+            'profile_memory': self.profile_memory,
+            'fold_conditionals': self.fold_conditionals,
+            'snapshot': self.snapshot,
+        }
+        if self.cache is not None:
+            options['cache'] = self.cache.cache_dir
+            options['cache_max_bytes'] = self.cache.max_bytes
+        return options
+
+    def _get_include_dirs(self):
+        """
+        The include_dirs argument which makes a parser with the same
+        configuration
+        """
+        return self.include_dirs if self.follow_includes else None
+
+    def _merge_worker_result(self, buf, hits, misses, state=None,
+                             stats=None):
+        """
+        Load the parse tree sent back by _parse_worker
+
+        :param state: the CppParseState to add the parse tree to
+        :param stats: the statistics of the parse, if it was profiled
+        :return: the parser of the parse tree
+        """
+        if self.cache is not None:
+            self.cache.hits += hits
+            self.cache.misses += misses
+            # The workers added entries, so recount the cache size
+            self.cache.size = None
+        # The parser keeps this parser's configuration (macros, include
+        # dirs, etc.), which edits and restores of its tree parse with
+        key, tree = cpp_parse_serial.loads(buf)[0]
+        parser = CppParse.from_tree(key, tree, state, self._make_parser(key))
+        if stats is not None:
+            parser.stats = CppParseProfile.from_dict(stats)
+        return parser
+
+    async def parse_async(self, executor=None, concurrency=4):
+        """
+        Parse the paths without blocking the event loop
+
+        :param executor: the executor the phases run on. None is the default
+        executor of the loop. With a ProcessPoolExecutor, each file is read
+        and parsed in a worker process.
+        :param concurrency: the number of files parsed at once
+        :return: self
+        """
+        async for _ in self.iter_parse_async(executor, concurrency):
+            pass
+        return self
+
+    async def iter_parse_async(self, executor=None, concurrency=4):
+        """
+        Parse the paths without blocking the event loop, yielding the parser
+        of each file as soon as it is done. Each is added to the state as
+        it is yielded. If the iteration is cancelled or stopped early, the
+        files which have not started are not parsed.
+
+        :param executor: see parse_async()
+        :param concurrency: see parse_async()
+        """
+        if self.state is None:
+            self.state = CppParseState()
+        paths = [path for path in dict.fromkeys(self.paths)
+                 if path not in self.state.parse_trees]
+        limit = asyncio.Semaphore(max(1, concurrency))
+        tasks = [asyncio.ensure_future(
+                 self._parse_path_async(path, executor, limit))
+                 for path in paths]
+        try:
+            for task in asyncio.as_completed(tasks):
+                parser = await task
+                self.state.parse_trees[parser.path] = parser
+                yield parser
+        finally:
+            for task in tasks:
+                task.cancel()
+        if self.path is None and self.text is None:
+            return
+        if self.path in self.state.parse_trees:
+            return
+        self.state.parse_trees[self.path] = self
+        loop = asyncio.get_running_loop()
+        if isinstance(executor, ProcessPoolExecutor):
+            # The parse must happen on this parser, not a copy of it
+            executor = None
+        if self.path is not None:
+            data = await loop.run_in_executor(None, self._read_path,
+                                              self.path)
+            await loop.run_in_executor(executor, self._preprocess_data, data)
+        else:
+            await loop.run_in_executor(executor, self._preprocess_text,
+                                       self.text)
+        yield self
+
+    async def _parse_path_async(self, path, executor, limit):
+        """
+        Parse one of the paths. The file is read on the default executor,
+        so the read never waits behind the phases of other files.
+
+        :return: the parser of the path
+        """
+        loop = asyncio.get_running_loop()
+        async with limit:
+            if isinstance(executor, ProcessPoolExecutor):
+                buf, hits, misses, stats = await loop.run_in_executor(
+                    executor, _parse_worker, path, self._worker_options())
+                return self._merge_worker_result(buf, hits, misses,
+                                                 self.state, stats)
+            parser = self._make_parser(path)
+            data = await loop.run_in_executor(None, parser._read_path, path)
+            await loop.run_in_executor(executor, parser._preprocess_data,
+                                       data)
+            return parser
+
+    def _preprocess_path(self, path):
+        """
+        Parse a file, or load its parse tree from the cache.
+        """
+        data = self._read_path(path)
+        self._preprocess_data(data)
+
+    def _read_path(self, path):
+        """
+        Read the content of a file as bytes.
+
+        With use_mmap, the file is mmapped instead. Nodes span the mmap
+        instead of copying out their text, so the mmap stays open as the
+        source of the parse tree. It is closed when no node refers to it
+        anymore.
+        """
+        with self._phase('read'), open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return b''
+            elif self.use_mmap:
+                return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                return fp.read()
+
+    def _decode(self, data):
+        """
+        Convert the content of a file to the text which is lexed
+        """
+        if self.use_mmap and len(data):
+            return data
+        # Decode the same way as open(path) would
+        with self._phase('decode'):
+            return io.TextIOWrapper(io.BytesIO(data)).read()
+
+    def _preprocess_data(self, data, text=None):
+        """
+        Parse the content of a file, or load its parse tree from the cache.
+
+        :param data: the content of the file from _read_path()
+        :param text: the content of the file from _decode(), if it was
+        already decoded
+        """
+        key = None
+        # The tree of a file which follows its includes depends on the
+        # headers too, so it isn't cached
+        if self.cache is not None and not self.follow_includes:
+            with self._phase('cache_get'):
+                key = self.cache.make_key(data, self._cache_config())
+                parse_tree = self.cache.get(key)
+            if self.stats is not None:
+                self.stats.cache = 'miss' if parse_tree is None else 'hit'
+            if parse_tree is not None:
+                self.parse_tree = parse_tree
+                self.uses_macros = None
+                if self.stats is not None:
+                    self.stats.nodes = self.count_nodes()
+                self._account()
+                return
+        if text is None:
+            text = self._decode(data)
+        if isinstance(text, str):
+            self.text = text
+        self._preprocess_text(text)
+        if key is not None:
+            with self._phase('cache_put'):
+                self.cache.put(key, self.get_root_node(),
+                               self.get_style_nodes())
+
+    def _cache_config(self):
+        """
+        Everything besides the content of a file which affects its parse
+        tree
+        """
+        return {
+            'parser': PARSER_VERSION,
+            'format': cpp_parse_serial.FORMAT_VERSION,
+            'typed_lex': self.typed_lex,
+            'use_mmap': self.use_mmap,
+            'macros': {name: str(val) for name, val in self.macros.items()},
+            'include_dirs': [str(path) for path in self.include_dirs],
+            'follow_includes': self.follow_includes,
+            'fold_conditionals': self.fold_conditionals,
+            'snapshot': self.snapshot_digest,
+        }
+
     def _preprocess_text(self, text):
         # Lex + Label
-        self.phase0 = CppParse0(text).lex()
-        self.phase1 = CppParse1(self.phase0).parse()
+        with self._phase('lex'):
+            phase0 = CppParse0(text, typed=self.typed_lex).lex()
+        if self.stats is not None:
+            self.stats.tokens = len(phase0.toks)
+        # With the typed lexer, folded conditionals are skipped before the
+        # inactive text is labeled
+        phase3 = self._make_phase3() \
+            if self.fold_conditionals and self.typed_lex else None
+        with self._phase('label'):
+            phase1 = CppParse1(phase0, directives=phase3).parse()
+        if not self.keep_phases:
+            # The tokens and the text are no longer needed
+            self.text = None
+            phase0 = None
+            phase1.lex = None
         # Parse Tree Modification
-        self.phase2 = CppParse2(self.phase1).parse()
-        self.phase3 = CppParse3(self.phase2).parse()
-        self.parse_tree = self.phase3
+        with self._phase('group'):
+            phase2 = CppParse2(phase1, merge_ops=not self.typed_lex).parse()
+        with self._phase('rewrite'):
+            phase3 = self._run_phase3(phase2, phase3)
+        self.parse_tree = phase3
+        self.uses_macros = len(phase3.macros) > 0 or phase3.defines > 0
+        if self.stats is not None:
+            self.stats.nodes = self.count_nodes()
+        self.index = None
+        self.source_map = None
+        if self.keep_phases:
+            self.phase0 = phase0
+            self.phase1 = phase1
+            self.phase2 = phase2
+            self.phase3 = phase3
+        self._account()
+
+    def _make_phase3(self):
+        """
+        The CppParse3 of the text. If this parser follows includes, the
+        includes of its last parse are forgotten first.
+        """
+        if not self.follow_includes or self.state is None:
+            return CppParse3(include_dirs=self.include_dirs,
+                             macros=self._get_macro_table(),
+                             fold_conditionals=self.fold_conditionals)
+        graph = self.state.includes
+        graph.forget(self.path)
+        phase3 = CppParse3(include_dirs=self.include_dirs,
+                           macros=self._get_macro_table(), parser=self,
+                           fold_conditionals=self.fold_conditionals)
+        if self.snapshot is not None:
+            # The headers of the snapshot were included already
+            for path, guard in self.snapshot.guards.items():
+                graph.guards.setdefault(path, guard)
+            phase3.included.update(dict.fromkeys(self.snapshot.files, True))
+        return phase3
+
+    def _run_phase3(self, parse_tree, phase3=None):
+        """
+        Run CppParse3 on a parse tree. If this parser follows includes, its
+        includes and include guard are recorded in the include graph.
+
+        :param phase3: the CppParse3 which already processed the directives
+        of the text in CppParse1, or None
+        """
+        if phase3 is None:
+            phase3 = self._make_phase3()
+        phase3.parse_tree = parse_tree
+        phase3.parse()
+        if phase3.parser is not None and \
+                (phase3.pragma_once or phase3.guard is not None):
+            self.state.includes.set_guard(self.path, phase3.guard)
+        return phase3
+
+    def _get_macro_table(self):
+        """
+        The macros defined before the text: those of the snapshot, with
+        the macros of this parser defined over them
+        """
+        if self.macro_table is not None:
+            return self.macro_table.copy()
+        if self.snapshot is None:
+            return self.macros
+        table = self.snapshot.macros.copy()
+        for name, val in self.macros.items():
+            table.define(CppMacro.from_value(name, val))
+        return table
+
+    def _include(self, name, quoted, phase3):
+        """
+        Parse the header of an include, unless it was parsed already with
+        the same imports (see get_imports()) as the including text defines
+
+        :param name: the name of the header
+        :param quoted: whether the include is "name" rather than <name>
+        :param phase3: the CppParse3 of the including text
+        :return: the CppParse of the header, or None if it wasn't found, it
+        is being parsed (an include cycle), or its include guard or #pragma
+        once skips it
+        """
+        graph = self.state.includes
+        path = graph.resolve(name, quoted, self.path, self.include_dirs)
+        graph.add(self.path, name, path)
+        if path is None:
+            return None
+        # A guarded header included already isn't even read again
+        if graph.is_skipped(path, phase3.macros, phase3.included):
+            graph.skips += 1
+            return None
+        parser = self.state.parse_trees.peek(path)
+        reused = parser is not None
+        if parser is None:
+            graph.parses += 1
+            parser = self._make_parser(path)
+            try:
+                parser.parse()
+            except Exception:
+                self.state.parse_trees.pop(path, None)
+                raise
+        elif parser.parse_tree is None and not parser.evicted:
+            return None
+        if not parser.matches_macros(phase3.macros):
+            parser = self._include_variant(path, phase3)
+            if parser is None:
+                return None
+        elif reused:
+            graph.reuses += 1
+        phase3.included[path] = True
+        for header in graph.get_closure(path):
+            phase3.included[header] = True
+        return parser
+
+    def _include_variant(self, path, phase3):
+        """
+        The parser of a header whose imports the including text defines
+        differently than the macros given to the parser. Its variants are
+        kept in the state (see CppParseState.variants), one per set of
+        imports, and a new one is parsed with the macros of the includer.
+
+        :return: the CppParse of the header, or None if a variant of it is
+        being parsed (an include cycle)
+        """
+        variants = self.state.variants.setdefault(path, [])
+        for parser in variants:
+            if parser.parse_tree is None:
+                return None
+            if parser.matches_macros(phase3.macros):
+                self.state.includes.reuses += 1
+                return parser
+        self.state.includes.parses += 1
+        parser = self._make_parser(path)
+        parser.macro_table = phase3.macros
+        variants.append(parser)
+        try:
+            parser._preprocess_path(path)
+        except Exception:
+            variants.remove(parser)
+            raise
+        return parser
+
+    def get_exports(self):
+        """
+        The macros the text defines (a CppMacro) or undefines (None) by
+        name, including those of the headers it includes
+        """
+        parse_tree = self._get_parse_tree()
+        if not hasattr(parse_tree, 'exports'):
+            # A loaded tree, whose directives are processed again
+            self.parse_tree = self._run_phase3(parse_tree)
+        return self.parse_tree.exports
+
+    def get_imports(self):
+        """
+        The macros the text looked up before defining or undefining them
+        (including those of the headers it includes), with the CppMacro it
+        found or None, by name. These are what the text depends on outside
+        of itself. Only recorded when includes are followed.
+        """
+        parse_tree = self._get_parse_tree()
+        if not hasattr(parse_tree, 'imports'):
+            self.parse_tree = self._run_phase3(parse_tree)
+        return self.parse_tree.imports
+
+    def matches_macros(self, macros):
+        """
+        Whether the text would parse the same after other macros: they
+        define each import of the text (see get_imports()) as it found it
+
+        :param macros: a CppMacroTable
+        """
+        return all(macros.get(name) == macro
+                   for name, macro in self.get_imports().items())
+
+    def get_includes(self):
+        """
+        The paths of the headers the text includes directly, if includes
+        are followed
+        """
+        if self.state is None:
+            return []
+        return self.state.includes.get_includes(self.path)
 
     def _parse(self):
         # Parse tree modification
@@ -58,20 +606,426 @@ class CppParse:
         self.phase5 = CppParse5(self.phase4).parse()
         self.parse_tree = self.phase3
 
+    def _phase(self, name):
+        """
+        A context manager which records the statistics of a phase if
+        profiling is on
+        """
+        if self.stats is None:
+            return _NO_PHASE
+        return self.stats.phase(name)
+
     def get_root_node(self):
-        return self.parse_tree.get_root_node()
+        return self._get_parse_tree().get_root_node()
 
     def get_style_nodes(self):
-        return self.parse_tree.get_style_nodes()
+        return self._get_parse_tree().get_style_nodes()
+
+    def _get_parse_tree(self):
+        if self.evicted:
+            self._restore()
+        return self.parse_tree
+
+    def count_nodes(self):
+        """
+        The number of nodes in the main tree and the style tree
+        """
+        return sum(1 for tree in (self.get_root_node(),
+                                  self.get_style_nodes())
+                   for _ in tree.iter_preorder(include_self=True))
+
+    def _account(self):
+        """
+        Let the state count the size of the parse tree, which just changed
+        """
+        if self.state is not None and \
+                self.state.parse_trees.peek(self.path) is self:
+            self.state.parse_trees.account(self.path)
+
+    def _evict(self, cache=None):
+        """
+        Drop the parse tree to free memory. It is restored when it is used
+        again.
+
+        :param cache: the CppParseCache to store the parse tree in. Without
+        it, the tree is parsed again from the file.
+        :return: whether the tree was evicted. A tree which could not be
+        restored is kept.
+        """
+        if self.parse_tree is None:
+            return False
+        key = None
+        if cache is not None:
+            text = self._current_text()
+            if isinstance(text, str):
+                text = text.encode('utf-8')
+            key = cache.make_key(text, self._cache_config())
+            if not cache.contains(key):
+                cache.put(key, *self._serial_entries()[0][1:])
+        elif self.path is None or self.edited:
+            return False
+        self.parse_tree = None
+        self.evicted = True
+        self.evicted_key = key
+        self.index = None
+        self.source_map = None
+        self.text = None
+        for phase in ('phase0', 'phase1', 'phase2', 'phase3'):
+            self.__dict__.pop(phase, None)
+        return True
+
+    def _restore(self):
+        """
+        Restore the parse tree after it was evicted, from the cache of the
+        state or else by parsing the file again
+        """
+        trees = self.state.parse_trees
+        trees.misses += 1
+        parse_tree = None
+        if self.evicted_key is not None and trees.cache is not None:
+            parse_tree = trees.cache.get(self.evicted_key)
+        if parse_tree is None and self.path is None:
+            raise Exception("The parse tree was evicted and is no longer in "
+                            "the cache")
+        self.evicted = False
+        self.evicted_key = None
+        if parse_tree is not None:
+            self.parse_tree = parse_tree
+            self.uses_macros = None
+            self._account()
+        else:
+            self._preprocess_path(self.path)
+
+    def _current_text(self):
+        source_map = self._get_source_map()
+        if source_map is not None:
+            return source_map.text()
+        return self.invert()
+
+    def save(self, path):
+        """
+        Save the parse tree to a binary file (see cpp_parse_serial)
+        """
+        with open(path, 'wb') as fp:
+            cpp_parse_serial.dump(self._serial_entries(), fp)
+
+    def to_bytes(self):
+        """
+        Convert the parse tree to bytes (see cpp_parse_serial)
+        """
+        return cpp_parse_serial.dumps(self._serial_entries())
+
+    @staticmethod
+    def load(path, state=None):
+        """
+        Load a parse tree saved by save()
+
+        :param state: the CppParseState to add the parse tree to
+        """
+        key, tree = cpp_parse_serial.load(path)[0]
+        return CppParse.from_tree(key, tree, state)
+
+    @staticmethod
+    def from_bytes(buf, state=None):
+        """
+        Load a parse tree converted to bytes by to_bytes()
+
+        :param state: the CppParseState to add the parse tree to
+        """
+        key, tree = cpp_parse_serial.loads(buf)[0]
+        return CppParse.from_tree(key, tree, state)
+
+    @staticmethod
+    def from_tree(path, parse_tree, state=None, parser=None):
+        """
+        Create a parser whose parse tree was already made (e.g., loaded)
+
+        :param path: the path the parse tree was made from
+        :param parse_tree: an object with get_root_node/get_style_nodes
+        :param state: the CppParseState to add the parser to
+        :param parser: the CppParse to attach the parse tree to, with the
+        configuration the tree was parsed with. By default, a parser with
+        the default configuration.
+        """
+        if parser is None:
+            parser = CppParse(path=path, state=state)
+        parser.state = state
+        parser.parse_tree = parse_tree
+        if state is not None:
+            state.parse_trees[path] = parser
+        return parser
+
+    def _serial_entries(self):
+        self.normalize_spans()
+        return [(self.path, self.get_root_node(), self.get_style_nodes())]
+
+    def get_index(self):
+        """
+        The index of the parse tree by node type. It is built on first use
+        after each parse and dropped whenever the tree is rewritten.
+        """
+        if self.index is None:
+            self.index = CppParseIndex(self.get_root_node())
+        return self.index
+
+    def invalidate_index(self):
+        """
+        Drop the index after modifying the parse tree outside of a phase
+        """
+        self.index = None
+
+    def find_all(self, node_type):
+        """
+        Find all nodes of a type in the parse tree
+
+        :param node_type: the CppParseNodeType to look for
+        :return: the nodes of this type in text order
+        """
+        return self.get_index().find_all(node_type)
+
+    def query(self, selector):
+        """
+        Find all nodes matched by a selector (see cpp_parse_query), e.g.,
+        "namespace > class > function[specifier=RPC]"
+
+        :return: the matched nodes in text order
+        """
+        return compile_query(selector).find_all(self.get_root_node(),
+                                                self.index)
+
+    def query_many(self, selectors):
+        """
+        Find the nodes matched by several selectors in one walk of the tree
+
+        :return: a dict mapping each selector to its matched nodes
+        """
+        return find_all_many(self.get_root_node(), selectors, self.index)
 
     def print(self):
         self.get_root_node().print()
 
+    def get_errors(self):
+        """
+        The (node, message) of each error found while parsing
+        """
+        return self._get_parse_tree().get_errors() or []
+
+    def apply_edit(self, start, end, new_text):
+        """
+        Replace text[start:end] of the current text with new_text and update
+        the parse tree. Only the statement around the edit is lexed and
+        grouped again, and the nodes after it are not shifted (see
+        cpp_parse_edit). If that isn't possible (e.g., the edit opens a
+        comment which runs past the statement), the whole text is parsed
+        again.
+
+        The phases kept by keep_phases still describe the text before the
+        edit.
+
+        :param start: the offset of the first character to replace. Offsets
+        are byte offsets for files parsed from an mmap.
+        :param end: the offset after the last character to replace
+        :param new_text: the text to insert
+        :return: self
+        """
+        source_map = self._get_source_map()
+        size = source_map.size if source_map is not None else \
+            len(self.invert())
+        if not 0 <= start <= end <= size:
+            raise Exception(f"Edit {start}:{end} is outside of the text "
+                            f"(length {size})")
+        if source_map is not None and source_map.is_bytes() and \
+                isinstance(new_text, str):
+            new_text = new_text.encode('utf-8')
+        try:
+            # An edit may add an #include, which is only followed by a
+            # full parse, or change which branches of an #if are folded
+            if source_map is None or len(self.get_errors()) or \
+                    self.follow_includes or self.fold_conditionals or \
+                    self._uses_macros():
+                raise CppEditFallback()
+            with self._phase('edit'):
+                CppParseEdit(self.get_root_node(), self.get_style_nodes(),
+                             source_map).apply(start, end, new_text)
+            self.edit_counts['incremental'] += 1
+            self.edited = True
+            self.source_map = source_map
+            self.text = None
+            if len(source_map.pieces) > MAX_EDIT_PIECES:
+                self.normalize_spans()
+        except CppEditFallback:
+            text = source_map.text() if source_map is not None else \
+                self.invert()
+            text = text[:start] + new_text + text[end:]
+            self.edit_counts['full'] += 1
+            self.edited = True
+            self.text = text if isinstance(text, str) else None
+            self._preprocess_text(text)
+        self.invalidate_index()
+        return self
+
+    def get_macros(self):
+        """
+        The CppMacroTable as of the end of the text, or None if the parse
+        tree was loaded instead of parsed
+        """
+        return getattr(self._get_parse_tree(), 'macros', None)
+
+    def _uses_macros(self):
+        """
+        Whether macros are defined in or before the text. The expansion of
+        each use of a macro depends on the text before it, so such trees
+        are parsed again as a whole when edited.
+        """
+        if self.uses_macros is None:
+            self.uses_macros = len(self.macros) > 0 or \
+                self.snapshot is not None or any(
+                node.size() and
+                node[0].val.replace(' ', '') in ('#define', '#undef')
+                for node in self.find_all(CppParseNodeType.PREPROCESSOR))
+        return self.uses_macros
+
+    def _get_source_map(self):
+        """
+        The CppSourceMap of the current text, or None if the nodes don't
+        span a source (e.g., the split lexer was used)
+        """
+        if self.source_map is not None:
+            return self.source_map
+        if not self.typed_lex:
+            return None
+        for tree in (self.get_root_node(), self.get_style_nodes()):
+            for node in tree.iter_preorder():
+                if node.has_span():
+                    return CppSourceMap(node.src_)
+        return None
+
+    def normalize_spans(self):
+        """
+        Make every node span a single source holding the current text again,
+        instead of the pieces left by apply_edit(). This is a pass over the
+        whole tree, so it is only done before saving and when the pieces
+        add up.
+        """
+        source_map = self.source_map
+        if source_map is None:
+            return
+        text = source_map.text()
+        position = source_map.node_position
+        for tree in (self.get_root_node(), self.get_style_nodes()):
+            for node in tree.iter_preorder():
+                if node.src_ is None or node.start is None:
+                    continue
+                start = position(node)
+                if node.end is not None:
+                    node.end += start - node.start
+                node.start = start
+                node.src_ = text
+        self.source_map = None
+
     def invert(self):
-        style_list = self.parse_tree.get_style_nodes().linearize()
-        node_list = self.parse_tree.get_root_node().linearize()
-        inverse_list = style_list + node_list
-        inverse_list.sort(key=lambda x: x.start)
-        text = "".join([x.join(ignore_hidden=False, inplace=False)
-                        for x in inverse_list])
+        """
+        Convert the parse tree back into text.
+
+        :return: the text of the parse tree
+        """
+        text = list(self._invert_chunks())
+        if len(text) == 1:
+            return text[0]
+        return "".join(text)
+
+    def invert_to(self, fp):
+        """
+        Write the text of the parse tree to a file object chunk by chunk,
+        without building the text in memory.
+
+        :param fp: a file object opened in text mode
+        """
+        for chunk in self._invert_chunks():
+            fp.write(chunk)
+
+    def _invert_chunks(self):
+        """
+        Yield the text of the parse tree in order. Runs of nodes which still
+        span consecutive text of the same source are yielded as a single
+        slice of the source instead of joining the text of each node.
+        """
+        run_src, run_start, run_end = None, None, None
+        for node in self._merge_text_nodes():
+            if node.end is not None:
+                if node.src_ is run_src and node.start == run_end:
+                    run_end = node.end
+                    continue
+                if run_src is not None:
+                    yield self._slice_src(run_src, run_start, run_end)
+                run_src, run_start, run_end = node.src_, node.start, node.end
+                continue
+            text = node.join(ignore_hidden=False, inplace=False)
+            if not text:
+                # e.g., an empty group, whose groupings are in the style
+                # tree
+                continue
+            if run_src is not None:
+                yield self._slice_src(run_src, run_start, run_end)
+                run_src = None
+            yield text
+        if run_src is not None:
+            yield self._slice_src(run_src, run_start, run_end)
+
+    def _merge_text_nodes(self):
+        """
+        Merge the text nodes of the style tree and the main tree by start.
+        Both trees already hold their nodes in text order, so this is a
+        single linear pass instead of a sort. On equal starts, the style
+        node comes first. After apply_edit(), starts are mapped to the
+        current text by the source map.
+        """
+        style_list = self.get_style_nodes().linearize()
+        node_list = self.get_root_node().linearize()
+        i, j = 0, 0
+        style_len, node_len = len(style_list), len(node_list)
+        if self.source_map is not None:
+            position = self.source_map.node_position
+            while i < style_len and j < node_len:
+                if position(style_list[i]) <= position(node_list[j]):
+                    yield style_list[i]
+                    i += 1
+                else:
+                    yield node_list[j]
+                    j += 1
+        while i < style_len and j < node_len:
+            if style_list[i].start <= node_list[j].start:
+                yield style_list[i]
+                i += 1
+            else:
+                yield node_list[j]
+                j += 1
+        yield from style_list[i:]
+        yield from node_list[j:]
+
+    @staticmethod
+    def _slice_src(src, start, end):
+        text = src[start:end]
+        if not isinstance(text, str):
+            text = str(text, 'utf-8')
         return text
+
+
+def _parse_worker(path, options):
+    """
+    Parse one file in a worker process
+
+    :return: the serialized parse tree, the cache hits and misses of the
+    worker, and the statistics of the parse if it was profiled
+    """
+    options = dict(options)
+    cache = None
+    if 'cache' in options:
+        cache = CppParseCache(options.pop('cache'),
+                              options.pop('cache_max_bytes'))
+    parser = CppParse(path=path, keep_phases=False, cache=cache,
+                      **options).parse()
+    hits = cache.hits if cache is not None else 0
+    misses = cache.misses if cache is not None else 0
+    stats = parser.stats.to_dict() if parser.stats is not None else None
+    return parser.to_bytes(), hits, misses, stats
@@ -1,18 +1,175 @@
 """
 Tokenize (lex) C++ text
+
+Two lexer modes are supported:
+1. split: a re.split into bare strings, labeled afterwards by CppParse1
+2. typed: a single pass over the text with one compiled master pattern.
+The tokens are stored in a CppTokStream as (kind, start, end), where kind is
+a CppTokType and start/end are character offsets into the text.
 """
 
 import re
 import sys, os
+from enum import IntEnum
+from .cpp_tok_stream import CppTokStream
+
+
+class CppTokType(IntEnum):
+    WHITESPACE = 0
+    SL_COMMENT = 1
+    ML_COMMENT = 2
+    STRING = 3
+    CHAR = 4
+    PREPROCESSOR = 5
+    NUMBER = 6
+    TEXT = 7
+    KEYWORD = 8
+    TYPE = 9
+    CLASS_KEYWORD = 10
+    STRUCT_KEYWORD = 11
+    NAMESPACE_KEYWORD = 12
+    TEMPLATE_KEYWORD = 13
+    TYPEDEF_KEYWORD = 14
+    USING_KEYWORD = 15
+    PAREN_LEFT = 16
+    PAREN_RIGHT = 17
+    BRACKET_LEFT = 18
+    BRACKET_RIGHT = 19
+    BRACE_LEFT = 20
+    BRACE_RIGHT = 21
+    ANGLE_BRACKET_LEFT = 22
+    ANGLE_BRACKET_RIGHT = 23
+    COMMA = 24
+    COLON = 25
+    SEMICOLON = 26
+    NS_SEP = 27
+    OP = 28
+
+
+#CPP keywords
+CPP0_KEYWORDS = ['and', 'and_eq', 'asm', 'atomic_cancel', 'atomic_commit',
+                 'atomic_noexcept', 'auto', 'bitand', 'bitor', 'bool',
+                 'break', 'case', 'catch', 'char', 'class', 'compl',
+                 'const', 'const_cast', 'continue', 'default', 'delete',
+                 'do', 'double', 'dynamic_cast', 'else', 'enum', 'explicit',
+                 'export', 'extern', 'false', 'float', 'for', 'friend',
+                 'goto', 'if', 'inline', 'int', 'long', 'mutable',
+                 'namespace', 'new', 'not', 'not_eq', 'operator', 'or',
+                 'or_eq', 'private', 'protected', 'public', 'reflexpr',
+                 'register', 'reinterpret_cast', 'return', 'short',
+                 'signed', 'sizeof', 'static', 'static_cast', 'struct',
+                 'switch', 'synchronized', 'template', 'this', 'throw',
+                 'true', 'try', 'typedef', 'typeid', 'typename', 'union',
+                 'unsigned', 'using', 'virtual', 'void', 'volatile',
+                 'wchar_t', 'while', 'xor', 'xor_eq']
+CPP11_KEYWORDS = CPP0_KEYWORDS + ['alignas', 'alignof', 'char16_t',
+                                  'char32_t', 'constexpr', 'decltype',
+                                  'noexcept', 'nullptr', 'static_assert',
+                                  'thread_local']
+CPP17_KEYWORDS = CPP11_KEYWORDS + []
+CPP20_KEYWORDS = CPP17_KEYWORDS + ['char8_t', 'concept', 'consteval',
+                                   'constinit', 'co_await', 'co_return',
+                                   'co_yield', 'requires']
+CPP23_KEYWORDS = CPP20_KEYWORDS + []
+CPP_KEYWORDS = CPP23_KEYWORDS
+
+# CPP Type Keywords
+CPP0_TYPE_KEYWORDS = ['bool', 'char', 'double',  'float', 'int',
+                      'void', 'wchar_t']
+CPP11_TYPE_KEYWORDS = CPP0_TYPE_KEYWORDS + ['char16_t', 'char32_t']
+CPP17_TYPE_KEYWORDS = CPP11_TYPE_KEYWORDS + []
+CPP20_TYPE_KEYWORDS = CPP17_TYPE_KEYWORDS + ['char8_t']
+CPP23_TYPE_KEYWORDS = CPP20_TYPE_KEYWORDS + []
+CPP_TYPE_KEYWORDS = CPP23_TYPE_KEYWORDS
+
+
+def _make_keyword_kinds():
+    kinds = {kw: CppTokType.KEYWORD for kw in CPP_KEYWORDS}
+    for kw in CPP_TYPE_KEYWORDS:
+        kinds[kw] = CppTokType.TYPE
+    kinds['class'] = CppTokType.CLASS_KEYWORD
+    kinds['struct'] = CppTokType.STRUCT_KEYWORD
+    kinds['namespace'] = CppTokType.NAMESPACE_KEYWORD
+    kinds['template'] = CppTokType.TEMPLATE_KEYWORD
+    kinds['typedef'] = CppTokType.TYPEDEF_KEYWORD
+    kinds['using'] = CppTokType.USING_KEYWORD
+    return kinds
+
+
+KEYWORD_KINDS = _make_keyword_kinds()
+KEYWORD_BYTES_KINDS = {kw.encode(): kind
+                       for kw, kind in KEYWORD_KINDS.items()}
+
+# Multi-character operators, longest first so the alternation is greedy
+MULTI_CHAR_OPS = ['->*', '...', '->', '++', '--', '+=', '-=', '*=', '/=',
+                  '%=', '==', '!=', '&=', '|=', '^=', '&&', '||', '.*', '##']
+
+# The master pattern. Each named group which is also a CppTokType name
+# produces a token of that kind. IDENT is either TEXT or a keyword.
+# NOTE: "<" and ">" are never merged into "<<", ">>", "<=", etc. here. Whether
+# they are angle brackets or operators is decided by the later phases.
+_TYPED_SOURCE = r"""
+    (?P<WHITESPACE>(?:\s|\\\r?\n)+)
+  | (?P<STRING>(?:u8|u|U|L)?R"(?P<raw_delim>[^()\\\s]{0,16})\(.*?\)
+                (?P=raw_delim)"
+              |(?:u8|u|U|L)?"(?:[^"\\\n]|\\.)*"?)
+  | (?P<CHAR>(?:u8|u|U|L)?'(?:[^'\\\n]|\\.)*'?)
+  | (?P<IDENT>%(ident)s)
+  | (?P<SEMICOLON>;)
+  | (?P<COMMA>,)
+  | (?P<PAREN_LEFT>\()
+  | (?P<PAREN_RIGHT>\))
+  | (?P<NS_SEP>::)
+  | (?P<COLON>:)
+  | (?P<BRACE_LEFT>\{)
+  | (?P<BRACE_RIGHT>\})
+  | (?P<BRACKET_LEFT>\[)
+  | (?P<BRACKET_RIGHT>\])
+  | (?P<ANGLE_BRACKET_LEFT><)
+  | (?P<ANGLE_BRACKET_RIGHT>>)
+  | (?P<SL_COMMENT>//[^\n]*)
+  | (?P<ML_COMMENT>/\*(?:.*?\*/|.*))
+  | (?P<PREPROCESSOR>\#(?:[^\n\\]|\\.|\\$)*)
+  | (?P<NUMBER>\.?[0-9](?:[eEpP][+-]|[0-9a-zA-Z_.'])*)
+  | (?P<OP>%(ops)s|[^\s\w])
+"""
+_TYPED_PATTERN = re.compile(_TYPED_SOURCE % {
+    'ident': r"[^\W\d]\w*",
+    'ops': "|".join(re.escape(op) for op in MULTI_CHAR_OPS)
+}, re.VERBOSE | re.DOTALL)
+
+# The same pattern over UTF-8 bytes (e.g., an mmap of a file). Bytes >= 0x80
+# are only valid in identifiers, strings, chars, and comments.
+_TYPED_BYTES_PATTERN = re.compile((_TYPED_SOURCE % {
+    'ident': r"(?:[^\W\d]|[\x80-\xff])(?:\w|[\x80-\xff])*",
+    'ops': "|".join(re.escape(op) for op in MULTI_CHAR_OPS)
+}).encode('latin-1'), re.VERBOSE | re.DOTALL)
+
+
+def _make_group_kinds():
+    kinds = [None] * (_TYPED_PATTERN.groups + 1)
+    for name, idx in _TYPED_PATTERN.groupindex.items():
+        if name in CppTokType.__members__:
+            kinds[idx] = CppTokType[name]
+    return kinds
+
+
+# The token kind of each group index in the master pattern
+GROUP_KINDS = _make_group_kinds()
+IDENT_GROUP = _TYPED_PATTERN.groupindex['IDENT']
 
 
 class CppParse0:
-    def __init__(self, text):
+    def __init__(self, text, typed=False):
         self.text = text
+        self.typed = typed
         self.toks = None
 
     def lex(self):
-        self._split_cpp_toks(self.text)
+        if self.typed:
+            self._lex_typed_toks(self.text)
+        else:
+            self._split_cpp_toks(self.text)
         return self
 
     @staticmethod
@@ -29,3 +186,64 @@ class CppParse0:
         toks = re.split(f"({chars}|\s+)", text)
         toks = CppParse0._clean(toks)
         self.toks = toks
+
+    def _lex_typed_toks(self, text, i=0, end=None):
+        """
+        Lex text[i:end] in a single pass into a CppTokStream. text is either
+        a str or a bytes-like object holding UTF-8 (e.g., an mmap). For
+        bytes, token offsets are byte offsets.
+        A '#' begins a preprocessor directive which runs until the first
+        newline not escaped by a backslash.
+
+        :param i: the offset in text to begin lexing at
+        :param end: the offset to stop lexing at (default: end of text)
+        """
+        if end is None:
+            end = len(text)
+        if isinstance(text, str):
+            pattern = _TYPED_PATTERN
+            keyword_kinds = KEYWORD_KINDS
+        else:
+            pattern = _TYPED_BYTES_PATTERN
+            keyword_kinds = KEYWORD_BYTES_KINDS
+        toks = CppTokStream(text)
+        append_kind = toks.kinds.append
+        append_start = toks.starts.append
+        append_end = toks.ends.append
+        group_kinds = GROUP_KINDS
+        ident_group = IDENT_GROUP
+        text_kind = CppTokType.TEXT
+        check_min = CppTokType.ML_COMMENT.value
+        check_max = CppTokType.CHAR.value
+        for m in pattern.finditer(text, i, end):
+            group = m.lastindex
+            if group == ident_group:
+                kind = keyword_kinds.get(m.group(), text_kind)
+            else:
+                kind = group_kinds[group]
+            start, stop = m.span()
+            if check_min <= kind <= check_max:
+                self._check_terminated(text, kind, start, stop)
+            append_kind(kind)
+            append_start(start)
+            append_end(stop)
+        self.toks = toks
+        return toks
+
+    @staticmethod
+    def _check_terminated(text, kind, start, end):
+        """
+        Verify a comment, string, or char literal is closed
+        """
+        last = text[end - 1:end]
+        if kind == CppTokType.ML_COMMENT:
+            if end - start < 4 or text[end - 2:end - 1] + last not in \
+                    ('*/', b'*/'):
+                raise Exception("Couldn't find the end */ of the "
+                                "multi-line comment")
+        elif kind == CppTokType.STRING:
+            if end - start < 2 or last not in ('"', b'"'):
+                raise Exception("Could not find end of string")
+        elif kind == CppTokType.CHAR:
+            if end - start < 2 or last not in ('\'', b'\''):
+                raise Exception("Could not find end of char")
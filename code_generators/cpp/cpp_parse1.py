@@ -1,64 +1,244 @@
 """
 An initial labeling of all tokens. No structural changes.
+
+Given the CppParse3 of the text (with fold_conditionals), the directives of
+typed tokens are processed as they are met, and the tokens of the text which
+isn't active (the branches of conditionals which aren't taken) are skipped
+without making a node of them. Each run of them becomes one MACRO_INACTIVE
+node which spans its text.
 """
 
 import re
 from .cpp_parse_node import CppParseNode, CppParseNodeType
+from .cpp_parse0 import CppTokType, CPP_KEYWORDS, CPP_TYPE_KEYWORDS
+
+# The node type of each typed token which becomes a single leaf node
+TYPED_LEAF_TYPES = [CppParseNodeType[kind.name]
+                    if kind.name in CppParseNodeType.__members__ else None
+                    for kind in CppTokType]
+for kind in [CppTokType.WHITESPACE, CppTokType.SL_COMMENT,
+             CppTokType.ML_COMMENT, CppTokType.STRING, CppTokType.CHAR,
+             CppTokType.PREPROCESSOR]:
+    TYPED_LEAF_TYPES[kind] = None
 
 
 class CppParse1:
-    def __init__(self, lex=None):
+    def __init__(self, lex=None, directives=None):
+        """
+        :param lex: the CppParse0 of the text
+        :param directives: the CppParse3 which processes the directives of
+        the typed tokens as they are met (see CppParse3.parse_directive()),
+        or None
+        """
         self.lex = lex
+        self.directives = directives
         self.root_node = None
         self.style_nodes = None
         self.cur_node = None
+        # (node, message) of each error found by this phase or later ones
+        self.errors = []
 
         #CPP operators
         self.operators = ['+', '-', '*', '/', '<', '>', '=', '?', '%', '@',
                           '&', '^', '|']
 
         #CPP keywords
-        self.cpp0 = ['and', 'and_eq', 'asm', 'atomic_cancel', 'atomic_commit',
-                     'atomic_noexcept', 'auto', 'bitand', 'bitor', 'bool',
-                     'break', 'case', 'catch', 'char', 'class', 'compl',
-                     'const', 'const_cast', 'continue', 'default', 'delete',
-                     'do', 'double', 'dynamic_cast', 'else', 'enum', 'explicit',
-                     'export', 'extern', 'false', 'float', 'for', 'friend',
-                     'goto', 'if', 'inline', 'int', 'long', 'mutable',
-                     'namespace', 'new', 'not', 'not_eq', 'operator', 'or',
-                     'or_eq', 'private', 'protected', 'public', 'reflexpr',
-                     'register', 'reinterpret_cast', 'return', 'short',
-                     'signed', 'sizeof', 'static', 'static_cast', 'struct',
-                     'switch', 'synchronized', 'template', 'this', 'throw',
-                     'true', 'try', 'typedef', 'typeid', 'typename', 'union',
-                     'unsigned', 'using', 'virtual', 'void', 'volatile',
-                     'wchar_t', 'while', 'xor', 'xor_eq']
-        self.cpp11 = self.cpp0 + ['alignas', 'alignof', 'char16_t', 'char32_t',
-                                  'constexpr', 'decltype', 'noexcept',
-                                  'nullptr', 'static_assert', 'thread_local']
-        self.cpp17 = self.cpp11 + []
-        self.cpp20 = self.cpp17 + ['char8_t', 'concept', 'consteval',
-                                   'constinit', 'co_await', 'co_return',
-                                   'co_yield', 'requires']
-        self.cpp23 = self.cpp20 + []
-        self.keywords = self.cpp23
+        self.keywords = CPP_KEYWORDS
 
         # CPP Type Keywords
-        self.type_keywords0 = ['bool', 'char', 'double',  'float', 'int',
-                               'void', 'wchar_t']
-        self.type_keywords11 = self.type_keywords0 + ['char16_t', 'char32_t']
-        self.type_keywords17 =  self.type_keywords11 + []
-        self.type_keywords20 = self.type_keywords17 + ['char8_t']
-        self.type_keywords23 = self.type_keywords20 + []
-        self.type_keywords = self.type_keywords23
+        self.type_keywords = CPP_TYPE_KEYWORDS
 
     def parse(self):
         self.root_node = CppParseNode()
         self.style_nodes = CppParseNode()
         self.cur_node = self.root_node
-        self._parse_toks(self.lex.toks)
+        if self.lex.typed and self.directives is not None:
+            self._parse_typed_directives(self.lex.text, self.lex.toks)
+        elif self.lex.typed:
+            self._parse_typed_toks(self.lex.text, self.lex.toks)
+        else:
+            self._parse_toks(self.lex.toks)
         return self
 
+    def _parse_typed_toks(self, text, toks, lo=0, hi=None):
+        """
+        Label the tokens of the typed lexer. The kind was already decided by
+        the lexer, so no token is re-classified here. Nodes span the text
+        instead of holding a copy of it.
+
+        :param text: the text the tokens point into. This is either a str or
+        a bytes-like object (e.g., an mmap) holding UTF-8.
+        :param toks: the CppTokStream of the text
+        :param lo: the index of the first token to label
+        :param hi: the index after the last token to label (default: all)
+        """
+        leaf_types = TYPED_LEAF_TYPES
+        cur_node = self.cur_node
+        children = cur_node.children_
+        style_nodes = self.style_nodes
+        style_children = style_nodes.children_
+        decode = not isinstance(text, str)
+        kinds, starts, ends = toks.kinds, toks.starts, toks.ends
+        if lo or hi is not None:
+            kinds, starts, ends = kinds[lo:hi], starts[lo:hi], ends[lo:hi]
+        for kind, start, end in zip(kinds, starts, ends):
+            node_type = leaf_types[kind]
+            if node_type is not None:
+                children.append(CppParseNode(node_type, None, start, cur_node,
+                                             False, end, text))
+            elif kind == CppTokType.WHITESPACE:
+                style_children.append(CppParseNode(
+                    CppParseNodeType.TEXT, None, start, style_nodes,
+                    True, end, text))
+            else:
+                tok = text[start:end]
+                if decode:
+                    tok = str(tok, 'utf-8')
+                if kind == CppTokType.STRING or kind == CppTokType.CHAR:
+                    self._parse_typed_quote(text, tok, kind, start, end)
+                elif kind == CppTokType.PREPROCESSOR:
+                    self._parse_typed_preprocessor(text, tok, start, end)
+                elif kind == CppTokType.SL_COMMENT or \
+                        kind == CppTokType.ML_COMMENT:
+                    self._parse_typed_comment(text, kind, start, end)
+
+    def _parse_typed_directives(self, text, toks):
+        """
+        Label the tokens of the typed lexer, and process each directive
+        with the directives CppParse3 as it is met. The tokens between a
+        directive after which the text isn't active and the next one after
+        which it is are skipped. They become one MACRO_INACTIVE node, unless
+        they are only whitespace and comments. Text which is still inactive
+        at the end (an #if without #endif) is labeled.
+        """
+        kinds = toks.kinds.tobytes()
+        starts, ends = toks.starts, toks.ends
+        directive = bytes([CppTokType.PREPROCESSOR])
+        style = bytes([CppTokType.WHITESPACE, CppTokType.SL_COMMENT,
+                       CppTokType.ML_COMMENT])
+        directives = self.directives
+        directives.parse_tree = self
+        decode = not isinstance(text, str)
+        # The first token which isn't labeled or skipped, and whether it
+        # is inactive
+        lo = 0
+        skip = False
+        # Whether the inactive run has directives
+        skipped = False
+        i = kinds.find(directive)
+        while i != -1:
+            start, end = starts[i], ends[i]
+            tok = text[start:end]
+            if decode:
+                tok = str(tok, 'utf-8')
+            node = self._make_typed_preprocessor(text, tok, start, end)
+            if not skip:
+                self._parse_typed_toks(text, toks, lo, i)
+                self.cur_node.add_child_node(node)
+                skip = not directives.parse_directive(node)
+                skipped = False
+            elif not directives.parse_directive(node):
+                skipped = True
+                i = kinds.find(directive, i + 1)
+                continue
+            else:
+                if skipped or len(kinds[lo:i].translate(None, style)):
+                    self.cur_node.add_child_node(CppParseNode(
+                        CppParseNodeType.MACRO_INACTIVE, None, ends[lo - 1],
+                        self.cur_node, False, start, text))
+                else:
+                    self._parse_typed_toks(text, toks, lo, i)
+                self.cur_node.add_child_node(node)
+                skip = False
+            lo = i + 1
+            i = kinds.find(directive, lo)
+        self._parse_typed_toks(text, toks, lo, len(kinds))
+
+    def _parse_typed_quote(self, text, tok, kind, start, end):
+        """
+        A string or char literal becomes a STRING/CHAR node whose value is
+        the text between the quotes. The prefix and quotes are style nodes.
+
+        :param text: the text the literal points into
+        :param tok: the text of the literal
+        :param kind: either CppTokType.STRING or CppTokType.CHAR
+        :param start: the offset of the first character of the literal
+        :param end: the offset after the closing quote
+        """
+        quote = '\"' if kind == CppTokType.STRING else '\''
+        inner_off = tok.index(quote) + 1
+        suffix_len = 1
+        if inner_off > 1 and tok[inner_off - 2] == 'R':
+            # Raw string: R"delim( ... )delim"
+            delim_end = tok.index('(', inner_off)
+            suffix_len += delim_end - inner_off + 1
+            inner_off = delim_end + 1
+        style_node = CppParseNode(CppParseNodeType.TEXT, hidden=True)
+        style_node.make_span_child(CppParseNodeType.TEXT, text,
+                                   start, start + inner_off, hidden=True)
+        style_node.make_span_child(CppParseNodeType.TEXT, text,
+                                   end - suffix_len, end, hidden=True)
+        self.style_nodes.add_child_node(style_node)
+        node_type = CppParseNodeType[CppTokType(kind).name]
+        self.cur_node.make_span_child(node_type, text,
+                                      start + inner_off, end - suffix_len)
+
+    def _parse_typed_comment(self, text, kind, start, end):
+        """
+        A comment becomes a style node whose value is the comment text
+        without the // or /* */ delimiters.
+
+        :param text: the text the comment points into
+        :param kind: either CppTokType.SL_COMMENT or CppTokType.ML_COMMENT
+        :param start: the offset of the comment
+        :param end: the offset after the comment
+        """
+        body_end = end
+        if kind == CppTokType.ML_COMMENT:
+            body_end = end - 2
+        style_node = CppParseNode(CppParseNodeType[CppTokType(kind).name],
+                                  None, start + 2, None, False,
+                                  body_end, text)
+        style_node.make_span_child(CppParseNodeType.TEXT, text,
+                                   start, start + 2, hidden=True)
+        style_node.make_span_child(CppParseNodeType.TEXT, text,
+                                   start + 2, body_end)
+        if body_end != end:
+            style_node.make_span_child(CppParseNodeType.TEXT, text,
+                                       body_end, end, hidden=True)
+        self.style_nodes.add_child_node(style_node)
+
+    def _parse_typed_preprocessor(self, text, tok, start, end):
+        """
+        A preprocessor directive becomes a PREPROCESSOR node. The first child
+        is the directive (e.g., #define) and the second is the rest of the
+        line(s).
+
+        :param text: the text the directive points into
+        :param tok: the text of the directive
+        :param start: the offset of the '#'
+        :param end: the offset after the directive
+        """
+        self.cur_node.add_child_node(
+            self._make_typed_preprocessor(text, tok, start, end))
+
+    @staticmethod
+    def _make_typed_preprocessor(text, tok, start, end):
+        i = 1
+        while i < len(tok) and tok[i] in ' \t':
+            i += 1
+        while i < len(tok) and (tok[i] == '_' or
+                                tok[i].isascii() and tok[i].isalnum()):
+            i += 1
+        preprocess_node = CppParseNode(CppParseNodeType.PREPROCESSOR,
+                                       None, start, None, False, end, text)
+        preprocess_node.make_span_child(CppParseNodeType.TEXT, text,
+                                        start, start + i)
+        if i < len(tok):
+            preprocess_node.make_span_child(CppParseNodeType.TEXT, text,
+                                            start + i, end)
+        return preprocess_node
+
     def _parse_toks(self, toks, i=0, term=None):
         while i < len(toks):
             tok = toks[i]
@@ -76,11 +256,11 @@ class CppParse1:
                 i = self._parse_whitespace(toks, i)
             elif tok == '#':
                 i = self._parse_preprocessor(toks, i)
-            elif tok == '(':
+            elif tok == '(' or tok == ')':
                 i = self._parse_parens(toks, i)
-            elif tok == '[':
+            elif tok == '[' or tok == ']':
                 i = self._parse_bracket(toks, i)
-            elif tok == '{':
+            elif tok == '{' or tok == '}':
                 i = self._parse_brace(toks, i)
             elif tok == '<' or tok == '>':
                 i = self._parse_angle_bracket(toks, i)
@@ -260,7 +440,8 @@ class CppParse1:
                     style_node.make_tok_child(CppParseNodeType.TEXT,
                                               toks[i], i, hidden=True)
                     preprocess_node.join()
-                    self.style_nodes.add_child_node(preprocess_node)
+                    self.style_nodes.add_child_node(preprocess_node,
+                                                    copy=True)
                     self.cur_node.add_child_node(preprocess_node)
                     break
             preprocess_node.make_tok_child(CppParseNodeType.TEXT, toks[i], i)
@@ -371,10 +552,10 @@ class CppParse1:
         return self.style_nodes
 
     def add_error(self, root_node, msg):
-        pass
+        self.errors.append((root_node, msg))
 
     def get_errors(self):
-        pass
+        return self.errors
 
     def _toks_match(self, toks, i, *vals):
         for val in vals:
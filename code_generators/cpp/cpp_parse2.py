@@ -9,121 +9,136 @@ from .cpp_parse_node import CppParseNode, CppParseNodeType
 from .cpp_parse_base import CppParseBase
 
 
+# The group node type and terminator of each left grouping
+GROUPINGS = {
+    CppParseNodeType.PAREN_LEFT: (CppParseNodeType.PARENTHESIS,
+                                  CppParseNodeType.PAREN_RIGHT),
+    CppParseNodeType.BRACKET_LEFT: (CppParseNodeType.BRACKETS,
+                                    CppParseNodeType.BRACKET_RIGHT),
+    CppParseNodeType.BRACE_LEFT: (CppParseNodeType.BRACES,
+                                  CppParseNodeType.BRACE_RIGHT),
+}
+TERMINATORS = {term for _, term in GROUPINGS.values()}
+
+# Operators which the split lexer leaves as single-character OP nodes
+SPLIT_OPS = ['++', '--', '+=', '-=', '*=', '/=', '%=', '==', '!=',
+             '&=', '|=', '^=', '&&', '||']
+
+
 class CppParse2(CppParseBase):
-    def __init__(self, parse_tree=None, state=None):
+    def __init__(self, parse_tree=None, state=None, merge_ops=True):
+        """
+        :param merge_ops: merge consecutive single-character operators
+        (e.g., '+' '+') into one. Not needed for the typed lexer, which
+        already emits multi-character operators as one token.
+        """
         self.parse_tree = parse_tree
         self.cur_node = None
+        self.merge_ops = merge_ops
 
     def parse(self):
         self.cur_node = self.get_root_node()
         self._parse(self.cur_node)
         return self
 
-    def _parse(self, root_node, i=0, term=None):
-        while i < root_node.size():
-            node = root_node[i]
-            if term and node[i].is_one_of(term):
-                return i
-            if node.is_one_of(CppParseNodeType.PAREN_LEFT):
-                self._parse_parens(root_node, i)
-            elif node.is_one_of(CppParseNodeType.BRACKET_LEFT):
-                self._parse_brackets(root_node, i)
-            elif node.is_one_of(CppParseNodeType.BRACE_LEFT):
-                self._parse_braces(root_node, i)
-            elif node.is_one_of(CppParseNodeType.COLON):
-                i = self._parse_ns_sep(root_node, i)
-            elif node.is_one_of(CppParseNodeType.OP):
-                i = self._parse_op(root_node, i)
+    def _parse(self, root_node):
+        """
+        Group everything between parens, brackets, and braces, and merge
+        multi-token operators, in one pass over the children of root_node.
+        The children of every group are built once as a new list.
+
+        The parens, brackets, and braces are moved into the style tree. They
+        are merged with the style nodes from phase 1 as they are found, so
+        the style tree stays in text order.
+        """
+        style_nodes = self.get_style_nodes()
+        old_styles = style_nodes.get_children()
+        styles = []
+        k = 0
+        # (group node, terminator, left node) of each unterminated group
+        stack = []
+        cur_node = CppParseNode(root_node.node_type)
+        term = None
+        left_node = None
+        for node in root_node.get_children():
+            node_type = node.node_type
+            if node_type in GROUPINGS or node_type == term:
+                start = node.start
+                while k < len(old_styles) and \
+                        self._style_start(old_styles[k], start) <= start:
+                    styles.append(old_styles[k])
+                    k += 1
+                styles.append(node)
+                node.parent = style_nodes
+            if node_type in GROUPINGS:
+                stack.append((cur_node, term, left_node))
+                group_type, term = GROUPINGS[node_type]
+                # The group starts at its left grouping, which is in the
+                # style tree
+                cur_node = CppParseNode(group_type, None, node.start, None,
+                                        False, None, node.src_)
+                left_node = node
+            elif node_type == term:
+                group_node = cur_node
+                cur_node, term, left_node = stack.pop()
+                cur_node.add_child_node(group_node)
+            elif node_type in TERMINATORS:
+                self.add_error(node, f"Unmatched {node.val}")
+                cur_node.add_child_node(node)
+            elif self.merge_ops and self._merge_op(cur_node, node):
+                pass
             else:
-                i += 1
-        return i
-
-    def _parse_parens(self, root_node, i):
-        return self._parse_grouping(root_node, i,
-                                    CppParseNodeType.PARENTHESIS,
-                                    CppParseNodeType.PAREN_RIGHT)
-
-    def _parse_brackets(self, root_node, i):
-        return self._parse_grouping(root_node, i,
-                                    CppParseNodeType.BRACKETS,
-                                    CppParseNodeType.BRACKET_RIGHT)
-
-    def _parse_braces(self, root_node, i):
-        return self._parse_grouping(root_node, i,
-                                    CppParseNodeType.BRACES,
-                                    CppParseNodeType.BRACE_RIGHT)
-
-    def _parse_ns_sep(self, root_node, i):
-        if self._pattern_matches(root_node, i, ':', ':'):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.NS_SEP)
-        return i + 1
-
-    def _parse_op(self, root_node, i):
-        # Arithmetic operators
-        if self._pattern_matches(root_node, i, '+', '+'):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '-', '-'):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '+', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '-', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '*', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '/', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '%', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-
-        # Relational operators
-        elif self._pattern_matches(root_node, i, '=', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '!', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '<', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '>', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-
-        # Bitwise operators
-        elif self._pattern_matches(root_node, i, '&', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '|', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '^', '='):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '<', '<'):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '>', '>'):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '<', '<', '='):
-            return self._parse_pattern(root_node, i, 3, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '>', '>', '='):
-            return self._parse_pattern(root_node, i, 3, CppParseNodeType.OP)
-
-        # Logical operators
-        elif self._pattern_matches(root_node, i, '&', '&'):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-        elif self._pattern_matches(root_node, i, '|', '|'):
-            return self._parse_pattern(root_node, i, 2, CppParseNodeType.OP)
-
-        return i + 1
-
-    def _pattern_matches(self, root_node, i, *vals):
-        for val in vals:
-            if root_node[i].val != val:
-                return False
-        return True
-    
-    def _parse_pattern(self, root_node, i, count, node_type):
-        i0 = i
+                cur_node.add_child_node(node)
+        while len(stack):
+            self.add_error(left_node, f"Unterminated {left_node.val}")
+            group_node = cur_node
+            cur_node, term, left_node = stack.pop()
+            cur_node.add_child_node(group_node)
+        styles += old_styles[k:]
+        style_nodes.set_children(styles)
+        root_node.set_children(cur_node.get_children())
+        for node in root_node.get_children():
+            node.parent = root_node
+
+    @staticmethod
+    def _style_start(node, default):
+        """
+        The start of the first text in a style node
+
+        :param default: the start to assume if the node has no text
+        """
+        while node.start is None and node.size():
+            node = node[0]
+        if node.start is None:
+            return default
+        return node.start
+
+    def _merge_op(self, cur_node, node):
+        """
+        Merge node into the last child of cur_node if together they form a
+        multi-token operator (e.g., '+' '+' or ':' ':').
+
+        :return: whether node was merged
+        """
+        if cur_node.size() == 0:
+            return False
+        prior_node = cur_node[-1]
+        if node.node_type != prior_node.node_type:
+            return False
+        val = prior_node.val + node.val
+        if node.node_type == CppParseNodeType.COLON and val == '::':
+            node_type = CppParseNodeType.NS_SEP
+        elif node.node_type == CppParseNodeType.OP and val in SPLIT_OPS:
+            node_type = CppParseNodeType.OP
+        else:
+            return False
         new_node = CppParseNode(node_type)
-        for k in range(count):
-            new_node.add_child_node(root_node[i])
-            i += 1
+        new_node.add_child_node(prior_node)
+        new_node.add_child_node(node)
         new_node.join(inplace=True, destroy_children=True)
-        root_node.replace_children(new_node, i0, i - 1)
-        return i
+        new_node.parent = cur_node
+        cur_node.get_children()[-1] = new_node
+        return True
 
     def get_root_node(self):
         return self.parse_tree.get_root_node()
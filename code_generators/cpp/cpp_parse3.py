@@ -1,201 +1,566 @@
 """
-Two actions
-1. Process #define
-2. Process #if, #elif, #else, #endif
-3. Process #ifdef, #elifdef, #elsedef
-4. Process #undef
+Preprocessing: #define, #undef, #include, and the conditionals (#if, #ifdef,
+#ifndef, #elif, #elifdef, #elifndef, #else, #endif)
+
+The condition of each #if and #elif is evaluated (see cpp_parse_expr), and
+the text of the branches which are not taken is inactive: its directives
+only count the nesting of conditionals, and its macros are not expanded.
+With fold_conditionals, each run of inactive nodes between two directives
+of the same group is replaced by a MACRO_INACTIVE node which spans their
+text, so the tree still inverts to the text. With the typed lexer, the
+directives are instead processed by the token-level pass of CppParse1 (see
+parse_directive()), which skips the inactive text before any node of it is
+made. The walk of the tree then replays the macros each directive defined.
+
+Macros are not replaced in the tree, so that it still inverts to the text.
+Each use of a macro instead gets its expansion: the TEXT node of the macro
+name gets the expanded text in its expansion property. A function-like macro
+is only used when its name is followed by a parenthesis group.
+
+When the parser follows includes, each #include is resolved through the
+include graph of its state (see CppIncludeGraph). The header is parsed once
+per set of imports, and the macros it exports are applied to the macro
+table. The include guard
+of the text, i.e., an #ifndef X and #define X which begin the text and an
+#endif which ends it, or its #pragma once, is found along the way. So is
+what the text depends on outside of itself: the macros its conditions and
+its text looked up before it defined or undefined them (its imports).
 """
 
 import re
+from .cpp_parse_expr import evaluate
+from .cpp_parse_macro import CppMacro, CppMacroTable, lex, join_tokens, \
+    is_ident
 from .cpp_parse_node import CppParseNode, CppParseNodeType
 
+GROUP_DELIMITERS = {
+    CppParseNodeType.PARENTHESIS: ('(', ')'),
+    CppParseNodeType.BRACKETS: ('[', ']'),
+    CppParseNodeType.BRACES: ('{', '}'),
+}
+IF_DIRECTIVES = ('#if', '#ifdef', '#ifndef')
+CONDITIONAL_DIRECTIVES = IF_DIRECTIVES + (
+    '#elif', '#elifdef', '#elifndef', '#else', '#endif')
+
+
+class CppConditional:
+    """
+    An #if whose #endif was not reached yet
+    """
+    def __init__(self, node, parent_active, active):
+        """
+        :param node: the PREPROCESSOR node of the #if
+        :param parent_active: whether the text around the #if is active
+        :param active: whether the first branch is taken
+        """
+        self.node = node
+        self.parent_active = parent_active
+        # Whether a branch was taken
+        self.taken = active
+        self.has_else = False
+
 
 class CppParse3:
-    def __init__(self, parse_tree=None, include_dirs=None, macros=None):
+    def __init__(self, parse_tree=None, include_dirs=None, macros=None,
+                 parser=None, fold_conditionals=False):
+        """
+        :param include_dirs: the directories to search for includes
+        :param macros: a CppMacroTable, or a dict of the macros defined
+        before the text from their name to their value
+        :param parser: the CppParse of the text, which follows its includes.
+        Without it, includes are not followed.
+        :param fold_conditionals: whether to replace the inactive branches
+        of conditionals by MACRO_INACTIVE nodes
+        """
         self.parse_tree = parse_tree
-        if include_dirs is None:
-            self.include_dirs = []
-        if macros is None:
-            self.macros = {}
+        self.include_dirs = include_dirs if include_dirs is not None else []
+        if not isinstance(macros, CppMacroTable):
+            macros = CppMacroTable(macros)
+        self.macros = macros
+        self.parser = parser
+        self.fold_conditionals = fold_conditionals
+        # The macros the text (and its includes) defined, or undefined
+        # (None), by name
+        self.exports = {}
+        # The macros the text (and its includes) looked up before defining
+        # or undefining them, by name, with the macro they found (None if
+        # it was not defined). Only recorded when includes are followed.
+        self.imports = {}
+        # The number of directives which changed the macros (#define,
+        # #undef, and followed #include)
+        self.defines = 0
+        # The headers included so far (when includes are followed)
+        self.included = {}
+        # The include guard macro of the text, and whether it has
+        # #pragma once
+        self.guard = None
+        self.pragma_once = False
+        # The open conditionals, innermost last
+        self.conds = []
+        # Whether the text being walked is active, and the directive which
+        # began the inactive text
+        self.active = True
+        self.inactive_start = None
+        # The directives before and after each run of inactive text
+        self.inactive = []
+        # The number of conditional directives
+        self.conditionals = 0
+        # The directives of the outermost conditionals, with their
+        # directive and the rest of their line
+        self.outer_ifs = []
+        # The macros each directive defined or undefined, and whether the
+        # text after it is active, by directive node, if the token-level
+        # pass processed the directives. The macros it defines are recorded
+        # in changes, and the walk starts again from walk_macros.
+        self.replays = None
+        self.changes = None
+        self.walk_macros = None
         self.cur_node = None
-        for macro_name, macro_val in self.macros.items():
-            if isinstance(macro_val, str):
-                macro_node = CppParseNode(CppParseNodeType.MACRO_DEF)
-                macro_node.make_tok_child(CppParseNodeType.MACRO_BODY,
-                                          macro_val, None)
-                self.macros[macro_name] = macro_node
 
     def parse(self):
         self.cur_node = self.get_root_node()
+        if self.replays is not None:
+            self.macros = self.walk_macros
+            self.walk_macros = None
+            self.changes = None
+            self.exports = {}
+            self.active = True
         self._parse(self.cur_node)
+        for cond in self.conds:
+            self.add_error(cond.node, "#endif was not found")
+        if self.fold_conditionals and self.replays is None:
+            self._fold_inactive()
+        self.guard = self._find_guard(self.cur_node)
+        # An includer which defines the guard skips the text instead, and
+        # one which includes the text again only repeats its exports
+        self.imports.pop(self.guard, None)
         return self
 
     def _parse(self, root_node):
-        i = 0
-        while i < root_node.size():
-            node = root_node[i]
-            if not node.is_one_of(CppParseNodeType.PREPROCESSOR):
-                if self._check_if_macro(node):
-                    self._parse_macro(root_node, i)
-                elif self._check_if_function_macro(node):
-                    self._parse_function_macro(root_node, i)
-            else:
-                preprocess_type = node[0]
-                if preprocess_type == '#define':
-                    i = self._parse_define(node)
-                elif preprocess_type == "#undef":
-                    i = self._parse_undefine(node)
-                elif preprocess_type == '#pragma':
-                    i += 1
-                elif preprocess_type == '#error':
-                    i += 1
-                elif preprocess_type == '#if':
-                    next_i = self._parse_if(root_node, i)
-                elif preprocess_type == '#ifdef':
-                    next_i = self._parse_ifdef(root_node, i)
-                elif preprocess_type == '#ifndef':
-                    next_i = self._parse_ifdef(root_node, i)
-                elif preprocess_type == '#include':
-                    i += 1
-                elif preprocess_type == '#endif':
-                    i += 1
-
-    def _check_if_function_macro(self, root_node):
-        """
-        Checks if the node equates to a function macro
-
-        :param root_node: the node being checked if macro
-        :return:
-        """
-        if root_node.val not in self.macros:
-            return False
-        macro_node = self.macros[root_node.val]
-        return macro_node.is_one_of(CppParseNodeType.MACRO_DEF)
-
-    def _check_if_macro(self, root_node):
+        # The tree may be deeper than the recursion limit, so the groups
+        # being walked are kept on a stack. Node types are compared by
+        # identity, since hashing an Enum member is slow.
+        preprocessor = CppParseNodeType.PREPROCESSOR
+        text = CppParseNodeType.TEXT
+        parens = CppParseNodeType.PARENTHESIS
+        braces = CppParseNodeType.BRACES
+        brackets = CppParseNodeType.BRACKETS
+        macros = self.macros.macros
+        imports = self.imports if self.parser is not None else None
+        replays = self.replays
+        active = self.active
+        stack = [(root_node, 0)]
+        while len(stack):
+            root_node, i = stack.pop()
+            children = root_node.get_children()
+            while i < len(children):
+                node = children[i]
+                node_type = node.node_type
+                i += 1
+                if node_type is preprocessor:
+                    if replays is None:
+                        self._parse_directive(node)
+                    else:
+                        self._replay(node)
+                    active = self.active
+                elif node_type is parens or node_type is braces or \
+                        node_type is brackets:
+                    # Inactive groups are still walked, since a branch may
+                    # open a group which a later branch closes
+                    stack.append((root_node, i))
+                    stack.append((node, 0))
+                    break
+                elif not active or node_type is not text or \
+                        (not macros and imports is None):
+                    # Nothing to expand, so don't copy out the text of node
+                    pass
+                elif node.val in macros:
+                    self._parse_macro(children, i - 1)
+                elif imports is not None and node.val not in imports:
+                    # An includer which defines it would change the text
+                    self._import((node.val,))
+
+    def parse_directive(self, node):
         """
-        Checks if the node equates to a macro
+        Process a directive for the token-level pass of CppParse1, before
+        the tree is built. parse() then replays the macros it defined
+        instead of processing it again.
 
-        :param root_node: the node being checked if it's a macro
-        :return:
+        :param node: the PREPROCESSOR node of the directive
+        :return: whether the text after the directive is active
         """
-        if root_node.val not in self.macros:
-            return False
-        macro_node = self.macros[root_node.val]
-        return macro_node.is_one_of(CppParseNodeType.MACRO_DEF)
-
-    def _find_macro_body(self, root_node):
+        if self.replays is None:
+            self.replays = {}
+            self.changes = []
+            self.walk_macros = self.macros.copy()
+        start = len(self.changes)
+        self._parse_directive(node)
+        self.replays[node] = (self.changes[start:], self.active)
+        return self.active
+
+    def _replay(self, node):
         """
-        Find the BODY keyword in the macro definition
-
-        :param root_node: the macro node
-        :return:
+        Apply the macros a directive defined when the token-level pass
+        processed it. Directives it didn't keep are in inactive text.
         """
-        i = 0
-        while i < root_node.size():
-            node = root_node[i]
-            if node.is_one_of(CppParseNodeType.MACRO_BODY):
-                return i
-            i += 1
-        return None
-
-
-    def _parse_macro(self, root_node, i):
+        replay = self.replays.get(node)
+        if replay is None:
+            return
+        changes, self.active = replay
+        for name, macro in changes:
+            self._set_macro(name, macro)
+
+    def _parse_directive(self, node):
         """
-        Replaces root_node[i] with the body of the macro
-
-        :param root_node:
-        :return:
+        Process a preprocessor line. The first child of node is the
+        directive (e.g., #define) and the others are the rest of the line
+        (one node with the typed lexer).
         """
-        macro_node = self.macros[root_node[i].val]
-        root_node.replace_children()
-
-    def _parse_function_macro(self, root_node, i):
+        directive = node[0].val.replace(' ', '').replace('\t', '')
+        rest = "".join(child.val for child in node.get_children()[1:])
+        if directive in CONDITIONAL_DIRECTIVES:
+            self.conditionals += 1
+            self._parse_conditional(node, directive, rest)
+            return
+        if not self.active:
+            return
+        try:
+            if directive == '#define':
+                self._parse_define(rest)
+            elif directive == '#undef':
+                self._parse_undefine(rest)
+            elif directive == '#include' and self.parser is not None:
+                self._process_include(rest)
+            elif directive == '#pragma' and rest.split() == ['once']:
+                self.pragma_once = True
+        except Exception as e:
+            self.add_error(node, str(e))
+
+    def _parse_conditional(self, node, directive, rest):
         """
-        Replaces root_node[i] with the body of the macro. Determines the
-        value of the macro parameters and replaces them in the macro body.
-
-        :param root_node:
-        :return:
+        Track the nesting of the conditionals and whether the text after
+        the directive is active. The conditions of branches which can't be
+        taken are not evaluated.
         """
-
-        pass
-
-    def _parse_define(self, root_node, i):
+        conds = self.conds
+        if directive in IF_DIRECTIVES:
+            if not len(conds):
+                self.outer_ifs.append((node, directive, rest))
+            active = self.active and self._evaluate(node, directive, rest)
+            conds.append(CppConditional(node, self.active, active))
+            self._set_active(node, active)
+            return
+        if not len(conds):
+            self.add_error(node, f"{directive} without #if")
+            return
+        cond = conds[-1]
+        if len(conds) == 1:
+            self.outer_ifs.append((node, directive, rest))
+        if directive == '#endif':
+            conds.pop()
+            self._set_active(node, cond.parent_active)
+            return
+        if cond.has_else:
+            self.add_error(node, f"{directive} after #else")
+            active = False
+        elif directive == '#else':
+            cond.has_else = True
+            active = cond.parent_active and not cond.taken
+        else:
+            active = cond.parent_active and not cond.taken and \
+                self._evaluate(node, directive, rest)
+        cond.taken = cond.taken or active
+        self._set_active(node, active)
+
+    def _evaluate(self, node, directive, rest):
         """
-        #define [MACRO_NAME] ...
-
-        :param root_node:
-        :param i: the index of the #define in root_node
-        :return:
+        :return: whether the condition of the directive holds. A condition
+        which can't be evaluated is an error, and false.
         """
-        macro_name = root_node[0].val
-        self.macros[macro_name] = root_node
-        return i + 1
+        if self.parser is None:
+            return self._evaluate_condition(node, directive, rest)
+        with self.macros.lookups() as names:
+            names.update(tok for tok in lex(rest) if is_ident(tok))
+            active = self._evaluate_condition(node, directive, rest)
+        self._import(names)
+        return active
+
+    def _evaluate_condition(self, node, directive, rest):
+        try:
+            if directive in ('#if', '#elif'):
+                return evaluate(rest, self.macros) != 0
+            toks = [tok for tok in lex(rest) if tok != ' ']
+            if len(toks) != 1 or not is_ident(toks[0]):
+                raise Exception(f"Invalid {directive}{rest}")
+            return (toks[0] in self.macros) != directive.endswith('ndef')
+        except Exception as e:
+            self.add_error(node, str(e))
+            return False
 
-    def _parse_undefine(self, root_node, i):
-        pass
+    def _set_active(self, node, active):
+        if active == self.active:
+            return
+        if active:
+            self.inactive.append((self.inactive_start, node))
+        else:
+            self.inactive_start = node
+        self.active = active
 
-    def _parse_if(self, root_node, i, depth=0):
-        return self._parse_generic_if(CppParseNodeType.MACRO_IF,
-                                      root_node, i, depth)
+    def _fold_inactive(self):
+        """
+        Replace the nodes between the directives before and after each run
+        of inactive text by a MACRO_INACTIVE node which spans their text,
+        and drop the style nodes in that text. Runs whose directives are in
+        different groups (e.g., a branch which opens a brace), or which have
+        no spans, are left alone.
+        """
+        runs = {}
+        for start, end in self.inactive:
+            parent = start.parent
+            if end.parent is not parent or start.end is None or \
+                    end.start is None or start[0].src_ is None:
+                continue
+            runs.setdefault(id(parent), (parent, []))[1].append((start, end))
+        spans = []
+        for parent, parent_runs in runs.values():
+            children = []
+            k = 0
+            run = None
+            skipped = 0
+            for node in parent.get_children():
+                if run is not None:
+                    start, end = run
+                    if node is not end:
+                        skipped += 1
+                        continue
+                    if skipped:
+                        children.append(CppParseNode(
+                            CppParseNodeType.MACRO_INACTIVE, None,
+                            start.end, parent, False, end.start,
+                            start[0].src_))
+                        spans.append((start.end, end.start))
+                    run = None
+                children.append(node)
+                if k < len(parent_runs) and node is parent_runs[k][0]:
+                    run = parent_runs[k]
+                    k += 1
+                    skipped = 0
+            parent.set_children(children)
+        if not len(spans):
+            return
+        spans.sort()
+        style_nodes = self.get_style_nodes()
+        children = []
+        k = 0
+        for node in style_nodes.get_children():
+            start = node.start
+            if start is not None:
+                while k < len(spans) and start >= spans[k][1]:
+                    k += 1
+                if k < len(spans) and start >= spans[k][0]:
+                    continue
+            children.append(node)
+        style_nodes.set_children(children)
+
+    def _find_guard(self, root_node):
+        """
+        The macro of the include guard of the text: the text begins with
+        #ifndef X (or #if !defined(X)) and #define X, and ends with the
+        #endif of that #ifndef, without an #else
 
-    def _parse_ifdef(self, root_node, i, depth=0):
-        return self._parse_generic_if(CppParseNodeType.MACRO_IFDEF,
-                                      root_node, i, depth)
+        :return: the name of the macro, or None
+        """
+        children = root_node.get_children()
+        if len(self.outer_ifs) != 2 or len(children) < 3 or \
+                len(self.conds):
+            return None
+        (first, directive, rest), (last, end, _) = self.outer_ifs
+        if first is not children[0] or last is not children[-1] or \
+                end != '#endif':
+            return None
+        toks = [tok for tok in lex(rest) if tok != ' ']
+        if directive == '#if' and toks[:2] == ['!', 'defined']:
+            toks = [tok for tok in toks[2:] if tok not in '()']
+        elif directive != '#ifndef':
+            return None
+        if len(toks) != 1 or not is_ident(toks[0]):
+            return None
+        define = children[1]
+        if define.node_type is not CppParseNodeType.PREPROCESSOR or \
+                define[0].val.replace(' ', '') != '#define':
+            return None
+        rest = "".join(child.val for child in define.get_children()[1:])
+        name = lex(rest.strip())
+        if not len(name) or name[0] != toks[0]:
+            return None
+        return toks[0]
+
+    def _parse_macro(self, children, i):
+        """
+        Expand a use of a macro
 
-    def _parse_ifndef(self, root_node, i, depth=0):
-        return self._parse_generic_if(CppParseNodeType.MACRO_IFNDEF,
-                                      root_node, i, depth)
+        The arguments of a function-like macro are the parenthesis group
+        after its name. If the expansion ends with the name of a
+        function-like macro, the parenthesis groups after the use complete
+        the invocation, e.g., F(2) with #define F G.
 
-    def _parse_generic_if(self, if_node_type,
-                          root_node, i, depth):
+        :param children: the nodes around the use
+        :param i: the index of the TEXT node of the macro name in children
+        """
+        if self.parser is None:
+            return self._expand_use(children, i)
+        with self.macros.lookups() as names:
+            names.add(children[i].val)
+            self._expand_use(children, i)
+        self._import(names)
+
+    def _expand_use(self, children, i):
+        parens = CppParseNodeType.PARENTHESIS
+        node = children[i]
+        toks = [node.val]
+        i += 1
+        if self.macros.get(node.val).params is not None:
+            if i >= len(children) or children[i].node_type is not parens:
+                return
+            toks += self._group_tokens(children[i])
+            i += 1
+        try:
+            out, pending = self.macros.expand_pending(toks)
+            while pending is not None and i < len(children) and \
+                    children[i].node_type is parens:
+                toks += self._group_tokens(children[i])
+                i += 1
+                out, pending = self.macros.expand_pending(toks)
+            node.expansion = join_tokens(out)
+        except Exception as e:
+            self.add_error(node, str(e))
+
+    @staticmethod
+    def _group_tokens(group):
+        """
+        The preprocessing tokens of a group, with whitespace where nodes
+        which span the text are apart
         """
-        Makes the #ifdef-elsedef recursively. Then processes it.
+        toks = []
+        last_end = None
+        stack = [(group, 0)]
+        toks.append(GROUP_DELIMITERS[group.node_type][0])
+        while len(stack):
+            root_node, i = stack.pop()
+            children = root_node.get_children()
+            while i < len(children):
+                node = children[i]
+                i += 1
+                start = node.start
+                if node.node_type is CppParseNodeType.STRING or \
+                        node.node_type is CppParseNodeType.CHAR:
+                    # The span of a literal is inside of its quotes
+                    start = start - 1 if start is not None else None
+                if start is None or last_end is None:
+                    # Without spans, tokens are assumed apart
+                    if toks[-1] not in '([{':
+                        toks.append(' ')
+                elif start > last_end:
+                    toks.append(' ')
+                if node.node_type in GROUP_DELIMITERS:
+                    toks.append(GROUP_DELIMITERS[node.node_type][0])
+                    stack.append((root_node, i))
+                    stack.append((node, 0))
+                    last_end = node.start + 1 \
+                        if node.start is not None else None
+                    break
+                if node.node_type is CppParseNodeType.STRING:
+                    toks.append(f'"{node.val}"')
+                elif node.node_type is CppParseNodeType.CHAR:
+                    toks.append(f"'{node.val}'")
+                elif node.val is not None:
+                    toks += lex(node.val)
+                last_end = node.end
+                if last_end is not None and start != node.start:
+                    last_end += 1
+            else:
+                toks.append(GROUP_DELIMITERS[root_node.node_type][1])
+                last_end = None
+        return toks
 
-        :param root_node: The node parent to the #if
-        :param i: the index of #if in the root node
-        :return:
+    def _parse_define(self, text):
         """
+        #define [MACRO_NAME] ...
 
-        i0 = i
-        if_node = CppParseNode(if_node_type)
-        if_node.add_child_node(root_node[i0])
-        cur_node_tmp = self.cur_node
-        if_node[0].add_child_node(CppParseNodeType.BODY)
-        self.cur_node = if_node[0]
-        i += 1
+        :param text: the rest of the line after #define
+        """
+        macro = CppMacro.from_define(text)
+        self._set_macro(macro.name, macro)
+        self.defines += 1
 
-        while i < root_node.size():
-            node = root_node[i]
-            if node.is_one_of(CppParseNodeType.PREPROCESSOR):
-                preprocess_type = node[0]
-                if preprocess_type == '#if':
-                    i = self._parse_if(root_node, i, depth + 1)
-                elif preprocess_type == '#ifdef':
-                    i = self._parse_ifdef(root_node, i, depth + 1)
-                elif preprocess_type == 'ifndef':
-                    i = self._parse_ifndef(root_node, i, depth + 1)
-                elif preprocess_type == 'elif':
-                    self.cur_node = node
-                elif preprocess_type == '#else':
-                    self.cur_node = node
-                elif preprocess_type == '#endif':
-                    break
-            else:
-                self.cur_node.add_child_node(node)
-            i += 1
+    def _parse_undefine(self, text):
+        """
+        #undef [MACRO_NAME]
+        """
+        toks = lex(text.strip())
+        if len(toks) != 1:
+            raise Exception(f"Invalid #undef{text}")
+        self._set_macro(toks[0], None)
+        self.defines += 1
 
-        if i == root_node.size():
-            self.add_error(root_node[i], "#endif was not found")
+    def _process_include(self, text):
+        """
+        #include "name" or #include <name>. Another form has its macros
+        expanded first.
 
-        self.cur_node = cur_node_tmp
-        if depth == 0:
-            root_node.replace_children(if_node, i0, i)
-        return i0 + 1
+        :param text: the rest of the line after #include
+        """
+        name, quoted = self._parse_include_name(text.strip())
+        if name is None:
+            name, quoted = self._parse_include_name(
+                self.macros.expand_text(text))
+        if name is None:
+            raise Exception(f"Invalid #include{text}")
+        header = self.parser._include(name, quoted, self)
+        if header is None:
+            return
+        # The header was parsed with the macros of this text as they are
+        self._import(header.get_imports())
+        for macro_name, macro in header.get_exports().items():
+            self._set_macro(macro_name, macro)
+        self.defines += 1
+
+    def _set_macro(self, name, macro):
+        """
+        Define a macro, or undefine it if macro is None, and export it
+        """
+        if macro is None:
+            self.macros.undefine(name)
+        else:
+            self.macros.define(macro)
+        self.exports[name] = macro
+        if self.changes is not None:
+            self.changes.append((name, macro))
+
+    def _import(self, names):
+        """
+        Record the macros the text looked up, unless it defined or
+        undefined them itself
+        """
+        for name in names:
+            if name not in self.imports and name not in self.exports:
+                self.imports[name] = self.macros.get(name)
 
-    def _process_include(self, root_node):
-        pass
+    @staticmethod
+    def _parse_include_name(text):
+        """
+        :return: the name of the header and whether it was quoted, or None
+        if text isn't a quoted or <> name
+        """
+        if len(text) > 2 and text[0] == '"':
+            end = text.find('"', 1)
+            if end > 1:
+                return text[1:end], True
+        if len(text) > 2 and text[0] == '<':
+            end = text.find('>', 1)
+            if end > 1:
+                return text[1:end], False
+        return None, False
 
     def get_root_node(self):
         return self.parse_tree.get_root_node()
@@ -13,40 +13,36 @@ from .cpp_parse_node import CppParseNode, CppParseNodeType
 class CppParse4:
     def __init__(self, parse_tree=None):
         self.parse_tree = parse_tree
+        # The nodes whose children still need to be reparsed. Nested bodies
+        # are pushed here instead of being reparsed recursively.
+        self.pending = []
+        # The handler of each node type which may begin a pattern
+        self.handlers = {
+            CppParseNodeType.BRACKETS: self._check_if_lambda,
+            CppParseNodeType.ANGLE_BRACKET_LEFT:
+                self._check_if_template_params,
+            CppParseNodeType.CLASS_KEYWORD: self._parse_class_defn,
+            CppParseNodeType.STRUCT_KEYWORD: self._parse_class_defn,
+            CppParseNodeType.NAMESPACE_KEYWORD: self._parse_namespace_defn,
+        }
 
     def parse(self):
-        self._reparse(self.parse_tree.get_root_node())
+        self.pending.append(self.parse_tree.get_root_node())
+        while len(self.pending):
+            self._reparse(self.pending.pop())
         return self
 
     def _reparse(self, root_node):
+        handlers = self.handlers
         i = 0
         while i < root_node.size():
             node = root_node[i]
             if self._check_if_function(root_node, i):
                 i = self._parse_function(root_node, i)
                 continue
-            elif node.node_type == CppParseNodeType.BRACKETS:
-                ret = self._check_if_lambda(root_node, i)
-                if ret > 0:
-                    i = ret
-                    continue
-            elif node.node_type == CppParseNodeType.ANGLE_BRACKET_LEFT:
-                ret = self._check_if_template_params(root_node, i)
-                if ret > 0:
-                    i = ret
-                    continue
-            elif node.node_type == CppParseNodeType.CLASS_KEYWORD:
-                ret = self._parse_class_defn(root_node, i)
-                if ret > 0:
-                    i = ret
-                    continue
-            elif node.node_type == CppParseNodeType.STRUCT_KEYWORD:
-                ret = self._parse_class_defn(root_node, i)
-                if ret > 0:
-                    i = ret
-                    continue
-            elif node.node_type == CppParseNodeType.NAMESPACE_KEYWORD:
-                ret = self._parse_namespace_defn(root_node, i)
+            handler = handlers.get(node.node_type)
+            if handler is not None:
+                ret = handler(root_node, i)
                 if ret > 0:
                     i = ret
                     continue
@@ -91,7 +87,7 @@ class CppParse4:
         node = root_node[i]
         if node.node_type == CppParseNodeType.BRACES:
             node.node_type = CppParseNodeType.BODY
-            self._reparse(node)
+            self.pending.append(node)
             i += 1
 
         # Update the root node
@@ -151,7 +147,7 @@ class CppParse4:
         if node.node_type != CppParseNodeType.BRACES:
             return -1
         node.node_type = CppParseNodeType.BODY
-        self._reparse(node)
+        self.pending.append(node)
         i += 1
 
         # Update the root node
@@ -17,9 +17,14 @@ from .cpp_parse_node import CppParseNode, CppParseNodeType
 class CppParse5:
     def __init__(self, parse_tree=None):
         self.parse_tree = parse_tree
+        # The nodes whose children still need to be reparsed. Nested nodes
+        # are pushed here instead of being reparsed recursively.
+        self.pending = []
 
     def parse(self):
-        self._reparse(self.get_root_node())
+        self.pending.append(self.get_root_node())
+        while len(self.pending):
+            self._reparse(self.pending.pop())
         return self
 
     def _reparse(self, root_node):
@@ -36,12 +41,12 @@ class CppParse5:
                     continue
             elif node.node_type == CppParseNodeType.CLASS_DEFN:
                 self._parse_class(node)
-                self._reparse(node)
+                self.pending.append(node)
             elif node.node_type == CppParseNodeType.NAMESPACE_DEFN:
                 self._parse_namespace(node)
-                self._reparse(node)
+                self.pending.append(node)
             elif node.node_type == CppParseNodeType.BODY:
-                self._reparse(node)
+                self.pending.append(node)
             i += 1
 
     def _parse_function_defn(self, func_node):
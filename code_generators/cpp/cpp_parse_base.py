@@ -4,36 +4,9 @@ from abc import ABC, abstractmethod
 
 class CppParseBase:
     @abstractmethod
-    def _parse(self, root_node, i, term):
+    def _parse(self, root_node):
         pass
 
-    def _parse_grouping(self, root_node, i, node_type, term):
-        """
-        Group everything between starter and terminator recursively.
-
-        :param i: the index of the left grouping (e..g, '(') in root_node
-        :param term: the CppParseNodeType of the terminating node
-        """
-        i0 = i
-        style_node = CppParseNode(CppParseNodeType.TEXT)
-        group_node = CppParseNode(node_type)
-
-        old_cur_node = self.cur_node
-        self.cur_node = group_node
-        # Add LEFT grouping to style node set
-        style_node.add_child_node(root_node[i])
-        # Parse everything up until the terminating character
-        i = self._parse(root_node, i + 1, term=term)
-        self.cur_node = old_cur_node
-
-        # The last character must be the terminating character
-        if not style_node[-1].is_one_of(term):
-            self.add_error(root_node[i0], f"Unterminated {root_node[i0].val}")
-
-        self.style_nodes.add_child_node(style_node)
-        self.cur_node.add_child_node(group_node)
-        return i + 1
-
     def _parse_args(self, root_node, i, node_type):
         """
         In a node which is known to be an argument list, this
@@ -0,0 +1,127 @@
+"""
+An on-disk cache of parse trees
+
+Entries are keyed by a hash of the content of a file and the configuration
+it was parsed with (parser version, format version, macros, include dirs,
+etc.), so a changed file or a changed configuration is simply a miss.
+Each entry is one file in the cache directory in the format of
+cpp_parse_serial. When the directory grows past its size limit, the least
+recently used entries are removed.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from . import cpp_parse_serial
+
+CACHE_SUFFIX = '.cppt'
+
+
+class CppParseCache:
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        """
+        :param cache_dir: the directory holding the cache entries
+        :param max_bytes: the size limit of the cache directory
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(data, config):
+        """
+        The key of a file
+
+        :param data: the content of the file (bytes or a buffer)
+        :param config: a JSON-serializable description of how the file is
+        parsed
+        """
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+        hasher.update(b'\0')
+        hasher.update(data)
+        return hasher.hexdigest()
+
+    def get(self, key):
+        """
+        Load the parse tree of a key
+
+        :return: a CppLoadedTree or None on a miss
+        """
+        path = self._entry_path(key)
+        try:
+            tree = cpp_parse_serial.load(path)[0][1]
+            # Mark the entry as recently used
+            os.utime(path)
+        except Exception:
+            # Missing or unreadable (e.g., truncated) entries are misses
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tree
+
+    def contains(self, key):
+        return os.path.exists(self._entry_path(key))
+
+    def put(self, key, root_node, style_nodes):
+        """
+        Store the parse tree of a key
+        """
+        path = self._entry_path(key)
+        # Each call writes its own temporary file, since threads (e.g., of
+        # parse_async) may put the same key at once
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                cpp_parse_serial.dump([(key, root_node, style_nodes)], fp)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if self.size is not None:
+            self.size += size
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache directory is
+        within its size limit
+        """
+        if self.size is not None and self.size <= self.max_bytes:
+            return
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            self.size -= size
+            self.evictions += 1
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(CACHE_SUFFIX):
+                os.remove(os.path.join(self.cache_dir, name))
+        self.size = 0
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_SUFFIX)
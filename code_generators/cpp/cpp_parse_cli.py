@@ -0,0 +1,66 @@
+"""
+Parse C++ files from the command line
+
+    python3 -m code_generators.cpp.cpp_parse_cli [-j JOBS] [--prefetch N]
+        [--cache DIR] [--mmap] [--save FILE] [--print]
+        [--profile FILE] [--profile-memory] PATH...
+
+Prints the number of nodes in the parse tree of each path. With --profile,
+the statistics of each phase are saved as JSON (see cpp_parse_profile).
+"""
+
+import argparse
+import sys
+from .cpp_parse import CppParse
+from .cpp_parse_profile import save_report
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(description="Parse C++ files")
+    parser.add_argument('paths', nargs='+', help="the files to parse")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="the number of processes to parse with")
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help="the number of files to read ahead of the "
+                             "parse")
+    parser.add_argument('--cache', default=None,
+                        help="the directory of the on-disk parse cache")
+    parser.add_argument('--mmap', action='store_true',
+                        help="lex files straight from an mmap")
+    parser.add_argument('--save', default=None,
+                        help="save the parse trees to this file")
+    parser.add_argument('--print', action='store_true',
+                        help="print the parse trees")
+    parser.add_argument('--profile', default=None,
+                        help="save the statistics of each phase to this "
+                             "JSON file (- prints them)")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="also trace the memory of each phase")
+    return parser
+
+
+def main(argv=None):
+    args = make_arg_parser().parse_args(argv)
+    parser = CppParse(paths=args.paths, jobs=args.jobs, cache=args.cache,
+                      prefetch=args.prefetch, use_mmap=args.mmap,
+                      keep_phases=False,
+                      profile=args.profile is not None,
+                      profile_memory=args.profile_memory).parse()
+    state = parser.state
+    for path in args.paths:
+        tree = state.parse_trees[path]
+        if args.print:
+            print(f"{path}:")
+            tree.print()
+        else:
+            count = sum(1 for _ in tree.get_root_node().iter_preorder())
+            print(f"{path}: {count} nodes")
+    if args.save is not None:
+        state.save(args.save)
+    if args.profile is not None:
+        save_report(state.get_profile_report(), args.profile)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
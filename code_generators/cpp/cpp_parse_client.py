@@ -0,0 +1,181 @@
+"""
+A client of the parse daemon (see cpp_parse_daemon)
+
+    python3 -m code_generators.cpp.cpp_parse_client [--socket PATH] COMMAND
+
+Commands:
+    ping                        check that the daemon is running
+    status                      the state of each file and request counts
+    watch PATH...               watch more files
+    unwatch PATH...             stop watching files
+    query SELECTOR [PATH...]    find nodes (see cpp_parse_query)
+    invert PATH                 print the text of the parse tree of a file
+    decorate -d MODULE:CLASS... PATH...
+                                generate code for decorated functions
+    shutdown                    stop the daemon
+
+Results are printed as JSON, except for invert. The client only uses the
+standard library, so it starts without loading the parser.
+"""
+
+import argparse
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+
+
+def default_socket_path():
+    """
+    The socket of the daemon: $CPP_PARSE_SOCKET, or a socket in the private
+    directory of the user (see private_socket_dir)
+    """
+    path = os.environ.get('CPP_PARSE_SOCKET')
+    if path:
+        return path
+    return os.path.join(private_socket_dir(), 'cpp_parse_daemon.sock')
+
+
+def private_socket_dir():
+    """
+    A directory only the user can access: $XDG_RUNTIME_DIR, or a per-user
+    directory in the temp directory, which is made with mode 0700. Another
+    user could make the latter first, so its owner and mode are checked.
+
+    :return: the path of the directory
+    """
+    path = os.environ.get('XDG_RUNTIME_DIR')
+    if not path:
+        path = os.path.join(tempfile.gettempdir(),
+                            f"cpp_parse_daemon-{os.getuid()}")
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        raise Exception(f"{path} is not a directory which only the user "
+                        f"can access")
+    return path
+
+
+def check_peer(sock, socket_path):
+    """
+    Check that the process at the other end of a connected Unix socket runs
+    as the user, so requests are never sent to a daemon of another user. The
+    credentials of the peer are used where the platform has SO_PEERCRED,
+    otherwise the owner of the socket file.
+
+    :param sock: the connected socket
+    :param socket_path: the path the socket is connected to
+    """
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+    else:
+        uid = os.stat(socket_path).st_uid
+    if uid != os.getuid():
+        raise Exception(f"{socket_path} is served by another user "
+                        f"(uid {uid})")
+
+
+class CppParseClient:
+    def __init__(self, socket_path=None, timeout=None):
+        """
+        :param socket_path: the Unix socket the daemon serves requests on
+        :param timeout: the number of seconds to wait for a response
+        """
+        self.socket_path = socket_path if socket_path is not None \
+            else default_socket_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(self.socket_path)
+        try:
+            check_peer(self.sock, self.socket_path)
+        except Exception:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, cmd, **args):
+        """
+        Run a command of the daemon
+
+        :param cmd: the name of the command (a cmd_<name> method of
+        CppParseDaemon)
+        :param args: the arguments of the command
+        :return: the result of the command
+        """
+        request = dict(args, cmd=cmd)
+        self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = self.rfile.readline()
+        if not line:
+            raise Exception("The daemon closed the connection")
+        response = json.loads(line)
+        if not response['ok']:
+            raise Exception(response['error'])
+        return response['result']
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Send a request to the parse daemon")
+    parser.add_argument('--socket', default=None,
+                        help="the Unix socket of the daemon")
+    cmds = parser.add_subparsers(dest='cmd', required=True)
+    cmds.add_parser('ping')
+    cmds.add_parser('status')
+    cmds.add_parser('shutdown')
+    for name in ['watch', 'unwatch']:
+        cmds.add_parser(name).add_argument('paths', nargs='+')
+    query = cmds.add_parser('query')
+    query.add_argument('selector')
+    query.add_argument('paths', nargs='*')
+    cmds.add_parser('invert').add_argument('path')
+    decorate = cmds.add_parser('decorate')
+    decorate.add_argument('-d', '--decorator', action='append',
+                          required=True, dest='decorators',
+                          help="a Decorator class as MODULE:CLASS")
+    decorate.add_argument('paths', nargs='+')
+    return parser
+
+
+def main(argv=None):
+    args = vars(make_arg_parser().parse_args(argv))
+    socket_path = args.pop('socket')
+    cmd = args.pop('cmd')
+    if cmd in ('watch', 'unwatch', 'query', 'decorate'):
+        args['paths'] = [os.path.abspath(path) for path in args['paths']] \
+            or None
+    elif cmd == 'invert':
+        args['path'] = os.path.abspath(args['path'])
+    try:
+        with CppParseClient(socket_path) as client:
+            result = client.request(cmd, **args)
+    except Exception as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    if cmd == 'invert':
+        sys.stdout.write(result)
+    else:
+        print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
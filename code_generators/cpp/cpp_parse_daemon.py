@@ -0,0 +1,464 @@
+"""
+A long-running daemon which keeps the parse trees of a set of files warm
+
+    python3 -m code_generators.cpp.cpp_parse_daemon [--socket PATH]
+        [--poll SECONDS] [--cache DIR] PATH...
+
+The daemon owns a CppParseState. It polls the watched files and reparses
+the ones whose mtime or size changed. The changed range of the text is found
+by comparing the old and new text, and is applied with CppParse.apply_edit,
+so only the statements around it are parsed again. The files are also
+checked before every request, so a request never sees a stale tree.
+
+Requests are served over a Unix socket, which only the user who started the
+daemon can connect to, one JSON object per line:
+    {"cmd": "query", "selector": "braces > text", "paths": ["a.h"]}
+and each gets one JSON line back:
+    {"ok": true, "result": ...} or {"ok": false, "error": "..."}
+Each command is a cmd_<name> method of CppParseDaemon. See
+cpp_parse_client for the client.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from .cpp_parse import CppParse
+from .cpp_parse_cache import CppParseCache
+from .cpp_parse_client import default_socket_path
+from .cpp_parse_node import CppParseNode
+from .cpp_parse_query import compile_query
+from .cpp_parse_state import CppParseState
+
+# The block size the old and new text of a file are compared in
+DIFF_BLOCK = 4096
+
+
+class CppParseDaemon:
+    def __init__(self, socket_path=None, paths=None, poll_interval=1.0,
+                 cache=None, typed_lex=True, macros=None, include_dirs=None,
+                 max_nodes=None, max_bytes=None):
+        """
+        :param socket_path: the Unix socket to serve requests on
+        :param paths: the files to watch
+        :param poll_interval: the number of seconds between checks of the
+        watched files. 0 only checks them when a request arrives.
+        :param cache: a CppParseCache or the directory of one, which files
+        are loaded from when first watched
+        :param typed_lex: see CppParse
+        :param macros: see CppParse
+        :param include_dirs: see CppParse
+        :param max_nodes: the budget of the parse trees in nodes. Past it,
+        the least recently used trees are evicted to the cache, or dropped
+        and parsed again when they are used.
+        :param max_bytes: the budget of the parse trees in estimated bytes
+        """
+        self.socket_path = socket_path if socket_path is not None \
+            else default_socket_path()
+        self.paths = list(dict.fromkeys(paths if paths is not None else []))
+        self.poll_interval = poll_interval
+        if isinstance(cache, str):
+            cache = CppParseCache(cache)
+        self.options = {
+            'typed_lex': typed_lex,
+            'macros': macros,
+            'include_dirs': include_dirs,
+            'cache': cache,
+            'keep_phases': False,
+        }
+        self.state = CppParseState(max_nodes, max_bytes, cache)
+        # The (mtime, size) and text of each file when it was last parsed
+        self.stamps = {}
+        self.texts = {}
+        # The error of each file which could not be parsed. Its last parse
+        # tree is kept.
+        self.errors = {}
+        self.counts = {'requests': 0, 'parses': 0, 'edits': 0}
+        self.lock = threading.RLock()
+        self.server = None
+        self.stop = threading.Event()
+        self.threads = []
+        self.start_time = time.time()
+
+    def serve_forever(self):
+        """
+        Serve requests until cmd_shutdown() or shutdown()
+        """
+        self._listen()
+        poller = self._start_poller()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop.set()
+            if poller is not None:
+                poller.join()
+            self._close()
+
+    def start(self):
+        """
+        Serve requests on a background thread
+
+        :return: self
+        """
+        self._listen()
+        self._start_poller()
+        server = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        server.start()
+        self.threads.append(server)
+        return self
+
+    def shutdown(self):
+        """
+        Stop serving requests and remove the socket
+        """
+        self.stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self._close()
+
+    def _listen(self):
+        with self.lock:
+            self.refresh()
+        if os.path.exists(self.socket_path):
+            # Only replace the socket of a daemon which is not running
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise Exception(f"A daemon is already serving "
+                                f"{self.socket_path}")
+            except OSError:
+                os.remove(self.socket_path)
+            finally:
+                probe.close()
+        # Only the user who started the daemon may send it requests. The
+        # socket is made without access for others, rather than changed
+        # after bind(), which would leave a window to connect in.
+        umask = os.umask(0o077)
+        try:
+            self.server = _CppParseServer(self.socket_path, _CppParseHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+
+    def _close(self):
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def _start_poller(self):
+        if self.poll_interval <= 0:
+            return None
+        poller = threading.Thread(target=self._poll, daemon=True)
+        poller.start()
+        self.threads.append(poller)
+        return poller
+
+    def _poll(self):
+        while not self.stop.wait(self.poll_interval):
+            with self.lock:
+                self.refresh()
+
+    def refresh(self):
+        """
+        Reparse the watched files which changed since they were last parsed.
+        The caller must hold the lock.
+
+        :return: the paths which changed
+        """
+        return [path for path in list(self.paths) if self._refresh_path(path)]
+
+    def _refresh_path(self, path):
+        """
+        Reparse a file if it changed
+
+        :return: whether it changed
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            # The file was removed
+            if path not in self.stamps:
+                return False
+            self._forget(path)
+            return True
+        stamp = (st.st_mtime_ns, st.st_size)
+        if self.stamps.get(path) == stamp:
+            return False
+        self.stamps[path] = stamp
+        parser = self.state.parse_trees.peek(path)
+        old_text = self.texts.get(path)
+        try:
+            # An evicted tree would be restored from the changed file, so it
+            # is parsed again instead of edited
+            if parser is None or parser.evicted or old_text is None:
+                parser = CppParse(path=path, state=self.state,
+                                  **self.options)
+                data = parser._read_path(path)
+                text = parser._decode(data)
+                self.state.parse_trees[path] = parser
+                parser._preprocess_data(data, text)
+                self.counts['parses'] += 1
+            else:
+                with open(path) as fp:
+                    text = fp.read()
+                start, old_end, new_end = _diff_range(old_text, text)
+                if start != old_end or start != new_end:
+                    parser.apply_edit(start, old_end, text[start:new_end])
+                    self.counts['edits'] += 1
+        except Exception as e:
+            # e.g., the file was saved in the middle of an edit which left a
+            # comment open. Keep the last parse tree until it is fixed.
+            self.errors[path] = str(e)
+            parser = self.state.parse_trees.peek(path)
+            if parser is not None and parser.parse_tree is None and \
+                    not parser.evicted:
+                del self.state.parse_trees[path]
+            return True
+        self.texts[path] = text
+        self.errors.pop(path, None)
+        return True
+
+    def _forget(self, path):
+        self.stamps.pop(path, None)
+        self.texts.pop(path, None)
+        self.errors.pop(path, None)
+        self.state.parse_trees.pop(path, None)
+
+    def handle(self, request):
+        """
+        Run a request
+
+        :param request: a dict with the name of the command ("cmd") and its
+        arguments
+        :return: the response
+        """
+        try:
+            request = dict(request)
+            cmd = getattr(self, f"cmd_{request.pop('cmd', None)}", None)
+            if cmd is None:
+                raise Exception("Unknown command")
+            with self.lock:
+                self.counts['requests'] += 1
+                self.refresh()
+                result = cmd(**request)
+            return {'ok': True, 'result': result}
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+
+    def _get_parsers(self, paths):
+        """
+        The parsers of paths, or of every watched file if paths is None
+        """
+        if paths is None:
+            paths = self.paths
+        parsers = []
+        for path in paths:
+            if path not in self.paths:
+                raise Exception(f"{path} is not watched")
+            parser = self.state.parse_trees.get(path)
+            if parser is None:
+                raise Exception(self.errors.get(path,
+                                                f"{path} was not parsed"))
+            parsers.append((path, parser))
+        return parsers
+
+    def cmd_ping(self):
+        return 'pong'
+
+    def cmd_watch(self, paths):
+        """
+        Watch more files and parse them
+
+        :return: the watched files
+        """
+        for path in paths:
+            if path not in self.paths:
+                self.paths.append(path)
+                self._refresh_path(path)
+        return self.paths
+
+    def cmd_unwatch(self, paths):
+        """
+        Stop watching files and drop their parse trees
+
+        :return: the watched files
+        """
+        for path in paths:
+            if path in self.paths:
+                self.paths.remove(path)
+                self._forget(path)
+        return self.paths
+
+    def cmd_refresh(self):
+        """
+        The files were already checked before the request, so this only
+        reports the state of each file
+        """
+        return self.cmd_status()['files']
+
+    def cmd_status(self):
+        return {
+            'files': {path: self.errors.get(path, 'ok')
+                      for path in self.paths},
+            'counts': self.counts,
+            'memory': self.state.get_stats(),
+            'uptime': time.time() - self.start_time,
+        }
+
+    def cmd_query(self, selector, paths=None):
+        """
+        Find the nodes matched by a selector (see cpp_parse_query)
+
+        :return: a dict with the type, text, and properties of each node
+        """
+        query = compile_query(selector)
+        nodes = []
+        for path, parser in self._get_parsers(paths):
+            for node in query.find_all(parser.get_root_node(),
+                                       parser.get_index()):
+                nodes.append(_node_to_dict(path, node))
+        return nodes
+
+    def cmd_invert(self, path):
+        """
+        The text of the parse tree of a file
+        """
+        return self._get_parsers([path])[0][1].invert()
+
+    def cmd_decorate(self, decorators, paths):
+        """
+        Generate code for decorated functions (see ParseDecorators). The
+        files are watched from then on.
+
+        :param decorators: the Decorator classes, as "module:ClassName"
+        :return: the files which were written
+        """
+        from code_generators.decorator.parse_decorators import \
+            ParseDecorators
+        self.cmd_watch(paths)
+        self._get_parsers(paths)
+        decs = []
+        for name in decorators:
+            module_name, _, class_name = name.partition(':')
+            decs.append(getattr(importlib.import_module(module_name),
+                                class_name)())
+        return ParseDecorators(decs, paths,
+                               parse_state=self.state).parse().outputs
+
+    def cmd_shutdown(self):
+        # The server can't be shut down from the thread of a request
+        threading.Thread(target=self.shutdown, daemon=True).start()
+        return 'bye'
+
+
+class _CppParseServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _CppParseHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.daemon
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise Exception("A request must be a JSON object")
+                response = daemon.handle(request)
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+def _node_to_dict(path, node):
+    node_dict = {'path': path, 'type': node.node_type.name}
+    if node.size() == 0:
+        node_dict['val'] = node.val
+    for prop in CppParseNode.PROP_SLOTS:
+        val = getattr(node, prop, None)
+        if val is not None:
+            node_dict[prop] = val
+    return node_dict
+
+
+def _diff_range(old, new):
+    """
+    The range of old which was replaced to make new, assuming the change is
+    contiguous
+
+    :return: (start, old_end, new_end), where old[start:old_end] became
+    new[start:new_end]
+    """
+    size = min(len(old), len(new))
+    # Skip equal blocks with slice comparisons, which run in C, then find
+    # the first difference in the block by character
+    start = 0
+    while start < size and \
+            old[start:start + DIFF_BLOCK] == new[start:start + DIFF_BLOCK]:
+        start += DIFF_BLOCK
+    start = min(start, size)
+    while start < size and old[start] == new[start]:
+        start += 1
+    # The common suffix may not overlap the common prefix
+    size -= start
+    end = 0
+    while end + DIFF_BLOCK <= size and \
+            old[len(old) - end - DIFF_BLOCK:len(old) - end] == \
+            new[len(new) - end - DIFF_BLOCK:len(new) - end]:
+        end += DIFF_BLOCK
+    while end < size and old[len(old) - end - 1] == new[len(new) - end - 1]:
+        end += 1
+    return start, len(old) - end, len(new) - end
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Keep the parse trees of C++ files warm")
+    parser.add_argument('paths', nargs='*', help="the files to watch")
+    parser.add_argument('--socket', default=None,
+                        help="the Unix socket to serve requests on")
+    parser.add_argument('--poll', type=float, default=1.0,
+                        help="the number of seconds between checks of the "
+                             "watched files")
+    parser.add_argument('--cache', default=None,
+                        help="the directory of the on-disk parse cache")
+    parser.add_argument('--max-nodes', type=int, default=None,
+                        help="evict parse trees past this many nodes")
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help="evict parse trees past this many estimated "
+                             "bytes")
+    return parser
+
+
+def main(argv=None):
+    args = make_arg_parser().parse_args(argv)
+    # Clients send absolute paths
+    paths = [os.path.abspath(path) for path in args.paths]
+    daemon = CppParseDaemon(args.socket, paths, args.poll, args.cache,
+                            max_nodes=args.max_nodes,
+                            max_bytes=args.max_bytes)
+    print(f"Serving {len(daemon.paths)} files on {daemon.socket_path}")
+    sys.stdout.flush()
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
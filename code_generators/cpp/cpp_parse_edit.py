@@ -0,0 +1,334 @@
+"""
+Incremental reparsing of an edited parse tree (see CppParse.apply_edit)
+
+An edit replaces text[start:end] of the current text. Only the tokens
+around the edit are lexed again:
+    1. The innermost group (parens, brackets, braces) whose inside contains
+       the whole edit is found. The root counts as a group spanning the
+       whole text.
+    2. Within it, the edit is widened to the enclosing statement: back to
+       the end of the prior ';', '}' or preprocessor line and forward to the
+       end of the next one.
+    3. The text of this region (with the edit applied) is lexed and run
+       through phases 1 to 3 on its own. Its nodes replace the old nodes of
+       the region in the main tree and the style tree.
+
+Widening to whole statements at one level keeps the region balanced, so
+grouping the region on its own gives the same tree as grouping the whole
+text. When that can't be guaranteed (the region doesn't lex to the same
+tokens at its ends, or grouping it fails), CppEditFallback is raised and the
+caller parses the whole text instead.
+
+Nodes after the region are not shifted. Each node keeps the offsets of the
+source it was lexed from, and a CppSourceMap maps them to offsets in the
+current text.
+"""
+
+from bisect import bisect_right
+from .cpp_parse0 import CppParse0
+from .cpp_parse1 import CppParse1
+from .cpp_parse2 import CppParse2
+from .cpp_parse3 import CppParse3
+from .cpp_parse_node import CppParseNodeType
+
+GROUP_TYPES = {CppParseNodeType.PARENTHESIS, CppParseNodeType.BRACKETS,
+               CppParseNodeType.BRACES}
+LEFT_TYPES = {CppParseNodeType.PAREN_LEFT, CppParseNodeType.BRACKET_LEFT,
+              CppParseNodeType.BRACE_LEFT}
+RIGHT_TYPES = {CppParseNodeType.PAREN_RIGHT, CppParseNodeType.BRACKET_RIGHT,
+               CppParseNodeType.BRACE_RIGHT}
+# The nodes which end a statement
+STATEMENT_ENDS = {CppParseNodeType.SEMICOLON, CppParseNodeType.PREPROCESSOR,
+                  CppParseNodeType.BRACES}
+# How far past the region to lex when checking that the region ends on a
+# token boundary. The check stops at the first newline.
+TAIL_LIMIT = 4096
+
+
+class CppEditFallback(Exception):
+    """
+    The edit can't be applied incrementally
+    """
+    pass
+
+
+class CppSourceMap:
+    def __init__(self, src):
+        """
+        The current text as a list of pieces, each a slice of a source which
+        nodes span. An edit replaces pieces instead of shifting the offsets
+        of every node after it.
+
+        :param src: the source of the unedited text
+        """
+        # (source, lo, hi) of each piece
+        self.pieces = [(src, 0, len(src))]
+        self.offs = None
+        self.by_src = None
+        self.size = 0
+        self._reindex()
+
+    def _reindex(self):
+        # The offset of each piece in the current text
+        self.offs = []
+        # id(source) -> ([lo of each piece of the source], [piece index])
+        self.by_src = {}
+        off = 0
+        for i, (src, lo, hi) in enumerate(self.pieces):
+            self.offs.append(off)
+            entry = self.by_src.get(id(src))
+            if entry is None:
+                entry = self.by_src[id(src)] = ([], [])
+            entry[0].append(lo)
+            entry[1].append(i)
+            off += hi - lo
+        self.size = off
+
+    def position(self, src, start):
+        """
+        The offset in the current text of src[start]
+        """
+        entry = self.by_src.get(id(src))
+        if entry is None:
+            raise CppEditFallback()
+        k = bisect_right(entry[0], start) - 1
+        if k < 0:
+            raise CppEditFallback()
+        i = entry[1][k]
+        return self.offs[i] + start - self.pieces[i][1]
+
+    def node_position(self, node):
+        return self.position(node.src_, node.start)
+
+    def replace(self, start, end, src, size):
+        """
+        Replace text[start:end] with src[0:size]
+        """
+        pieces = []
+        inserted = False
+        for piece, off in zip(self.pieces, self.offs):
+            piece_src, lo, hi = piece
+            piece_end = off + hi - lo
+            if piece_end <= start:
+                pieces.append(piece)
+                continue
+            if not inserted:
+                if off < start:
+                    pieces.append((piece_src, lo, lo + start - off))
+                pieces.append((src, 0, size))
+                inserted = True
+            if piece_end > end:
+                pieces.append((piece_src, lo + max(end - off, 0), hi))
+        if not inserted:
+            pieces.append((src, 0, size))
+        self.pieces = [piece for piece in pieces if piece[2] > piece[1]]
+        self._reindex()
+
+    def slice(self, start, end):
+        """
+        The current text[start:end], as a str or as bytes if the sources
+        are bytes
+        """
+        chunks = []
+        for (src, lo, hi), off in zip(self.pieces, self.offs):
+            piece_end = off + hi - lo
+            if piece_end <= start or off >= end:
+                continue
+            chunk = src[lo + max(start - off, 0):
+                        lo + min(end, piece_end) - off]
+            if not isinstance(chunk, (str, bytes)):
+                chunk = bytes(chunk)
+            chunks.append(chunk)
+        if len(chunks) == 1:
+            return chunks[0]
+        return (b'' if self.is_bytes() else '').join(chunks)
+
+    def text(self):
+        return self.slice(0, self.size)
+
+    def is_bytes(self):
+        return not isinstance(self.pieces[0][0], str)
+
+
+class CppParseEdit:
+    def __init__(self, root_node, style_nodes, source_map):
+        """
+        :param root_node: the root of the main tree
+        :param style_nodes: the root of the style tree
+        :param source_map: the CppSourceMap of the current text
+        """
+        self.root_node = root_node
+        self.style_nodes = style_nodes
+        self.map = source_map
+
+    def apply(self, start, end, new_text):
+        """
+        Replace text[start:end] with new_text and reparse the region around
+        it. Raises CppEditFallback if the tree was not modified because the
+        whole text has to be parsed instead.
+        """
+        group, lo, hi = self._find_group(start, end)
+        children = group.get_children()
+        i0, rs = self._find_region_start(children, start, lo, hi)
+        i1, re = self._find_region_end(children, i0, end, hi)
+        region = self.map.slice(rs, start) + new_text + \
+            self.map.slice(end, re)
+        main, styles, src = self._parse_region(region, re)
+        # Replace the old nodes of the region
+        style_children = self.style_nodes.get_children()
+        s0 = self._bisect(style_children, rs)
+        s1 = self._bisect(style_children, re)
+        for node in main:
+            node.parent = group
+        for node in styles:
+            node.parent = self.style_nodes
+        children[i0:i1 + 1] = main
+        style_children[s0:s1] = styles
+        self.map.replace(rs, re, src, len(region))
+
+    def _find_group(self, start, end):
+        """
+        The innermost group whose inside contains text[start:end]
+
+        :return: the group node and the offsets of its inside
+        """
+        node, lo, hi = self.root_node, 0, self.map.size
+        while True:
+            children = node.get_children()
+            k = self._bisect(children, start + 1) - 1
+            if k < 0 or children[k].node_type not in GROUP_TYPES:
+                return node, lo, hi
+            child = children[k]
+            child_lo = self._position(child) + 1
+            child_hi = self._right_of(children, k, hi)
+            if not (child_lo <= start and end <= child_hi):
+                return node, lo, hi
+            node, lo, hi = child, child_lo, child_hi
+
+    def _find_region_start(self, children, start, lo, hi):
+        """
+        The first child of the region and the offset it begins at: the end
+        of the last statement which ends before start
+        """
+        j = self._bisect(children, start + 1) - 1
+        while j >= 0:
+            if children[j].node_type in STATEMENT_ENDS:
+                stmt_end = self._end_of(children, j, hi)
+                # A preprocessor line ends at a newline, so text inserted
+                # right at its end would continue the line
+                if stmt_end < start or (stmt_end == start and
+                                        children[j].node_type !=
+                                        CppParseNodeType.PREPROCESSOR):
+                    return j + 1, stmt_end
+            j -= 1
+        return 0, lo
+
+    def _find_region_end(self, children, i0, end, hi):
+        """
+        The last child of the region and the offset it ends at: the end of
+        the first statement which ends at or after end
+        """
+        j = max(i0, self._bisect(children, end) - 1)
+        while j < len(children):
+            if children[j].node_type in STATEMENT_ENDS:
+                stmt_end = self._end_of(children, j, hi)
+                if stmt_end >= end:
+                    return j, stmt_end
+            j += 1
+        return len(children) - 1, hi
+
+    def _parse_region(self, region, re):
+        """
+        Lex and group the new text of the region
+
+        :param re: the offset in the current text the region ends at
+        :return: the main nodes, the style nodes, and the source they span
+        """
+        # The region must end on a token boundary. Lex it together with the
+        # rest of its last line to verify that no token crosses its end.
+        tail = self.map.slice(re, min(re + TAIL_LIMIT, self.map.size))
+        newline = tail.find(b'\n' if isinstance(tail, bytes) else '\n')
+        if newline >= 0:
+            tail = tail[:newline + 1]
+        src = region + tail
+        try:
+            phase0 = CppParse0(src, typed=True)
+            toks = phase0._lex_typed_toks(src)
+        except Exception:
+            raise CppEditFallback()
+        size = len(region)
+        n = bisect_right(toks.starts, size - 1) if size else 0
+        if n and toks.ends[n - 1] != size:
+            raise CppEditFallback()
+        del toks.kinds[n:]
+        del toks.starts[n:]
+        del toks.ends[n:]
+        phase1 = CppParse1(phase0).parse()
+        phase2 = CppParse2(phase1, merge_ops=False).parse()
+        phase3 = CppParse3(phase2).parse()
+        # A macro defined by the region would change the expansions after
+        # it, and a conditional which of the branches after it are active
+        if len(phase1.get_errors()) or phase3.defines or \
+                phase3.conditionals:
+            raise CppEditFallback()
+        return (phase3.get_root_node().get_children(),
+                phase3.get_style_nodes().get_children(), src)
+
+    def _position(self, node):
+        """
+        The offset in the current text of the first text of a node. A
+        group begins at its left grouping.
+        """
+        while node.node_type not in GROUP_TYPES and node.size():
+            node = node[0]
+        if node.start is None:
+            raise CppEditFallback()
+        return self.map.node_position(node)
+
+    def _bisect(self, nodes, off):
+        """
+        The index of the first node which begins at or after off
+        """
+        lo, hi = 0, len(nodes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._position(nodes[mid]) < off:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _end_of(self, children, j, hi):
+        """
+        The offset in the current text of the end of a child
+        """
+        node = children[j]
+        if node.node_type in GROUP_TYPES:
+            return self._right_of(children, j, hi) + 1
+        while node.node_type not in GROUP_TYPES and node.size():
+            node = node[-1]
+        if node.node_type in GROUP_TYPES or not node.has_span():
+            raise CppEditFallback()
+        return self.map.node_position(node) + node.end - node.start
+
+    def _right_of(self, children, j, hi):
+        """
+        The offset of the right grouping of a group child. Between it and
+        the next child (or the right grouping of the parent) there is only
+        whitespace and comments, so it is the last grouping in the style
+        tree before that.
+        """
+        if j + 1 < len(children):
+            bound = self._position(children[j + 1])
+        else:
+            bound = hi
+        style_children = self.style_nodes.get_children()
+        k = self._bisect(style_children, bound) - 1
+        while k >= 0:
+            node = style_children[k]
+            if node.node_type in RIGHT_TYPES:
+                return self.map.node_position(node)
+            if node.node_type in LEFT_TYPES:
+                break
+            k -= 1
+        raise CppEditFallback()
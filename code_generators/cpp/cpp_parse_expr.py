@@ -0,0 +1,281 @@
+"""
+Evaluate the condition of an #if or #elif (see CppParse3)
+
+As in the preprocessor, defined X and defined(X) are replaced first, then
+the macros are expanded, and the identifiers left (including true and
+false) become 0 and 1. The result is computed on integers: the arithmetic,
+bitwise, shift, comparison, logical, and conditional operators, and
+parentheses. As in the preprocessor, each value is an intmax_t or a
+uintmax_t (64 bits): a literal with a u suffix, or one which only fits
+unsigned, is unsigned, an operator on a signed and an unsigned value
+converts both to unsigned, and the results wrap around. So -1 < 0u is false.
+As in C, the operand of &&, ||, or ?: which isn't taken is parsed but not
+evaluated, so it can't divide by zero (e.g., #if X != 0 && 10 / X > 2).
+"""
+
+import operator
+from .cpp_parse_macro import lex, is_ident
+
+# The binary operators by precedence, lowest first
+BINARY_OPS = [
+    ('||',),
+    ('&&',),
+    ('|',),
+    ('^',),
+    ('&',),
+    ('==', '!='),
+    ('<', '>', '<=', '>='),
+    ('<<', '>>'),
+    ('+', '-'),
+    ('*', '/', '%'),
+]
+_PRECEDENCE = {op: level for level, ops in enumerate(BINARY_OPS)
+               for op in ops}
+_OPS = {
+    '|': operator.or_, '^': operator.xor, '&': operator.and_,
+    '==': operator.eq, '!=': operator.ne, '<': operator.lt, '>': operator.gt,
+    '<=': operator.le, '>=': operator.ge, '<<': operator.lshift,
+    '>>': operator.rshift, '+': operator.add, '-': operator.sub,
+    '*': operator.mul,
+}
+# The width of intmax_t and uintmax_t
+INT_BITS = 64
+_UINT_MOD = 1 << INT_BITS
+_INT_MAX = (1 << (INT_BITS - 1)) - 1
+_COMPARISONS = ('==', '!=', '<', '>', '<=', '>=')
+_CHAR_ESCAPES = {'n': 10, 't': 9, 'r': 13, '0': 0, 'a': 7, 'b': 8, 'f': 12,
+                 'v': 11, '\\': 92, "'": 39, '"': 34, '?': 63}
+
+
+def evaluate(text, macros):
+    """
+    :param text: the condition, e.g., the rest of the line after #if
+    :param macros: the CppMacroTable of the text before the condition
+    :return: the integer value of the condition
+    """
+    toks = _replace_defined(lex(text), macros)
+    toks = [tok for tok in macros.expand(toks) if tok != ' ']
+    if not len(toks):
+        raise Exception("#if with no expression")
+    return CppExprParser(toks).parse()[0]
+
+
+def _wrap(val, unsigned):
+    """
+    A value as an intmax_t, or a uintmax_t if unsigned
+
+    :return: the value and whether it is unsigned
+    """
+    val %= _UINT_MOD
+    if not unsigned and val > _INT_MAX:
+        val -= _UINT_MOD
+    return val, unsigned
+
+
+def _replace_defined(toks, macros):
+    out = []
+    i = 0
+    while i < len(toks):
+        tok = toks[i]
+        if tok != 'defined':
+            out.append(tok)
+            i += 1
+            continue
+        rest = [(j, toks[j]) for j in range(i + 1, min(i + 8, len(toks)))
+                if toks[j] != ' ']
+        if len(rest) and is_ident(rest[0][1]):
+            name, end = rest[0][1], rest[0][0]
+        elif len(rest) >= 3 and rest[0][1] == '(' and \
+                is_ident(rest[1][1]) and rest[2][1] == ')':
+            name, end = rest[1][1], rest[2][0]
+        else:
+            raise Exception("defined without a macro name")
+        out.append('1' if name in macros else '0')
+        i = end + 1
+    return out
+
+
+def parse_int(tok):
+    """
+    The value of an integer or character literal
+    """
+    if tok[-1] == "'":
+        return _parse_char(tok)
+    text = tok.replace("'", '').lower().rstrip('ul')
+    try:
+        if text.startswith('0x'):
+            return int(text[2:], 16)
+        if text.startswith('0b'):
+            return int(text[2:], 2)
+        if len(text) > 1 and text[0] == '0':
+            return int(text[1:], 8)
+        return int(text)
+    except ValueError:
+        raise Exception(f"Invalid integer {tok} in #if")
+
+
+def _parse_literal(tok):
+    """
+    The value of an integer or character literal, and whether it is
+    unsigned: it has a u suffix, or it is a hexadecimal, octal, or binary
+    literal which only fits unsigned
+    """
+    val = parse_int(tok)
+    if tok[-1] == "'":
+        return _wrap(val, False)
+    suffix = tok.lower().lstrip('0123456789abcdefx\'')
+    base = tok[:2].lower()
+    unsigned = 'u' in suffix or (val > _INT_MAX and (
+        base in ('0x', '0b') or tok[0] == '0'))
+    return _wrap(val, unsigned)
+
+
+def _parse_char(tok):
+    body = tok[tok.index("'") + 1:-1]
+    if len(body) == 1:
+        return ord(body)
+    if len(body) == 2 and body[0] == '\\' and body[1] in _CHAR_ESCAPES:
+        return _CHAR_ESCAPES[body[1]]
+    if body[:2] == '\\x':
+        return int(body[2:], 16)
+    if body[:1] == '\\' and body[1:].isdigit():
+        return int(body[1:], 8)
+    raise Exception(f"Invalid character {tok} in #if")
+
+
+class CppExprParser:
+    def __init__(self, toks):
+        """
+        :param toks: the tokens of the expression, without whitespace
+        """
+        self.toks = toks
+        self.i = 0
+        # The depth of operands which are not evaluated
+        self.skip = 0
+
+    def parse(self):
+        """
+        :return: the value of the expression, and whether it is unsigned
+        """
+        val = self._parse_conditional()
+        if self.i < len(self.toks):
+            raise Exception(f"Unexpected {self.toks[self.i]} in #if")
+        return val
+
+    def _peek(self):
+        return self.toks[self.i] if self.i < len(self.toks) else None
+
+    def _next(self):
+        tok = self._peek()
+        if tok is None:
+            raise Exception("Unexpected end of #if expression")
+        self.i += 1
+        return tok
+
+    def _expect(self, tok):
+        if self._next() != tok:
+            raise Exception(f"Expected {tok} in #if")
+
+    def _parse_conditional(self):
+        cond = self._parse_binary(0)
+        if self._peek() != '?':
+            return cond
+        self.i += 1
+        yes = self._parse_skipped(self._parse_conditional, not cond[0])
+        self._expect(':')
+        no = self._parse_skipped(self._parse_conditional, cond[0])
+        # The result has the type of both operands
+        return _wrap((yes if cond[0] else no)[0], yes[1] or no[1])
+
+    def _parse_skipped(self, parse, skip, *args):
+        """
+        Parse an operand, which is not evaluated if skip
+        """
+        if not skip:
+            return parse(*args)
+        self.skip += 1
+        try:
+            return parse(*args)
+        finally:
+            self.skip -= 1
+
+    def _parse_binary(self, level):
+        """
+        Precedence climbing over BINARY_OPS, from level up
+        """
+        lhs = self._parse_unary()
+        while True:
+            op = self._peek()
+            op_level = _PRECEDENCE.get(op)
+            if op_level is None or op_level < level:
+                return lhs
+            self.i += 1
+            skip = (op == '&&' and not lhs[0]) or (op == '||' and lhs[0])
+            rhs = self._parse_skipped(self._parse_binary, skip, op_level + 1)
+            lhs = self._apply(op, lhs, rhs)
+
+    def _apply(self, op, lhs, rhs):
+        """
+        :param lhs: the value of the left operand, and whether it is
+        unsigned
+        :param rhs: the value of the right operand, and whether it is
+        unsigned
+        :return: the value of the result, and whether it is unsigned
+        """
+        if op == '||':
+            return int(bool(lhs[0]) or bool(rhs[0])), False
+        if op == '&&':
+            return int(bool(lhs[0]) and bool(rhs[0])), False
+        if op in ('<<', '>>'):
+            # The result has the type of the left operand
+            unsigned = lhs[1]
+            count = rhs[0]
+            if count < 0:
+                if self.skip:
+                    return 0, unsigned
+                raise Exception("Negative shift in #if")
+            if op == '>>':
+                return _wrap(lhs[0] >> min(count, INT_BITS), unsigned)
+            return _wrap(lhs[0] << min(count, INT_BITS), unsigned)
+        # The usual arithmetic conversions
+        unsigned = lhs[1] or rhs[1]
+        lhs = _wrap(lhs[0], unsigned)[0]
+        rhs = _wrap(rhs[0], unsigned)[0]
+        if op in ('/', '%'):
+            if rhs == 0:
+                if self.skip:
+                    return 0, unsigned
+                raise Exception("Division by zero in #if")
+            # C truncates toward zero
+            quot = abs(lhs) // abs(rhs)
+            if (lhs < 0) != (rhs < 0):
+                quot = -quot
+            return _wrap(quot if op == '/' else lhs - quot * rhs, unsigned)
+        if op in _COMPARISONS:
+            return int(_OPS[op](lhs, rhs)), False
+        return _wrap(_OPS[op](lhs, rhs), unsigned)
+
+    def _parse_unary(self):
+        tok = self._next()
+        if tok == '(':
+            val = self._parse_conditional()
+            self._expect(')')
+            return val
+        if tok == '!':
+            return int(not self._parse_unary()[0]), False
+        if tok == '~':
+            val, unsigned = self._parse_unary()
+            return _wrap(~val, unsigned)
+        if tok == '-':
+            val, unsigned = self._parse_unary()
+            return _wrap(-val, unsigned)
+        if tok == '+':
+            return self._parse_unary()
+        if tok[0].isdigit() or tok[-1] == "'":
+            return _parse_literal(tok)
+        if tok == 'true':
+            return 1, False
+        if is_ident(tok):
+            # Including false
+            return 0, False
+        raise Exception(f"Unexpected {tok} in #if")
@@ -0,0 +1,148 @@
+"""
+The includes between the files of a CppParseState
+
+A header is first parsed with the macros given to the parser, and its parse
+tree is shared through the parse_trees of the state. Each includer applies
+the macros the header defines and undefines (its exports) to its own macro
+table. The parse also records the macros the conditionals and the text of
+the header looked up before defining them (its imports, see
+CppParse.get_imports()). An includer which defines an import differently,
+e.g., the USE_A of an #ifdef USE_A, or the X of an X-macro table, gets a
+variant of the header parsed with its own macros instead. The variants are
+kept in the variants of the state, and shared by includers whose imports
+match.
+
+The include guard (#ifndef X / #define X / ... / #endif) or #pragma once of
+each header is found when it is first parsed. Later includes of the header
+by a text which already defines its guard, or already included it, are
+skipped before its parse tree is looked up, so an evicted header isn't read
+from disk again.
+"""
+
+import os
+
+
+class CppIncludeGraph:
+    def __init__(self):
+        # The includes of each file: a list of (name, path of the header or
+        # None if it was not found)
+        self.includes = {}
+        # The path each include resolved to, by (name, directories)
+        self.resolved = {}
+        # The guard macro of each guarded header, or None for #pragma once
+        self.guards = {}
+        # The number of headers parsed for an include, and of includes which
+        # reused a header which was parsed already
+        self.parses = 0
+        self.reuses = 0
+        # The number of includes skipped by a guard
+        self.skips = 0
+
+    def resolve(self, name, quoted, includer, include_dirs):
+        """
+        Find the header of an include
+
+        :param name: the name between the quotes or angle brackets
+        :param quoted: whether the include is "name" rather than <name>. A
+        quoted include is looked for next to the includer first. An
+        absolute name is only looked for as is.
+        :param includer: the path of the including file, or None
+        :param include_dirs: the directories to search
+        :return: the real path of the header (see os.path.realpath), so that
+        the same header has one path however it was found, or None if it
+        was not found
+        """
+        dirs = tuple(include_dirs)
+        if os.path.isabs(name):
+            dirs = ('',)
+        elif quoted and includer is not None:
+            dirs = (os.path.dirname(includer),) + dirs
+        key = (name, dirs)
+        if key not in self.resolved:
+            path = None
+            for include_dir in dirs:
+                candidate = os.path.join(include_dir, name)
+                if os.path.isfile(candidate):
+                    path = os.path.realpath(candidate)
+                    break
+            self.resolved[key] = path
+        return self.resolved[key]
+
+    def add(self, includer, name, path):
+        self.includes.setdefault(includer, []).append((name, path))
+
+    def forget(self, includer):
+        """
+        Drop the includes and the guard of a file before it is parsed again
+        """
+        self.includes.pop(includer, None)
+        self.guards.pop(includer, None)
+
+    def set_guard(self, path, guard):
+        """
+        :param guard: the guard macro of the header, or None if it has
+        #pragma once
+        """
+        self.guards[path] = guard
+
+    def is_skipped(self, path, macros, included):
+        """
+        Whether an include of a header is skipped by its guard
+
+        :param macros: the macro table of the including text
+        :param included: the headers the text included already
+        """
+        if path not in self.guards:
+            return False
+        guard = self.guards[path]
+        if guard is None:
+            return path in included
+        return guard in macros
+
+    def get_includes(self, path):
+        """
+        The headers a file includes directly, in order
+        """
+        return [header for _, header in self.includes.get(path, [])
+                if header is not None]
+
+    def get_unresolved(self, path):
+        """
+        The names of the includes of a file whose header was not found
+        """
+        return [name for name, header in self.includes.get(path, [])
+                if header is None]
+
+    def get_includers(self, path):
+        """
+        The files which include a header directly
+        """
+        return [includer for includer in self.includes
+                if path in self.get_includes(includer)]
+
+    def get_closure(self, path):
+        """
+        Every header a file includes, directly or not, in the order they
+        are first reached
+        """
+        seen = {}
+        stack = list(reversed(self.get_includes(path)))
+        while len(stack):
+            header = stack.pop()
+            if header in seen or header == path:
+                continue
+            seen[header] = True
+            stack += reversed(self.get_includes(header))
+        return list(seen)
+
+    def get_stats(self):
+        return {
+            'files': len(self.includes),
+            'headers': len({header for includes in self.includes.values()
+                            for _, header in includes
+                            if header is not None}),
+            'guarded': len(self.guards),
+            'parses': self.parses,
+            'reuses': self.reuses,
+            'skips': self.skips,
+        }
@@ -0,0 +1,43 @@
+"""
+An index of the nodes of a parse tree by node type
+
+The index is built by a single walk over the tree. Lookups by type are then
+a dict access instead of a walk per query.
+"""
+
+
+class CppParseIndex:
+    def __init__(self, root_node):
+        self.root_node = root_node
+        self.nodes = {}
+        self.build()
+
+    def build(self):
+        """
+        Index every node below the root node, in text order
+        """
+        nodes = {}
+        for node in self.root_node.iter_preorder():
+            node_type = node.node_type
+            if node_type in nodes:
+                nodes[node_type].append(node)
+            else:
+                nodes[node_type] = [node]
+        self.nodes = nodes
+        return self
+
+    def find_all(self, node_type):
+        """
+        Find all nodes of a type
+
+        :param node_type: the CppParseNodeType to look for
+        :return: the nodes of this type in text order. The list belongs to
+        the index and must not be modified.
+        """
+        return self.nodes.get(node_type, [])
+
+    def count(self, node_type):
+        return len(self.nodes.get(node_type, []))
+
+    def __contains__(self, node_type):
+        return node_type in self.nodes
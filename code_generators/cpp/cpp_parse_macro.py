@@ -0,0 +1,490 @@
+"""
+The macro table of the preprocessor and its expansion (see CppParse3)
+
+Macros are expanded on preprocessing tokens, which are strings. A run of
+whitespace, comments, or line continuations is a single ' ' token, which
+only matters for # (stringizing) and for telling a function-like #define
+from an object-like one.
+
+Expanding a macro substitutes its arguments into its body, pastes the tokens
+around ##, and rescans the result with the macro disabled. A macro name met
+while it is disabled is painted (see CppPaintedToken), and is never expanded
+afterwards. When the rescan ends in an invocation of a function-like macro
+whose arguments aren't complete (e.g., F expands to G, and F(2) to G(2)),
+the tokens after the invocation of the macro complete it. The result is
+memoized by the macro name and the argument tokens, so a macro used many
+times with the same arguments (e.g., the rows of an X-macro table) is only
+substituted once. Each memoized expansion remembers every identifier it
+looked up. Redefining or undefining a macro drops the expansions which
+looked it up, whether it was defined at the time or not.
+"""
+
+import contextlib
+import re
+
+_PP_TOKEN = re.compile(r"""
+    (?P<ws>(?:[ \t\f\v\r\n]|\\\r?\n|/\*.*?\*/|//[^\n]*)+)
+  | (?P<string>(?:u8|[uUL])?"(?:\\.|[^"\\\n])*")
+  | (?P<char>(?:u8|[uUL])?'(?:\\.|[^'\\\n])*')
+  | (?P<ident>[A-Za-z_]\w*)
+  | (?P<number>\.?\d(?:[eEpP][+-]|[\w.'])*)
+  | (?P<punct>\.\.\.|\#\#|<<=|>>=|->\*?|\+\+|--|<<|>>|&&|\|\||::
+        |[-+*/%&|^!=<>]=?|[()\[\]{},;?:~.\#])
+  | (?P<other>\S)
+""", re.S | re.X)
+
+
+def lex(text):
+    """
+    Split text into preprocessing tokens
+
+    :return: a list of tokens, with ' ' for each run of whitespace
+    """
+    toks = []
+    for m in _PP_TOKEN.finditer(text):
+        if m.lastgroup == 'ws':
+            if len(toks) and toks[-1] != ' ':
+                toks.append(' ')
+        else:
+            toks.append(m.group())
+    return toks
+
+
+def join_tokens(toks):
+    """
+    The text of a token sequence
+    """
+    return "".join(toks).strip()
+
+
+def is_ident(tok):
+    return tok[0].isalpha() or tok[0] == '_'
+
+
+def _strip(toks):
+    """
+    Drop the whitespace at the ends of a token sequence
+    """
+    start = 0
+    end = len(toks)
+    while start < end and toks[start] == ' ':
+        start += 1
+    while end > start and toks[end - 1] == ' ':
+        end -= 1
+    return tuple(toks[start:end])
+
+
+def _skip_ws(toks, i, step=1):
+    while 0 <= i < len(toks) and toks[i] == ' ':
+        i += step
+    return i
+
+
+def _paint(toks, disabled):
+    return [CppPaintedToken(tok) if tok in disabled else tok for tok in toks]
+
+
+def _args_key(args):
+    """
+    The arguments of an invocation as a key of the memoized expansions.
+    Painted tokens are equal to the same unpainted tokens, so they are
+    marked in the key.
+    """
+    if not any(tok.__class__ is CppPaintedToken
+               for arg in args for tok in arg):
+        return args
+    return tuple(tuple(('painted', tok) if tok.__class__ is CppPaintedToken
+                       else tok for tok in arg) for arg in args)
+
+
+def _stringize(toks):
+    text = []
+    for tok in toks:
+        if tok[-1] in '"\'':
+            tok = tok.replace('\\', '\\\\').replace('"', '\\"')
+        text.append(tok)
+    return '"' + "".join(text) + '"'
+
+
+class CppPaintedToken(str):
+    """
+    The name of a macro which was met while the macro was being expanded,
+    which is never expanded (it is "painted blue")
+    """
+    __slots__ = ()
+
+
+class CppMacro:
+    def __init__(self, name, body, params=None, variadic=False):
+        """
+        :param name: the name of the macro
+        :param body: the tokens of the replacement list
+        :param params: the names of the parameters, or None if the macro is
+        object-like
+        :param variadic: whether the macro takes ... as its last parameter
+        """
+        self.name = name
+        self.body = tuple(body)
+        self.params = tuple(params) if params is not None else None
+        self.variadic = variadic
+
+    @staticmethod
+    def from_define(text):
+        """
+        Make a macro from the text of a #define after the directive, e.g.,
+        " F(a, b) ((a) + (b))"
+        """
+        toks = _strip(lex(text))
+        if not len(toks) or not is_ident(toks[0]):
+            raise Exception(f"Invalid macro name in #define{text}")
+        name = toks[0]
+        # A ( right after the name begins the parameters
+        if len(toks) < 2 or toks[1] != '(':
+            return CppMacro(name, _strip(toks[1:]))
+        params = []
+        variadic = False
+        i = _skip_ws(toks, 2)
+        while i < len(toks) and toks[i] != ')':
+            if toks[i] == '...':
+                variadic = True
+            elif is_ident(toks[i]):
+                params.append(toks[i])
+            else:
+                raise Exception(f"Invalid parameter {toks[i]} of {name}")
+            i = _skip_ws(toks, i + 1)
+            if i < len(toks) and toks[i] == ',' and not variadic:
+                i = _skip_ws(toks, i + 1)
+            elif i < len(toks) and toks[i] != ')':
+                raise Exception(f"Invalid parameter {toks[i]} of {name}")
+        if i >= len(toks):
+            raise Exception(f"Missing ) in the parameters of {name}")
+        return CppMacro(name, _strip(toks[i + 1:]), params, variadic)
+
+    @staticmethod
+    def from_value(name, val):
+        """
+        Make a macro defined outside of the text (e.g., by -DNAME=val)
+        """
+        return CppMacro(name, _strip(lex(str(val) if val is not None
+                                         else '')))
+
+    def __eq__(self, other):
+        return isinstance(other, CppMacro) and \
+            self.name == other.name and self.body == other.body and \
+            self.params == other.params and self.variadic == other.variadic
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'body': list(self.body),
+            'params': list(self.params) if self.params is not None else None,
+            'variadic': self.variadic,
+        }
+
+    @staticmethod
+    def from_dict(macro):
+        return CppMacro(macro['name'], macro['body'], macro['params'],
+                        macro['variadic'])
+
+
+class CppMacroTable:
+    def __init__(self, macros=None):
+        """
+        :param macros: a dict of the macros defined before the text, from
+        their name to their value
+        """
+        self.macros = {}
+        # The memoized expansions: (name, args, disabled macros) to the
+        # tokens and the identifiers looked up to make them
+        self.cache = {}
+        # The keys of the memoized expansions which looked up each
+        # identifier
+        self.dependents = {}
+        # The identifiers looked up by each expansion being made
+        self.deps_stack = []
+        self.hits = 0
+        self.misses = 0
+        if macros is not None:
+            for name, val in macros.items():
+                self.define(CppMacro.from_value(name, val))
+
+    def define(self, macro):
+        if self.macros.get(macro.name) == macro:
+            return
+        self.macros[macro.name] = macro
+        self._invalidate(macro.name)
+
+    def undefine(self, name):
+        if self.macros.pop(name, None) is not None:
+            self._invalidate(name)
+
+    def _invalidate(self, name):
+        for key in self.dependents.pop(name, ()):
+            self.cache.pop(key, None)
+
+    def copy(self):
+        """
+        A table with the same macros, and no memoized expansions
+        """
+        table = CppMacroTable()
+        table.macros = dict(self.macros)
+        return table
+
+    def get(self, name):
+        return self.macros.get(name)
+
+    def __contains__(self, name):
+        return name in self.macros
+
+    def __len__(self):
+        return len(self.macros)
+
+    def __iter__(self):
+        return iter(self.macros)
+
+    @contextlib.contextmanager
+    def lookups(self):
+        """
+        Collect the identifiers which the expansions made in the block look
+        up, including those of memoized expansions
+        """
+        names = set()
+        self.deps_stack.append(names)
+        try:
+            yield names
+        finally:
+            self.deps_stack.pop()
+
+    def expand_text(self, text):
+        """
+        :return: the text with every macro expanded
+        """
+        return join_tokens(self.expand(lex(text)))
+
+    def expand(self, toks, disabled=frozenset()):
+        """
+        Expand the macros in a token sequence
+
+        :param toks: a list of tokens (see lex())
+        :param disabled: the macros which are not expanded, since they are
+        being expanded already
+        :return: a list of tokens
+        """
+        return self._expand(toks, disabled)[0]
+
+    def expand_pending(self, toks):
+        """
+        Expand the macros in a token sequence which the text after it may
+        continue
+
+        :return: the list of tokens, and the index in it of an invocation of
+        a function-like macro which the tokens after toks may complete, or
+        None
+        """
+        return self._expand(toks, frozenset())
+
+    def _expand(self, toks, disabled):
+        out = []
+        macros = self.macros
+        deps = self.deps_stack[-1] if len(self.deps_stack) else None
+        i = 0
+        while i < len(toks):
+            tok = toks[i]
+            if deps is not None and is_ident(tok):
+                deps.add(tok)
+            macro = macros.get(tok)
+            if macro is None:
+                out.append(tok)
+                i += 1
+                continue
+            if tok.__class__ is CppPaintedToken or tok in disabled:
+                out.append(CppPaintedToken(tok))
+                i += 1
+                continue
+            if macro.params is None:
+                result, pending = self._expand_macro(macro, None, disabled)
+                i += 1
+            else:
+                # A function-like macro is only invoked by a following (
+                j = _skip_ws(toks, i + 1)
+                args, end = self._collect_args(toks, j)
+                if args is None and end is None:
+                    # The invocation may go on after the tokens
+                    return out + _paint(toks[i:], disabled), len(out)
+                if args is None:
+                    out.append(tok)
+                    i += 1
+                    continue
+                result, pending = self._expand_macro(
+                    macro, self._match_args(macro, args), disabled)
+                i = end
+            if pending is None:
+                out += result
+                continue
+            # The tokens after the invocation complete the one which ends
+            # its expansion
+            out += result[:pending]
+            toks = list(result[pending:]) + list(toks[i:])
+            i = 0
+        return out, None
+
+    @staticmethod
+    def _collect_args(toks, i):
+        """
+        Split the arguments of an invocation at the commas outside of
+        parentheses
+
+        :param i: the index of the (
+        :return: the tuple of the tokens of each argument and the index past
+        the ). If there are no arguments, None and i, or None and None if
+        the tokens end before the arguments do.
+        """
+        if i >= len(toks):
+            return None, None
+        if toks[i] != '(':
+            return None, i
+        args = []
+        arg = []
+        depth = 0
+        for j in range(i + 1, len(toks)):
+            tok = toks[j]
+            if tok == ')' and depth == 0:
+                args.append(_strip(arg))
+                return tuple(args), j + 1
+            if tok == ',' and depth == 0:
+                args.append(_strip(arg))
+                arg = []
+                continue
+            if tok == '(':
+                depth += 1
+            elif tok == ')':
+                depth -= 1
+            arg.append(tok)
+        return None, None
+
+    @staticmethod
+    def _match_args(macro, args):
+        """
+        Check the number of arguments. The variadic arguments become one
+        argument, commas included.
+        """
+        count = len(macro.params)
+        if count == 0 and args == ((),):
+            args = ()
+        if macro.variadic:
+            if len(args) < count:
+                raise Exception(f"Macro {macro.name} takes at least "
+                                f"{count} arguments")
+            rest = []
+            for arg in args[count:]:
+                if len(rest):
+                    rest.append(',')
+                rest += arg
+            return args[:count] + (tuple(rest),)
+        if len(args) != count:
+            raise Exception(f"Macro {macro.name} takes {count} arguments, "
+                            f"not {len(args)}")
+        return args
+
+    def _expand_macro(self, macro, args, disabled):
+        """
+        The memoized expansion of one invocation of a macro
+
+        :return: the tokens, and the index of an invocation in them which
+        the tokens after the invocation of the macro may complete, or None
+        """
+        key = (macro.name, _args_key(args) if args is not None else None,
+               disabled)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.hits += 1
+            toks, pending, deps = entry
+        else:
+            self.misses += 1
+            deps = {macro.name}
+            self.deps_stack.append(deps)
+            try:
+                toks = self._substitute(macro, args, disabled)
+                toks, pending = self._expand(toks, disabled | {macro.name})
+                toks = tuple(toks)
+            finally:
+                self.deps_stack.pop()
+            self.cache[key] = (toks, pending, deps)
+            for name in deps:
+                self.dependents.setdefault(name, set()).add(key)
+        if len(self.deps_stack):
+            self.deps_stack[-1].update(deps)
+        return toks, pending
+
+    def _substitute(self, macro, args, disabled):
+        """
+        Replace the parameters in the body of a macro with the arguments,
+        and paste the tokens around ##
+        """
+        body = macro.body
+        if args is None:
+            if '##' not in body:
+                return list(body)
+            params = {}
+        else:
+            params = dict(zip(macro.params, args))
+            if macro.variadic:
+                params['__VA_ARGS__'] = args[-1]
+        out = []
+        i = 0
+        while i < len(body):
+            tok = body[i]
+            if tok == '#' and len(params):
+                j = _skip_ws(body, i + 1)
+                if j < len(body) and body[j] in params:
+                    out.append(_stringize(params[body[j]]))
+                    i = j + 1
+                    continue
+            if tok in params:
+                arg = params[tok]
+                prev = _skip_ws(body, i - 1, -1)
+                next = _skip_ws(body, i + 1)
+                if (prev >= 0 and body[prev] == '##') or \
+                        (next < len(body) and body[next] == '##'):
+                    # Arguments of ## are pasted as written
+                    out += arg
+                else:
+                    out += self.expand(list(arg), disabled)
+                i += 1
+                continue
+            out.append(tok)
+            i += 1
+        if '##' in body:
+            out = self._paste(out)
+        return out
+
+    @staticmethod
+    def _paste(toks):
+        out = []
+        i = 0
+        while i < len(toks):
+            tok = toks[i]
+            if tok != '##':
+                out.append(tok)
+                i += 1
+                continue
+            while len(out) and out[-1] == ' ':
+                out.pop()
+            j = _skip_ws(toks, i + 1)
+            if j < len(toks):
+                if len(out):
+                    out[-1] += toks[j]
+                else:
+                    out.append(toks[j])
+            i = j + 1
+        return out
+
+    def to_dict(self):
+        return {name: macro.to_dict() for name, macro in self.macros.items()}
+
+    @staticmethod
+    def from_dict(macros):
+        table = CppMacroTable()
+        for name, macro in macros.items():
+            table.macros[name] = CppMacro.from_dict(macro)
+        return table
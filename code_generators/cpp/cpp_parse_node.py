@@ -33,6 +33,7 @@ class CppParseNodeType(Enum):
     SEMICOLON = "SEMICOLON"
 
     # Phase 2 parsing (basic structuring)
+    NS_SEP = "NS_SEP"
     PARENTHESIS = "PARENTHISIS"
     BRACKETS = "BRACKETS"
     BRACES = "BRACES"
@@ -47,6 +48,7 @@ class CppParseNodeType(Enum):
     MACRO_IF = "MACRO_IF"
     MACRO_IFDEF = "MACRO_IF"
     MACRO_IFNDEF = "MACRO_IF"
+    MACRO_INACTIVE = "MACRO_INACTIVE"
 
     # Phase 4 parsing (type/class/namespace declarations)
     CLASS_DEFN = "CLASS_DEFN"
@@ -73,15 +75,58 @@ class CppParseNodeType(Enum):
 
 
 class CppParseNode:
+    # Nodes are allocated per-token, so their fields are slotted. The
+    # properties CppParse5 attaches to functions, classes, and namespaces,
+    # and the expansion CppParse3 attaches to uses of macros (PROP_SLOTS),
+    # are only set on those nodes.
+    #
+    # The children are stored as a gap buffer so that phases which scan the
+    # children and replace_children() at their cursor cost O(1) per edit
+    # instead of O(n). children_ holds the children before the gap and gap_
+    # holds the children after the gap in reverse order (or is None when
+    # there is no gap). get_children() closes the gap.
+    #
+    # A node may span src_[start:end] of the text it was lexed from. Its val
+    # is then sliced from the source on first use and cached. Assigning val
+    # drops the span (end becomes None), since the node no longer matches
+    # the source.
+    PROP_SLOTS = ('name', 'type', 'specifiers', 'docstring', 'expansion')
+    __slots__ = ('children_', 'gap_', 'parent', 'node_type', 'val_', 'start',
+                 'end', 'src_', 'hidden') + PROP_SLOTS
+
     def __init__(self, node_type=CppParseNodeType.ROOT, val=None,
-                 start=None, parent=None, hidden=False):
+                 start=None, parent=None, hidden=False, end=None, src=None):
         self.children_ = []
+        self.gap_ = None
         self.parent = parent
         self.node_type = node_type
-        self.val = val
+        self.val_ = val
         self.start = start
+        self.end = end
+        self.src_ = src
         self.hidden = hidden
 
+    @property
+    def val(self):
+        val = self.val_
+        if val is None and self.end is not None:
+            val = self.src_[self.start:self.end]
+            if not isinstance(val, str):
+                val = str(val, 'utf-8')
+            self.val_ = val
+        return val
+
+    @val.setter
+    def val(self, val):
+        self.val_ = val
+        self.end = None
+
+    def has_span(self):
+        """
+        Whether the text of this node is still src_[start:end]
+        """
+        return self.end is not None
+
     def is_one_of(self, *types):
         for t in types:
             if self.node_type == t:
@@ -89,41 +134,89 @@ class CppParseNode:
         return False
 
     def make_group_child(self, node_type, hidden=False):
-        self.children_.append(CppParseNode(
+        self.get_children().append(CppParseNode(
             node_type, None, None, self, hidden))
 
     def make_tok_child(self, node_type, val,
                       start, hidden=False):
-        self.children_.append(CppParseNode(
+        self.get_children().append(CppParseNode(
             node_type, val, start, self, hidden))
 
-    def add_child_node(self, node, hidden=None):
-        node = node.shallow_copy()
+    def make_span_child(self, node_type, src, start, end, hidden=False):
+        self.get_children().append(CppParseNode(
+            node_type, None, start, self, hidden, end, src))
+
+    def add_child_node(self, node, hidden=None, copy=False):
+        """
+        Append a node to the children of this node. The node is reparented
+        in place: the caller is responsible for removing it from the children
+        of its old parent (e.g., with replace_children).
+
+        :param node: the node to append
+        :param hidden: if not None, the new hidden flag of the node
+        :param copy: append a shallow copy of the node instead
+        :return: the appended node
+        """
+        if copy:
+            node = node.shallow_copy()
         if hidden is not None:
             node.hidden = hidden
         node.parent = self
-        self.children_.append(node)
+        self.get_children().append(node)
+        return node
 
-    def add_child_nodes(self, root_node, start, end):
+    def add_child_nodes(self, root_node, start, end, copy=False):
         """
         Add nodes from start to (including) end
         """
-        for node in root_node.get_children()[start:end+1]:
-            self.add_child_node(node)
+        end = min(end, root_node.size() - 1)
+        for i in range(start, end + 1):
+            self.add_child_node(root_node[i], copy=copy)
 
     def replace_children(self, node, start, end):
         """
-        Remove nodes from start to (including) end
+        Remove nodes from start to (including) end and put node in their
+        place. This moves the gap to start, so it costs O(distance from the
+        previous edit) rather than O(number of children).
         """
-        self.children_ = self.children_[0:start] + [node] + \
-                         self.children_[end+1:]
+        self._move_gap(start)
+        gap = self.gap_
+        count = end - start + 1
+        if count > 0:
+            del gap[max(0, len(gap) - count):]
+        self.children_.append(node)
 
+    def _move_gap(self, i):
+        """
+        Move the gap so that exactly i children come before it
+        """
+        left = self.children_
+        right = self.gap_
+        if right is None:
+            right = self.gap_ = []
+        if i < len(left):
+            moved = left[i:]
+            del left[i:]
+            moved.reverse()
+            right.extend(moved)
+        elif i > len(left):
+            count = min(i - len(left), len(right))
+            moved = right[len(right) - count:]
+            del right[len(right) - count:]
+            moved.reverse()
+            left.extend(moved)
+
+    def _close_gap(self):
+        gap = self.gap_
+        self.gap_ = None
+        gap.reverse()
+        self.children_.extend(gap)
 
     def next_child(self, i, count=1):
         i += count
-        if i >= len(self.children_):
+        if i >= self.size():
             return None
-        return self.children_[i]
+        return self[i]
 
     def last_child(self, off=0):
         """
@@ -132,10 +225,10 @@ class CppParseNode:
         :param off: The offset from the last child
         :return: The child node
         """
-        i = len(self.children_) - 1
+        i = self.size() - 1
         i -= off
         while i > 0:
-            node = self.children_[i]
+            node = self[i]
             if not node.hidden:
                 return node
             i -= 1
@@ -147,56 +240,153 @@ class CppParseNode:
 
         :return: the merged string
         """
-        if len(self.children_) == 0:
+        children = self.get_children()
+        if len(children) == 0:
             val = self.val
             if val is None:
                 val = ""
-        elif ignore_hidden:
-            val = "".join([x.join(ignore_hidden, inplace=False)
-                           for x in self.children_ if not x.hidden])
         else:
-            val = "".join([x.join(ignore_hidden, inplace=False)
-                           for x in self.children_])
+            vals = []
+            stack = [iter(children)]
+            while stack:
+                for node in stack[-1]:
+                    if ignore_hidden and node.hidden:
+                        continue
+                    if node.size():
+                        stack.append(iter(node.get_children()))
+                        break
+                    if node.val is not None:
+                        vals.append(node.val)
+                else:
+                    stack.pop()
+            val = "".join(vals)
         if inplace:
             self.val = val
-        if destroy_children and len(self.children_):
-            self.start = self.children_[0].start
+        if destroy_children and len(children):
+            self.start = children[0].start
             self.children_ = []
         return val
 
     def linearize(self, nodelist=None):
         """
         Convert the node into an array. Ignores nodes which do not represent
-        some sort of text object.
+        some sort of text object, i.e., nodes with children or no start.
 
         :return:
         """
         if nodelist is None:
             nodelist = []
-        for node in self.children_:
-            node.linearize(nodelist)
-            if node.start is not None:
-                nodelist.append(node)
+        stack = [iter(self.get_children())]
+        while stack:
+            for node in stack[-1]:
+                if node.size():
+                    stack.append(iter(node.get_children()))
+                    break
+                if node.start is not None:
+                    nodelist.append(node)
+            else:
+                stack.pop()
         return nodelist
 
+    def iter_preorder(self, include_self=False):
+        """
+        Iterate over the nodes below this node, parents before their
+        children. Uses an explicit stack, so the depth of the tree is not
+        bounded by the recursion limit.
+
+        :param include_self: whether to begin with this node
+        """
+        if include_self:
+            yield self
+        stack = [iter(self.get_children())]
+        while stack:
+            for node in stack[-1]:
+                yield node
+                if node.size():
+                    stack.append(iter(node.get_children()))
+                    break
+            else:
+                stack.pop()
+
+    def iter_postorder(self, include_self=False):
+        """
+        Iterate over the nodes below this node, children before their
+        parents. Uses an explicit stack.
+
+        :param include_self: whether to end with this node
+        """
+        stack = [(self, iter(self.get_children()))]
+        while stack:
+            for node in stack[-1][1]:
+                if node.size():
+                    stack.append((node, iter(node.get_children())))
+                    break
+                yield node
+            else:
+                node = stack.pop()[0]
+                if len(stack) or include_self:
+                    yield node
+
     def copy_children(self):
-        return self.children_.copy()
+        return self.get_children().copy()
 
     def set_children(self, children):
         self.children_ = children
+        self.gap_ = None
 
     def size(self):
-        return len(self.get_children())
+        if self.gap_ is None:
+            return len(self.children_)
+        return len(self.children_) + len(self.gap_)
 
     def get_children(self):
+        if self.gap_ is not None:
+            self._close_gap()
         return self.children_
 
     def shallow_copy(self):
-        new_node = CppParseNode(self.node_type, self.val,
-                                self.start, self.parent, self.hidden)
-        new_node.children_ = self.children_
+        """
+        Copy this node. The copy shares its list of children with this node.
+        """
+        new_node = CppParseNode(self.node_type, self.val_,
+                                self.start, self.parent, self.hidden,
+                                self.end, self.src_)
+        new_node.children_ = self.get_children()
+        self._copy_props(new_node)
+        return new_node
+
+    def deep_copy(self, parent=None):
+        """
+        Copy this node and all of its children.
+
+        :param parent: the parent of the copy
+        """
+        new_root = self._copy_one(parent)
+        stack = [(new_root, iter(self.get_children()))]
+        while stack:
+            new_parent, children = stack[-1]
+            for node in children:
+                new_node = node._copy_one(new_parent)
+                new_parent.children_.append(new_node)
+                if node.size():
+                    stack.append((new_node, iter(node.get_children())))
+                    break
+            else:
+                stack.pop()
+        return new_root
+
+    def _copy_one(self, parent):
+        new_node = CppParseNode(self.node_type, self.val_,
+                                self.start, parent, self.hidden,
+                                self.end, self.src_)
+        self._copy_props(new_node)
         return new_node
 
+    def _copy_props(self, new_node):
+        for prop in self.PROP_SLOTS:
+            if hasattr(self, prop):
+                setattr(new_node, prop, getattr(self, prop))
+
     def __str__(self):
         if self.val is not None:
             return self.val
@@ -210,12 +400,29 @@ class CppParseNode:
             return ''
 
     def __getitem__(self, i):
-        return self.children_[i]
+        gap = self.gap_
+        if gap is None or isinstance(i, slice):
+            return self.get_children()[i]
+        left = self.children_
+        if i < 0:
+            i += len(left) + len(gap)
+            if i < 0:
+                raise IndexError("child index out of range")
+        if i < len(left):
+            return left[i]
+        return gap[len(left) - i - 1]
 
     def print(self, depth=0):
-        for child in self.children_:
-            if child.val is not None:
-                print(f"{' ' * depth}{child.node_type}: {child.val}")
+        stack = [iter(self.get_children())]
+        while stack:
+            indent = ' ' * (depth + 2 * (len(stack) - 1))
+            for child in stack[-1]:
+                if child.val is not None:
+                    print(f"{indent}{child.node_type}: {child.val}")
+                else:
+                    print(f"{indent}{child.node_type}:")
+                if child.size():
+                    stack.append(iter(child.get_children()))
+                    break
             else:
-                print(f"{' ' * depth}{child.node_type}:")
-            child.print(depth + 2)
\ No newline at end of file
+                stack.pop()
\ No newline at end of file
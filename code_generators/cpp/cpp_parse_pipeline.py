@@ -0,0 +1,146 @@
+"""
+Parse several files as a pipeline of stages
+
+    read:  a reader thread reads (and decodes) each file and puts it in a
+           bounded queue
+    parse: the calling thread takes files off the queue and runs the phases
+
+File I/O releases the GIL, so reading the next files overlaps with parsing
+the current one. The queue bounds how far the reader runs ahead, and with it
+the memory held by files which were read but not yet parsed. Each stage
+records how long it was busy, how long it waited on the other stage, and the
+depth of the queue it fed from or into.
+"""
+
+import queue
+import threading
+import time
+
+# The item which tells the parse stage there are no more files
+_DONE = None
+
+
+class CppStageStats:
+    def __init__(self, name):
+        self.name = name
+        # The number of files handled by the stage
+        self.count = 0
+        # The time spent handling files
+        self.busy_time = 0
+        # The time spent waiting on the queue (the read stage waits on a
+        # full queue, the parse stage waits on an empty one)
+        self.wait_time = 0
+        # The depth of the queue, sampled each time a file is handled
+        self.max_depth = 0
+        self.depth_sum = 0
+
+    def sample_depth(self, depth):
+        self.max_depth = max(self.max_depth, depth)
+        self.depth_sum += depth
+
+    def mean_depth(self):
+        if self.count == 0:
+            return 0
+        return self.depth_sum / self.count
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'count': self.count,
+            'busy_time': self.busy_time,
+            'wait_time': self.wait_time,
+            'max_depth': self.max_depth,
+            'mean_depth': self.mean_depth(),
+        }
+
+
+class CppParsePipeline:
+    def __init__(self, parser, paths, prefetch=8):
+        """
+        :param parser: the CppParse whose configuration and state the files
+        are parsed with
+        :param paths: the files to parse
+        :param prefetch: the number of files the reader may read ahead
+        """
+        self.parser = parser
+        self.paths = paths
+        self.queue = queue.Queue(maxsize=max(1, prefetch))
+        self.read_stats = CppStageStats('read')
+        self.parse_stats = CppStageStats('parse')
+        self.stats = [self.read_stats, self.parse_stats]
+        self.stop = threading.Event()
+
+    def run(self):
+        """
+        Parse every file into the state of the parser
+
+        :return: self
+        """
+        reader = threading.Thread(target=self._read, daemon=True)
+        reader.start()
+        try:
+            self._parse()
+        finally:
+            self.stop.set()
+            reader.join()
+        return self
+
+    def _read(self):
+        stats = self.read_stats
+        decode = self.parser.cache is None
+        for path in self.paths:
+            if self.stop.is_set():
+                return
+            t0 = time.perf_counter()
+            try:
+                data = self.parser._read_path(path)
+                text = self.parser._decode(data) if decode else None
+                item = (path, data, text, None)
+            except Exception as e:
+                item = (path, None, None, e)
+            t1 = time.perf_counter()
+            stats.busy_time += t1 - t0
+            stats.count += 1
+            stats.sample_depth(self.queue.qsize())
+            if not self._put(item):
+                return
+            stats.wait_time += time.perf_counter() - t1
+        self._put(_DONE)
+
+    def _put(self, item):
+        """
+        Put an item in the queue, giving up if the parse stage stopped
+
+        :return: whether the item was put
+        """
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _parse(self):
+        stats = self.parse_stats
+        state = self.parser.state
+        while True:
+            depth = self.queue.qsize()
+            t0 = time.perf_counter()
+            item = self.queue.get()
+            t1 = time.perf_counter()
+            stats.wait_time += t1 - t0
+            if item is _DONE:
+                return
+            stats.sample_depth(depth)
+            path, data, text, e = item
+            if e is not None:
+                raise e
+            if path in state.parse_trees:
+                # A header which an earlier file included
+                continue
+            child = self.parser._make_parser(path)
+            state.parse_trees[path] = child
+            child._preprocess_data(data, text)
+            stats.busy_time += time.perf_counter() - t1
+            stats.count += 1
@@ -0,0 +1,202 @@
+"""
+Per-phase statistics of the parse of each file (see CppParse(profile=True))
+
+Each phase records its wall and CPU time, the change in the number of
+allocated memory blocks, and with profile_memory, the bytes allocated and
+the peak memory while it ran (from tracemalloc, which slows the parse
+down). tracemalloc is only started while such a phase runs, unless it was
+already tracing. Phases which run more than once, e.g., when a parse tree
+is restored or edited, add up.
+"""
+
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+# The phases in the order they run
+PHASES = ['read', 'decode', 'cache_get', 'lex', 'label', 'group', 'rewrite',
+          'cache_put', 'edit']
+
+
+class CppParseProfile:
+    def __init__(self, path=None, memory=False):
+        """
+        :param path: the path of the file
+        :param memory: whether to trace the memory of each phase
+        """
+        self.path = path
+        self.memory = memory
+        # The totals of each phase which ran
+        self.phases = {}
+        # The number of tokens lexed and of nodes in the final parse tree
+        self.tokens = 0
+        self.nodes = 0
+        self.cache = None
+
+    def phase(self, name):
+        """
+        A context manager which times one run of a phase
+        """
+        return _CppPhaseTimer(self, name)
+
+    def add(self, name, wall, cpu, blocks, alloc=None, peak=None):
+        totals = self.phases.get(name)
+        if totals is None:
+            totals = {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'blocks': 0}
+            if alloc is not None:
+                totals.update(alloc=0, peak=0)
+            self.phases[name] = totals
+        totals['calls'] += 1
+        totals['wall'] += wall
+        totals['cpu'] += cpu
+        totals['blocks'] += blocks
+        if alloc is not None:
+            totals['alloc'] += alloc
+            totals['peak'] = max(totals['peak'], peak)
+
+    def get_time(self):
+        return sum(totals['wall'] for totals in self.phases.values())
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'cache': self.cache,
+            'tokens': self.tokens,
+            'nodes': self.nodes,
+            'wall': self.get_time(),
+            'phases': {name: dict(self.phases[name])
+                       for name in _sort_phases(self.phases)},
+        }
+
+    @staticmethod
+    def from_dict(stats):
+        """
+        Load the statistics converted by to_dict() (e.g., those sent back by
+        a worker process)
+        """
+        profile = CppParseProfile(stats['path'])
+        profile.cache = stats['cache']
+        profile.tokens = stats['tokens']
+        profile.nodes = stats['nodes']
+        profile.phases = {name: dict(totals)
+                          for name, totals in stats['phases'].items()}
+        return profile
+
+
+class _CppPhaseTimer:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        if self.profile.memory:
+            _TRACER.enter(self)
+        self.blocks = sys.getallocatedblocks()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        blocks = sys.getallocatedblocks() - self.blocks
+        alloc = peak = None
+        if self.profile.memory:
+            alloc, peak = _TRACER.exit(self)
+        self.profile.add(self.name, wall, cpu, blocks, alloc, peak)
+
+
+class _CppMemoryTracer:
+    """
+    Traces memory while any phase which profiles it runs. tracemalloc is
+    global to the process, so phases which run inside one another (e.g., the
+    parse of an included header) or on other threads share it. If it isn't
+    tracing when the first of them starts, it is started, and stopped again
+    when the last one ends.
+
+    Each phase resets the peak of tracemalloc when it starts. The peak so
+    far is folded into the phases which are already running first, so an
+    inner phase never hides the peak of the phase around it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # The timers of the phases which are running
+        self.timers = []
+        self.started = False
+
+    def enter(self, timer):
+        with self.lock:
+            if not self.timers and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started = True
+            cur, peak = tracemalloc.get_traced_memory()
+            for other in self.timers:
+                other.peak = max(other.peak, peak)
+            self.timers.append(timer)
+            timer.mem = timer.peak = cur
+            tracemalloc.reset_peak()
+
+    def exit(self, timer):
+        """
+        :return: the bytes allocated and the peak memory since enter()
+        """
+        with self.lock:
+            cur, peak = tracemalloc.get_traced_memory()
+            self.timers.remove(timer)
+            if not self.timers and self.started:
+                tracemalloc.stop()
+                self.started = False
+        return cur - timer.mem, max(timer.peak, peak) - timer.mem
+
+
+_TRACER = _CppMemoryTracer()
+
+
+def _sort_phases(names):
+    return sorted(names, key=lambda name: (
+        PHASES.index(name) if name in PHASES else len(PHASES), name))
+
+
+def make_report(profiles):
+    """
+    Sum up the statistics of a run over many files
+
+    :param profiles: the CppParseProfile of each file
+    :return: a dict which can be saved as JSON, with the statistics of
+    each file ("files") and their totals ("totals")
+    """
+    files = [profile.to_dict() for profile in profiles]
+    phases = {}
+    for stats in files:
+        for name, totals in stats['phases'].items():
+            sums = phases.setdefault(name, dict.fromkeys(totals, 0))
+            for key, val in totals.items():
+                if key == 'peak':
+                    sums[key] = max(sums.get(key, 0), val)
+                else:
+                    sums[key] = sums.get(key, 0) + val
+    return {
+        'files': files,
+        'totals': {
+            'files': len(files),
+            'cache_hits': sum(1 for stats in files
+                              if stats['cache'] == 'hit'),
+            'tokens': sum(stats['tokens'] for stats in files),
+            'nodes': sum(stats['nodes'] for stats in files),
+            'wall': sum(stats['wall'] for stats in files),
+            'phases': {name: phases[name] for name in _sort_phases(phases)},
+        },
+    }
+
+
+def save_report(report, path):
+    """
+    Save a report from make_report() as JSON. "-" prints it.
+    """
+    if path == '-':
+        print(json.dumps(report, indent=2))
+        return
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2)
@@ -0,0 +1,210 @@
+"""
+Find nodes of a parse tree by a selector, e.g.:
+    namespace > class > function[specifier=RPC]
+
+A selector is a list of steps. Each step names a node type and may filter
+the node by attributes:
+    function                 a node of a type (see STEP_TYPES)
+    *                        a node of any type
+    function[name=hello]     a node whose attribute equals a value
+    function[specifier=RPC]  a node whose specifiers include a value
+    function[docstring]      a node whose attribute is set
+"a > b" matches a b which is a child of an a. "a b" matches a b which is
+below an a at any depth.
+
+Selectors are compiled once and cached. A compiled query matches a node
+by checking the last step against the node and the other steps against its
+ancestors, so the candidates can come straight from a CppParseIndex.
+"""
+
+import re
+from functools import lru_cache
+from .cpp_parse_node import CppParseNodeType
+
+
+# The node type of each step name. Every CppParseNodeType may also be named
+# in lowercase (e.g., parenthesis).
+STEP_TYPES = {node_type.name.lower(): node_type
+              for node_type in CppParseNodeType}
+STEP_TYPES.update({
+    'namespace': CppParseNodeType.NAMESPACE_DEFN,
+    'class': CppParseNodeType.CLASS_DEFN,
+    'function': CppParseNodeType.FUNCTION_DEF,
+    'template': CppParseNodeType.TEMPLATE_DEFN,
+    'macro': CppParseNodeType.MACRO_DEF,
+})
+
+CHILD = '>'
+DESCENDANT = ' '
+
+_QUERY_TOKENS = re.compile(r"""
+    \s*(?P<child>>)\s*
+  | (?P<descendant>\s+)
+  | (?P<step>\*|[A-Za-z_]\w*)
+  | \[\s*(?P<attr>\w+)\s*
+      (?:=\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<val>[^\]\s]+))\s*)?\]
+""", re.VERBOSE)
+
+
+class CppQueryStep:
+    def __init__(self, node_type, combinator):
+        """
+        :param node_type: the CppParseNodeType of the step or None for any
+        :param combinator: how this step relates to the prior step
+        (CHILD or DESCENDANT)
+        """
+        self.node_type = node_type
+        self.combinator = combinator
+        # (attribute, value) pairs. A value of None only checks that the
+        # attribute is set.
+        self.filters = []
+
+    def matches(self, node):
+        if self.node_type is not None and node.node_type != self.node_type:
+            return False
+        for attr, val in self.filters:
+            if attr == 'specifier':
+                if val not in (getattr(node, 'specifiers', None) or ()):
+                    return False
+                continue
+            node_val = getattr(node, attr, None)
+            if val is None:
+                if node_val is None:
+                    return False
+            elif node_val != val:
+                return False
+        return True
+
+
+class CppQuery:
+    def __init__(self, selector):
+        self.selector = selector
+        self.steps = self._compile(selector)
+        self.node_type = self.steps[-1].node_type
+
+    @staticmethod
+    def _compile(selector):
+        steps = []
+        combinator = DESCENDANT
+        i = 0
+        text = selector.strip()
+        while i < len(text):
+            m = _QUERY_TOKENS.match(text, i)
+            if m is None:
+                raise Exception(f"Invalid query {selector} at offset {i}")
+            i = m.end()
+            if m.group('child') is not None:
+                combinator = CHILD
+            elif m.group('descendant') is not None:
+                if combinator != CHILD:
+                    combinator = DESCENDANT
+            elif m.group('step') is not None:
+                if combinator is None:
+                    raise Exception(f"Missing combinator in query {selector}")
+                name = m.group('step')
+                if name == '*':
+                    node_type = None
+                elif name.lower() in STEP_TYPES:
+                    node_type = STEP_TYPES[name.lower()]
+                else:
+                    raise Exception(f"Unknown node type {name} in query "
+                                    f"{selector}")
+                steps.append(CppQueryStep(node_type, combinator))
+                combinator = None
+            else:
+                if len(steps) == 0 or combinator is not None:
+                    raise Exception(f"Attribute without a node type in "
+                                    f"query {selector}")
+                val = m.group('dq')
+                if val is None:
+                    val = m.group('sq')
+                if val is None:
+                    val = m.group('val')
+                steps[-1].filters.append((m.group('attr'), val))
+        if len(steps) == 0 or combinator is not None:
+            raise Exception(f"Incomplete query {selector}")
+        return steps
+
+    def matches(self, node):
+        """
+        Whether a node is matched by this query
+        """
+        if not self.steps[-1].matches(node):
+            return False
+        return self._match_ancestors(node, len(self.steps) - 1)
+
+    def _match_ancestors(self, node, k):
+        """
+        Check steps[:k] against the ancestors of node, given that node
+        matches steps[k]
+        """
+        if k == 0:
+            return True
+        step = self.steps[k - 1]
+        parent = node.parent
+        if self.steps[k].combinator == CHILD:
+            return parent is not None and step.matches(parent) and \
+                self._match_ancestors(parent, k - 1)
+        while parent is not None:
+            if step.matches(parent) and self._match_ancestors(parent, k - 1):
+                return True
+            parent = parent.parent
+        return False
+
+    def find_all(self, root_node, index=None):
+        """
+        Find all nodes below root_node matched by this query
+
+        :param root_node: the node to search
+        :param index: a CppParseIndex of root_node. If given, only the nodes
+        of the type of the last step are checked instead of walking the tree.
+        :return: the matched nodes in text order
+        """
+        if index is not None and self.node_type is not None:
+            return [node for node in index.find_all(self.node_type)
+                    if self.matches(node)]
+        return [node for node in root_node.iter_preorder()
+                if self.matches(node)]
+
+
+@lru_cache(maxsize=256)
+def compile_query(selector):
+    """
+    Compile a selector into a CppQuery. Compiled queries are cached.
+    """
+    return CppQuery(selector)
+
+
+def find_all_many(root_node, selectors, index=None):
+    """
+    Find the nodes matched by several selectors. Without an index, the tree
+    is walked once for all of them.
+
+    :param root_node: the node to search
+    :param selectors: a list of selectors
+    :param index: a CppParseIndex of root_node
+    :return: a dict mapping each selector to its matched nodes in text order
+    """
+    queries = [compile_query(selector)
+               for selector in dict.fromkeys(selectors)]
+    matches = {selector: [] for selector in selectors}
+    if index is not None:
+        for query in queries:
+            matches[query.selector] = query.find_all(root_node, index)
+        return matches
+    # The queries which may match each node type
+    by_type = {}
+    any_type = []
+    for query in queries:
+        if query.node_type is None:
+            any_type.append(query)
+        else:
+            by_type.setdefault(query.node_type, []).append(query)
+    for node in root_node.iter_preorder():
+        for query in by_type.get(node.node_type, ()):
+            if query.matches(node):
+                matches[query.selector].append(node)
+        for query in any_type:
+            if query.matches(node):
+                matches[query.selector].append(node)
+    return matches
@@ -0,0 +1,283 @@
+"""
+A compact binary format for parse trees
+
+A file holds one or more entries. Each entry is a key (e.g., the path of a
+header) and the main tree and style tree of its parse. Layout:
+    header:   MAGIC, FORMAT_VERSION (u16), reserved (u16), meta length (u32)
+    meta:     JSON with the node type names, keys, sources, and the node
+              properties (name, type, specifiers, docstring)
+    sections: each is a u64 length followed by the bytes
+              1. string table offsets (array 'I')
+              2. string table data (UTF-8)
+              3. the node table as one column per field (see NODE_COLUMNS)
+              4. the text of each source
+
+Nodes are stored in preorder with their number of children, so no parent
+pointers are stored. A node which spans its source is stored as a span
+(source, start, end) instead of as text. A node which only begins in its
+source (e.g., a group) keeps its source too. The text of a source is stored
+once. Sources which were bytes (e.g., an mmap) are loaded as a memoryview
+of the buffer the file was loaded from, so loading from an mmap does not
+copy them.
+"""
+
+import json
+import mmap
+import struct
+import sys
+from array import array
+from .cpp_parse_node import CppParseNode, CppParseNodeType
+
+MAGIC = b'CPPT'
+FORMAT_VERSION = 2
+_HEADER = struct.Struct('<4sHHI')
+_SECTION = struct.Struct('<Q')
+# The value stored for a start, end, source, or string which is None
+NONE = 0xFFFFFFFF
+
+# (name, array typecode) of each column of the node table
+NODE_COLUMNS = [('types', 'B'), ('hidden', 'B'), ('sizes', 'I'),
+                ('starts', 'I'), ('ends', 'I'), ('srcs', 'I'), ('vals', 'I')]
+NODE_TYPES = list(CppParseNodeType)
+
+
+class CppLoadedTree:
+    """
+    The main tree and style tree of a parse, without the phases which
+    produced them
+    """
+    def __init__(self, root_node, style_nodes):
+        self.root_node = root_node
+        self.style_nodes = style_nodes
+
+    def get_root_node(self):
+        return self.root_node
+
+    def get_style_nodes(self):
+        return self.style_nodes
+
+    def add_error(self, node, msg):
+        pass
+
+    def get_errors(self):
+        pass
+
+
+def dump(entries, fp):
+    """
+    Write parse trees to a binary file object
+
+    :param entries: a list of (key, root_node, style_nodes)
+    :param fp: a file object opened in binary mode
+    """
+    for chunk in _dump_chunks(entries):
+        fp.write(chunk)
+
+
+def dumps(entries):
+    """
+    Convert parse trees to bytes
+
+    :param entries: a list of (key, root_node, style_nodes)
+    """
+    return b''.join(_dump_chunks(entries))
+
+
+def load(path):
+    """
+    Load the parse trees of a file written by dump(). The file is mmapped.
+
+    :return: a list of (key, CppLoadedTree)
+    """
+    with open(path, 'rb') as fp:
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(buf)
+
+
+def loads(buf):
+    """
+    Load the parse trees of a buffer written by dumps()
+
+    :param buf: bytes, an mmap, or any other buffer
+    :return: a list of (key, CppLoadedTree)
+    """
+    view = memoryview(buf)
+    if len(view) < _HEADER.size:
+        raise Exception("Not a parse tree file")
+    magic, version, _, meta_len = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise Exception("Not a parse tree file")
+    if version != FORMAT_VERSION:
+        raise Exception(f"Unsupported parse tree format version {version}")
+    off = _HEADER.size
+    meta = json.loads(str(view[off:off + meta_len], 'utf-8'))
+    off += meta_len
+    swap = meta['byteorder'] != sys.byteorder
+
+    def read_section():
+        nonlocal off
+        size, = _SECTION.unpack_from(view, off)
+        off += _SECTION.size
+        section = view[off:off + size]
+        off += size
+        return section
+
+    def read_array(typecode):
+        col = array(typecode)
+        col.frombytes(read_section())
+        if swap:
+            col.byteswap()
+        return col
+
+    str_offs = read_array('I')
+    str_data = str(read_section(), 'utf-8')
+    strings = [str_data[str_offs[i]:str_offs[i + 1]]
+               for i in range(len(str_offs) - 1)]
+    cols = {name: read_array(typecode) for name, typecode in NODE_COLUMNS}
+    srcs = []
+    for kind in meta['sources']:
+        src = read_section()
+        srcs.append(str(src, 'utf-8') if kind == 'str' else src)
+    node_types = [CppParseNodeType[name] for name in meta['node_types']]
+    props = {int(i): node_props for i, node_props in meta['props'].items()}
+
+    entries = []
+    i = 0
+    for key in meta['keys']:
+        root_node, i = _load_tree(cols, i, node_types, strings, srcs, props)
+        style_nodes, i = _load_tree(cols, i, node_types, strings, srcs,
+                                    props)
+        entries.append((key, CppLoadedTree(root_node, style_nodes)))
+    return entries
+
+
+def _dump_chunks(entries):
+    strings = {}
+    srcs = {}
+    src_texts = []
+    props = {}
+    cols = {name: array(typecode) for name, typecode in NODE_COLUMNS}
+    types = cols['types']
+    hidden = cols['hidden']
+    sizes = cols['sizes']
+    starts = cols['starts']
+    ends = cols['ends']
+    src_ids = cols['srcs']
+    vals = cols['vals']
+    type_ids = {node_type: i for i, node_type in enumerate(NODE_TYPES)}
+    i = 0
+    for key, root_node, style_nodes in entries:
+        for tree in (root_node, style_nodes):
+            for node in tree.iter_preorder(include_self=True):
+                types.append(type_ids[node.node_type])
+                hidden.append(1 if node.hidden else 0)
+                sizes.append(node.size())
+                starts.append(NONE if node.start is None else node.start)
+                src = node.src_
+                if src is not None and node.start is not None:
+                    if id(src) not in srcs:
+                        srcs[id(src)] = len(src_texts)
+                        src_texts.append(src)
+                    src_ids.append(srcs[id(src)])
+                else:
+                    src_ids.append(NONE)
+                if node.end is not None:
+                    ends.append(node.end)
+                    vals.append(NONE)
+                else:
+                    ends.append(NONE)
+                    vals.append(_intern(strings, node.val))
+                node_props = {prop: getattr(node, prop)
+                              for prop in CppParseNode.PROP_SLOTS
+                              if hasattr(node, prop)}
+                if len(node_props):
+                    props[i] = node_props
+                i += 1
+    meta = {
+        'byteorder': sys.byteorder,
+        'node_types': [node_type.name for node_type in NODE_TYPES],
+        'keys': [key for key, _, _ in entries],
+        'sources': ['str' if isinstance(src, str) else 'bytes'
+                    for src in src_texts],
+        'props': props,
+    }
+    meta = json.dumps(meta).encode('utf-8')
+    yield _HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(meta))
+    yield meta
+    str_offs = array('I', [0])
+    str_data = []
+    size = 0
+    for string in strings:
+        size += len(string)
+        str_offs.append(size)
+        str_data.append(string)
+    yield from _section(str_offs.tobytes())
+    yield from _section(''.join(str_data).encode('utf-8'))
+    for name, _ in NODE_COLUMNS:
+        yield from _section(cols[name].tobytes())
+    for src in src_texts:
+        yield from _section(src.encode('utf-8') if isinstance(src, str)
+                            else src)
+
+
+def _section(data):
+    yield _SECTION.pack(len(data))
+    yield data
+
+
+def _intern(strings, string):
+    """
+    The index of a string in the string table
+    """
+    if string is None:
+        return NONE
+    if string not in strings:
+        strings[string] = len(strings)
+    return strings[string]
+
+
+def _load_tree(cols, i, node_types, strings, srcs, props):
+    """
+    Load the tree whose root is node i of the node table
+
+    :return: the root node and the index of the node after the tree
+    """
+    types = cols['types']
+    hidden = cols['hidden']
+    sizes = cols['sizes']
+    starts = cols['starts']
+    ends = cols['ends']
+    src_ids = cols['srcs']
+    vals = cols['vals']
+
+    def make_node(i, parent):
+        start = starts[i]
+        end = ends[i]
+        val = vals[i]
+        src_id = src_ids[i]
+        node = CppParseNode(node_types[types[i]],
+                            None if val == NONE else strings[val],
+                            None if start == NONE else start,
+                            parent, hidden[i] == 1,
+                            None if end == NONE else end,
+                            None if src_id == NONE else srcs[src_id])
+        if i in props:
+            for prop, prop_val in props[i].items():
+                setattr(node, prop, prop_val)
+        return node
+
+    root_node = make_node(i, None)
+    stack = [[root_node, sizes[i]]]
+    i += 1
+    while len(stack):
+        top = stack[-1]
+        if top[1] == 0:
+            stack.pop()
+            continue
+        top[1] -= 1
+        node = make_node(i, top[0])
+        top[0].children_.append(node)
+        if sizes[i]:
+            stack.append([node, sizes[i]])
+        i += 1
+    return root_node, i
@@ -0,0 +1,129 @@
+"""
+The macros and include guards after a prelude of headers, saved to start
+other parses from (see CppParse(snapshot=...))
+
+A snapshot is made by following the includes of the prelude headers in
+order, as if a file included each of them. It keeps the macro table at the
+end, the include guard of each guarded header, and the SHA-256 of every
+file which was read. A parse started from a snapshot begins with its
+macros, and skips includes of its headers by their guards without reading
+them. A snapshot whose files changed is stale, and isn't loaded.
+"""
+
+import hashlib
+import json
+import os
+from .cpp_parse_macro import CppMacroTable
+
+SNAPSHOT_VERSION = 1
+
+
+def hash_file(path):
+    """
+    The SHA-256 of the content of a file, or None if it can't be read
+    """
+    hasher = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                hasher.update(chunk)
+    except OSError:
+        return None
+    return hasher.hexdigest()
+
+
+class CppParseSnapshot:
+    def __init__(self, macros=None, guards=None, files=None):
+        """
+        :param macros: the CppMacroTable at the end of the prelude
+        :param guards: the guard macro of each guarded header, or None for
+        #pragma once
+        :param files: the SHA-256 of each file which was read
+        """
+        self.macros = macros if macros is not None else CppMacroTable()
+        self.guards = guards if guards is not None else {}
+        self.files = files if files is not None else {}
+
+    @staticmethod
+    def make(paths, macros=None, include_dirs=None):
+        """
+        Preprocess a prelude
+
+        :param paths: the prelude headers, in the order they are included
+        :param macros: the macros defined before the prelude (e.g., by -D)
+        :param include_dirs: the directories to search for the includes of
+        the prelude
+        :return: the snapshot
+        """
+        # cpp_parse imports this module
+        from .cpp_parse import CppParse
+        from .cpp_parse_state import CppParseState
+        # The headers are keyed by their real path, as includes resolve to
+        text = "".join(f'#include "{os.path.realpath(path)}"\n'
+                       for path in paths)
+        state = CppParseState()
+        parser = CppParse(text=text, state=state, macros=macros,
+                          include_dirs=include_dirs if include_dirs is not None
+                          else [], keep_phases=False).parse()
+        unresolved = state.includes.get_unresolved(None)
+        if len(unresolved):
+            raise Exception(f"The prelude header {unresolved[0]} was not "
+                            f"found")
+        headers = state.includes.get_closure(None)
+        return CppParseSnapshot(
+            parser.get_macros().copy(),
+            {path: guard for path, guard in state.includes.guards.items()
+             if path in headers},
+            {path: hash_file(path) for path in headers})
+
+    def is_valid(self):
+        """
+        Whether every file of the snapshot still has the same content
+        """
+        return all(hash_file(path) == digest
+                   for path, digest in self.files.items())
+
+    def get_digest(self):
+        """
+        The SHA-256 of the snapshot, for the keys of the parse cache
+        """
+        return hashlib.sha256(json.dumps(
+            self.to_dict(), sort_keys=True).encode('utf-8')).hexdigest()
+
+    def to_dict(self):
+        return {
+            'version': SNAPSHOT_VERSION,
+            'macros': self.macros.to_dict(),
+            'guards': self.guards,
+            'files': self.files,
+        }
+
+    @staticmethod
+    def from_dict(snapshot):
+        return CppParseSnapshot(CppMacroTable.from_dict(snapshot['macros']),
+                                dict(snapshot['guards']),
+                                dict(snapshot['files']))
+
+    def save(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.to_dict(), fp)
+
+    @staticmethod
+    def load(path):
+        """
+        Load a snapshot saved by save()
+
+        :return: the snapshot, or None if it is missing, was saved by
+        another version, or any of its files changed
+        """
+        try:
+            with open(path) as fp:
+                snapshot = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            return None
+        snapshot = CppParseSnapshot.from_dict(snapshot)
+        if not snapshot.is_valid():
+            return None
+        return snapshot
@@ -1,5 +1,207 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from . import cpp_parse_serial
+from .cpp_parse_cache import CppParseCache
+from .cpp_parse_include import CppIncludeGraph
+from .cpp_parse_profile import make_report
+
+# The estimated memory of one node of a parse tree, including its share of
+# the children lists and the text
+NODE_BYTES = 250
+
 
 class CppParseState:
-    def __init__(self):
-        self.parse_trees = {}
-        self.errors = []
\ No newline at end of file
+    def __init__(self, max_nodes=None, max_bytes=None, cache=None):
+        """
+        :param max_nodes: the number of nodes the parse trees may hold in
+        memory. Past it, the least recently used trees are evicted.
+        :param max_bytes: the estimated memory the parse trees may use (see
+        NODE_BYTES). Past it, the least recently used trees are evicted.
+        :param cache: a CppParseCache or the directory of one. Evicted trees
+        are stored in it. Without it, evicted trees are dropped and parsed
+        again from their file.
+        """
+        self.parse_trees = CppParseTrees(max_nodes, max_bytes, cache)
+        # The includes between the files, when includes are followed
+        self.includes = CppIncludeGraph()
+        # The parsers of the headers which were parsed again with the
+        # macros of an includer, by path (see CppParse._include_variant).
+        # They are not evicted.
+        self.variants = {}
+        self.errors = []
+
+    def get_stats(self):
+        """
+        The memory use of the parse trees and how often they were evicted
+        and restored
+        """
+        return self.parse_trees.get_stats()
+
+    def get_profile_report(self):
+        """
+        The statistics of every file which was parsed with profiling on, and
+        their totals (see cpp_parse_profile.make_report)
+        """
+        return make_report(parser.stats
+                           for parser in self.parse_trees.parsers.values()
+                           if parser.stats is not None)
+
+    def save(self, path):
+        """
+        Save every parse tree to one binary file (see cpp_parse_serial)
+        """
+        entries = []
+        for key, parser in self.parse_trees.items():
+            if parser.parse_tree is not None:
+                root_node, style_nodes = parser._serial_entries()[0][1:]
+                entries.append((key, root_node, style_nodes))
+        with open(path, 'wb') as fp:
+            cpp_parse_serial.dump(entries, fp)
+
+    @staticmethod
+    def load(path):
+        """
+        Load the parse trees saved by save()
+
+        :return: a CppParseState
+        """
+        from .cpp_parse import CppParse
+        state = CppParseState()
+        for key, tree in cpp_parse_serial.load(path):
+            CppParse.from_tree(key, tree, state)
+        return state
+
+
+class CppParseTrees(MutableMapping):
+    """
+    The parser of each path, in least recently used order. When the parse
+    trees grow past the budget, the least recently used ones are evicted:
+    the parser stays, but drops its parse tree. Getting an evicted parser
+    (or using one which is still held) restores its tree from the cache or
+    by parsing its file again.
+
+    A tree can only be evicted if it can be restored. Trees which were not
+    parsed from a file (or were edited since) need a cache.
+    """
+    def __init__(self, max_nodes=None, max_bytes=None, cache=None):
+        if isinstance(cache, str):
+            cache = CppParseCache(cache)
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.parsers = OrderedDict()
+        # The (node count, estimated bytes) of each tree in memory
+        self.sizes = {}
+        self.nodes = 0
+        self.bytes = 0
+        # Gets of parsers whose tree was in memory and of evicted ones
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getitem__(self, path):
+        parser = self.parsers[path]
+        self.parsers.move_to_end(path)
+        if parser.evicted:
+            parser._restore()
+        else:
+            self.hits += 1
+        return parser
+
+    def __setitem__(self, path, parser):
+        if path in self.parsers:
+            self._forget(path)
+        self.parsers[path] = parser
+        if parser.parse_tree is not None:
+            self.account(path)
+
+    def __delitem__(self, path):
+        del self.parsers[path]
+        self._forget(path)
+
+    def pop(self, path, *default):
+        # Without getting the parser, which would restore it
+        if path not in self.parsers:
+            if len(default):
+                return default[0]
+            raise KeyError(path)
+        self._forget(path)
+        return self.parsers.pop(path)
+
+    def __contains__(self, path):
+        # Without getting the parser, which would restore it
+        return path in self.parsers
+
+    def __iter__(self):
+        return iter(list(self.parsers))
+
+    def __len__(self):
+        return len(self.parsers)
+
+    def peek(self, path):
+        """
+        The parser of a path, without restoring it or marking it as used
+
+        :return: the parser or None
+        """
+        return self.parsers.get(path)
+
+    def has_budget(self):
+        return self.max_nodes is not None or self.max_bytes is not None
+
+    def account(self, path):
+        """
+        Count the size of the tree of a path, which was just made, and
+        evict other trees if it went over budget
+        """
+        parser = self.parsers.get(path)
+        if parser is None or not self.has_budget():
+            return
+        self._forget(path)
+        self.parsers.move_to_end(path)
+        nodes = parser.count_nodes()
+        size = (nodes, nodes * NODE_BYTES)
+        self.sizes[path] = size
+        self.nodes += size[0]
+        self.bytes += size[1]
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Evict the least recently used trees until the trees are within
+        budget
+
+        :param keep: a path whose tree is not evicted
+        """
+        for path in list(self.parsers):
+            if not self._over_budget():
+                return
+            if path == keep or path not in self.sizes:
+                continue
+            parser = self.parsers[path]
+            if not parser._evict(self.cache):
+                continue
+            self._forget(path)
+            self.evictions += 1
+
+    def _over_budget(self):
+        return (self.max_nodes is not None and self.nodes > self.max_nodes) \
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def _forget(self, path):
+        size = self.sizes.pop(path, None)
+        if size is not None:
+            self.nodes -= size[0]
+            self.bytes -= size[1]
+
+    def get_stats(self):
+        return {
+            'trees': len(self.parsers),
+            'resident': len(self.sizes) if self.has_budget() else
+            sum(1 for parser in self.parsers.values() if not parser.evicted),
+            'nodes': self.nodes,
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,68 @@
+"""
+Walk a parse tree, dispatching on the type of each node
+
+A visitor defines visit_<TYPE> and leave_<TYPE> methods, where <TYPE> is the
+name of a CppParseNodeType (e.g., visit_FUNCTION_DEF). visit_<TYPE> is
+called before the children of a node are walked and leave_<TYPE> after.
+visit_default and leave_default handle the types without a method.
+A visit method returns False to skip the children of the node.
+
+The walk uses an explicit stack, so the depth of the tree is not bounded by
+the recursion limit.
+"""
+
+from .cpp_parse_node import CppParseNodeType
+
+
+class CppParseVisitor:
+    def walk(self, root_node, include_root=False):
+        """
+        Walk the nodes below root_node in text order
+
+        :param root_node: the node to walk
+        :param include_root: whether to visit root_node itself
+        :return: self
+        """
+        visit_table, leave_table = self._make_tables()
+        visit_default = self.visit_default
+        leave_default = self.leave_default
+        if include_root:
+            visit = visit_table.get(root_node.node_type, visit_default)
+            if visit(root_node) is False:
+                leave_table.get(root_node.node_type, leave_default)(root_node)
+                return self
+        stack = [(root_node, iter(root_node.get_children()))]
+        while stack:
+            for node in stack[-1][1]:
+                visit = visit_table.get(node.node_type, visit_default)
+                if visit(node) is not False and node.size():
+                    stack.append((node, iter(node.get_children())))
+                    break
+                leave_table.get(node.node_type, leave_default)(node)
+            else:
+                node = stack.pop()[0]
+                if len(stack) or include_root:
+                    leave_table.get(node.node_type, leave_default)(node)
+        return self
+
+    def visit_default(self, node):
+        return True
+
+    def leave_default(self, node):
+        pass
+
+    def _make_tables(self):
+        """
+        Map each CppParseNodeType to the visit and leave methods of this
+        visitor which handle it
+        """
+        visit_table = {}
+        leave_table = {}
+        for node_type in CppParseNodeType:
+            visit = getattr(self, f"visit_{node_type.name}", None)
+            if visit is not None:
+                visit_table[node_type] = visit
+            leave = getattr(self, f"leave_{node_type.name}", None)
+            if leave is not None:
+                leave_table[node_type] = leave
+        return visit_table, leave_table
@@ -0,0 +1,62 @@
+"""
+A compact stream of typed tokens.
+
+Tokens are stored as parallel arrays (struct-of-arrays) of kind, start,
+and end. start and end are offsets into the lexed text, so no string is
+created for a token until its text is requested.
+"""
+
+from array import array
+
+
+class CppTokStream:
+    def __init__(self, text):
+        self.text = text
+        self.kinds = array('B')
+        self.starts = array('I')
+        self.ends = array('I')
+
+    def append(self, kind, start, end):
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def kind(self, i):
+        return self.kinds[i]
+
+    def start(self, i):
+        return self.starts[i]
+
+    def end(self, i):
+        return self.ends[i]
+
+    def val(self, i):
+        """
+        Materialize the text of a token
+
+        :param i: the index of the token
+        :return: the string the token spans
+        """
+        val = self.text[self.starts[i]:self.ends[i]]
+        if not isinstance(val, str):
+            val = str(val, 'utf-8')
+        return val
+
+    def size(self):
+        return len(self.kinds)
+
+    def nbytes(self):
+        """
+        The number of bytes used by the token arrays
+        """
+        return sum(len(col) * col.itemsize
+                   for col in (self.kinds, self.starts, self.ends))
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        return self.kinds[i], self.starts[i], self.ends[i]
+
+    def __iter__(self):
+        return zip(self.kinds, self.starts, self.ends)
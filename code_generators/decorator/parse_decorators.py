@@ -1,34 +1,36 @@
 from code_generators.cpp.cpp_parse import CppParse
 from code_generators.cpp.cpp_parse_node import CppParseNode, CppParseNodeType
+from code_generators.cpp.cpp_parse_visitor import CppParseVisitor
 
 
 class ParseDecorators:
-    def __init__(self, decorators, paths):
+    def __init__(self, decorators, paths, jobs=1, parse_state=None):
+        """
+        :param jobs: the number of processes to parse the paths with
+        :param parse_state: a CppParseState holding parse trees of the paths
+        (e.g., of a CppParseDaemon). Paths already in it are not parsed
+        again.
+        """
         self.decorators = {dec.name : dec for dec in decorators}
         self.paths = paths
+        self.jobs = jobs
+        self.parse_state = parse_state
+        # The files written by the last parse()
+        self.outputs = []
 
     def parse(self):
         state = {}
+        parse_state = CppParse(paths=self.paths, jobs=self.jobs,
+                               state=self.parse_state).parse().state
         for path in self.paths:
-            parser = CppParse(paths=[path])
-            parser.parse()
+            parser = parse_state.parse_trees[path]
             self._parse_decorators(parser.get_root_node(), state)
         self._output(state)
+        self.outputs = list(state)
         return self
 
     def _parse_decorators(self, root_node, state):
-        i = 0
-        while i < root_node.size():
-            node = root_node[i]
-            if node.node_type == CppParseNodeType.FUNCTION_DEF:
-                self._parse_function(node, state)
-            elif node.node_type == CppParseNodeType.CLASS_DEFN:
-                self._parse_decorators(node, state)
-            elif node.node_type == CppParseNodeType.NAMESPACE_DEFN:
-                self._parse_decorators(node, state)
-            elif node.node_type == CppParseNodeType.BODY:
-                self._parse_decorators(node, state)
-            i += 1
+        DecoratorVisitor(self, state).walk(root_node)
 
     def _parse_function(self, func_node, state):
         for spec in func_node.specifiers:
@@ -44,3 +46,29 @@ class ParseDecorators:
         for path, lines in state.items():
             with open(path, 'w') as fp:
                 fp.write("\n".join(lines))
+
+
+class DecoratorVisitor(CppParseVisitor):
+    """
+    Finds the decorated functions of a parse tree. Only classes, namespaces,
+    and bodies are walked into.
+    """
+    def __init__(self, parser, state):
+        self.parser = parser
+        self.state = state
+
+    def visit_default(self, node):
+        return False
+
+    def visit_FUNCTION_DEF(self, node):
+        self.parser._parse_function(node, self.state)
+        return False
+
+    def visit_CLASS_DEFN(self, node):
+        return True
+
+    def visit_NAMESPACE_DEFN(self, node):
+        return True
+
+    def visit_BODY(self, node):
+        return True
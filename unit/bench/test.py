@@ -0,0 +1,57 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+from code_generators.bench import cpp_bench
+from code_generators.bench.cpp_bench import CppBench
+from code_generators.bench.cpp_corpus import CppCorpus
+from code_generators.cpp.cpp_parse import CppParse
+
+def corpus_generate():
+    corpus = CppCorpus(prototypes=40, depth=3, comment_density=0.5,
+                       macro_density=0.5, template_density=0.5, seed=3)
+    text = corpus.generate()
+    # The same parameters always generate the same text
+    assert(text == corpus.generate())
+    assert(text != CppCorpus(prototypes=40, seed=4).generate())
+    assert(len(corpus.apis) == 40)
+    assert(text.count(corpus.apis[0].api_str) == 1)
+    for line in ["template<typename T>", "#ifdef", "#define", "/**", "//"]:
+        assert(line in text)
+    parser = CppParse(text=text).parse()
+    assert(parser.invert() == text)
+    assert(len(parser.get_errors()) == 0)
+
+def bench_run():
+    corpus = CppCorpus(prototypes=20)
+    report = CppBench(corpus, files=2, repeat=1).run()
+    assert(report['corpus']['files'] == 2 and report['nodes'] > 0)
+    for stage in ['parse', 'lex', 'label', 'group', 'rewrite',
+                  'parse_folded', 'invert', 'api_class']:
+        assert(report['stages'][stage]['median'] >= 0)
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'bench.json')
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            assert(cpp_bench.main(['--prototypes', '10', '--repeat', '1',
+                                   '--json', json_path]) == 0)
+        assert("MB/s" in out.getvalue())
+        with open(json_path) as fp:
+            assert(json.load(fp)['corpus']['prototypes'] == 10)
+
+def bench_folded():
+    corpus = CppCorpus(prototypes=500, ifdef_density=0.75)
+    text = corpus.generate()
+    assert(text.count("#ifdef SCOPE") == 5)
+    parser = CppParse(text=text, fold_conditionals=True).parse()
+    assert(parser.invert() == text)
+    # The scopes which are never enabled are skipped before they are
+    # labeled, so the folded parse is faster
+    report = CppBench(corpus, repeat=3).run()
+    assert(report['corpus']['ifdef_density'] == 0.75)
+    stages = report['stages']
+    assert(stages['parse_folded']['median'] < stages['parse']['median'])
+
+corpus_generate()
+bench_run()
+bench_folded()
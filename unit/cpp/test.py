@@ -1,5 +1,1118 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from code_generators.cpp import cpp_parse_cli, cpp_parse_client
 from code_generators.cpp.cpp_parse import CppParse
-from code_generators.cpp.cpp_parse_node import CppParseNodeType
+from code_generators.cpp.cpp_parse0 import CppParse0, CppTokType
+from code_generators.cpp.cpp_parse_state import CppParseState
+from code_generators.cpp.cpp_parse_cache import CppParseCache
+from code_generators.cpp.cpp_parse_client import CppParseClient
+from code_generators.cpp.cpp_parse_daemon import CppParseDaemon
+from code_generators.cpp.cpp_parse_snapshot import CppParseSnapshot
+from code_generators.cpp.cpp_parse_node import CppParseNode, CppParseNodeType
+from code_generators.cpp.cpp_parse_profile import CppParseProfile
+from code_generators.cpp.cpp_parse_visitor import CppParseVisitor
+
+def lex_typed():
+    text = """
+    #define HELLO(x) \\
+      x ## 1
+    std::vector<int> x = "a\\"b"; // hi
+    y->z += 'c' /* there */ .5e+3;
+    """
+
+    lex = CppParse0(text, typed=True).lex()
+    toks = [(kind, text[start:end]) for kind, start, end in lex.toks
+            if kind != CppTokType.WHITESPACE]
+    assert(toks[0] == (CppTokType.PREPROCESSOR,
+                       "#define HELLO(x) \\\n      x ## 1"))
+    assert(toks[1] == (CppTokType.TEXT, "std"))
+    assert(toks[2] == (CppTokType.NS_SEP, "::"))
+    assert(toks[4] == (CppTokType.ANGLE_BRACKET_LEFT, "<"))
+    assert(toks[5] == (CppTokType.TYPE, "int"))
+    assert(toks[9] == (CppTokType.STRING, '"a\\"b"'))
+    assert(toks[11] == (CppTokType.SL_COMMENT, "// hi"))
+    assert(toks[13] == (CppTokType.OP, "->"))
+    assert(toks[15] == (CppTokType.OP, "+="))
+    assert(toks[16] == (CppTokType.CHAR, "'c'"))
+    assert(toks[17] == (CppTokType.ML_COMMENT, "/* there */"))
+    assert(toks[18] == (CppTokType.NUMBER, ".5e+3"))
+    assert("".join(text[start:end] for _, start, end in lex.toks) == text)
+
+def lex_tok_stream():
+    text = "int x = 5;"
+
+    toks = CppParse0(text, typed=True).lex().toks
+    assert(len(toks) == 8)
+    assert(toks.kind(0) == CppTokType.TYPE)
+    assert(toks.start(2) == 4 and toks.end(2) == 5)
+    assert(toks.val(2) == 'x')
+    assert(toks[6] == (CppTokType.NUMBER, 8, 9))
+    assert(toks.kinds.itemsize == 1)
+    assert(toks.nbytes() == 8 * (1 + 2 * toks.starts.itemsize))
+
+def parse_typed_invert():
+    text = """
+    #include <vector>
+    /* hello1 */ int x = "1234" + '5' + R"d(raw)d"; // hello2
+    """
+
+    parser = CppParse(text=text, typed_lex=True)
+    parser.parse()
+    nodes = parser.get_root_node().get_children()
+    assert(nodes[0].is_one_of(CppParseNodeType.PREPROCESSOR))
+    assert(nodes[0][0].val == '#include')
+    assert(nodes[4].is_one_of(CppParseNodeType.STRING))
+    assert(nodes[4].val == '1234')
+    assert(nodes[6].is_one_of(CppParseNodeType.CHAR))
+    assert(nodes[8].val == 'raw')
+    assert(text == parser.invert())
+
+def parse_mmap():
+    text = """
+    #include "héllo.h"
+    /* 日本 */ int x = "ünï" + 'c';
+    """
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'mmap.h')
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(text)
+        parser = CppParse(path=path, use_mmap=True, keep_phases=False)
+        parser.parse()
+    assert(parser.text is None)
+    assert(not hasattr(parser, 'phase0'))
+    nodes = parser.get_root_node().get_children()
+    assert(nodes[0][1].val == ' "héllo.h"')
+    assert(nodes[4].is_one_of(CppParseNodeType.STRING))
+    assert(nodes[4].val == 'ünï')
+    assert(parser.get_style_nodes()[2].val == ' 日本 ')
+    assert(text == parser.invert())
+
+def parse_spans():
+    text = """
+    // hello
+    int x = "1234";
+    """
+
+    parser = CppParse(text=text, typed_lex=True)
+    parser.parse()
+    nodes = parser.get_root_node().get_children()
+    # Nodes span the text and only copy it out when asked for
+    assert(nodes[0].val_ is None and nodes[0].has_span())
+    assert(nodes[0].val == 'int')
+    assert(parser.get_style_nodes()[1].val == ' hello')
+    # An unmodified tree inverts to a single slice of the text
+    assert(parser.invert() is text)
+    # Assigning a value drops the span
+    nodes[1].val = 'y'
+    assert(not nodes[1].has_span())
+    assert(parser.invert() == text.replace('x', 'y'))
+
+def parse_invert_to():
+    text = """
+    namespace hello {
+    // hello
+    int x[2] = {(1 + 2), 3}; /* world */
+    }
+    """
+
+    parser = CppParse(text=text * 3, typed_lex=True)
+    parser.parse()
+    # The style tree stays in text order after grouping
+    starts = [node.start for node in parser.get_style_nodes().linearize()]
+    assert(starts == sorted(starts))
+    fp = io.StringIO()
+    parser.invert_to(fp)
+    assert(fp.getvalue() == text * 3)
+
+def node_traversal():
+    text = "int f(int x[2]) { return (x[0]); }"
+
+    parser = CppParse(text=text, typed_lex=True)
+    parser.parse()
+    root = parser.get_root_node()
+    pre = [node.node_type for node in root.iter_preorder()]
+    post = [node.node_type for node in root.iter_postorder()]
+    assert(pre[2] == CppParseNodeType.PARENTHESIS)
+    assert(pre[3] == CppParseNodeType.TYPE)
+    assert(post[-1] == CppParseNodeType.BRACES)
+    assert(post.index(CppParseNodeType.BRACKETS) <
+           post.index(CppParseNodeType.PARENTHESIS))
+    assert(sorted(pre, key=str) == sorted(post, key=str))
+
+    class CountVisitor(CppParseVisitor):
+        def __init__(self):
+            self.texts = []
+            self.groups = 0
+
+        def visit_TEXT(self, node):
+            self.texts.append(node.val)
+
+        def visit_BRACES(self, node):
+            return False
+
+        def leave_PARENTHESIS(self, node):
+            self.groups += 1
+
+    visitor = CountVisitor().walk(root)
+    assert(visitor.texts == ['f', 'x'])
+    assert(visitor.groups == 1)
+
+def parse_deep_nesting():
+    depth = sys.getrecursionlimit() * 2
+    text = "int x = " + "(" * depth + "1" + ")" * depth + ";"
+
+    parser = CppParse(text=text, typed_lex=True)
+    parser.parse()
+    root = parser.get_root_node()
+    assert(root.join() == text.replace(" ", "").replace("(", "")
+           .replace(")", ""))
+    assert(len(root.deep_copy().linearize()) == len(root.linearize()))
+    assert(text == parser.invert())
+
+def parse_find_all():
+    text = """
+    int hello(int x, int y[2]) { return (x + y[0]); }
+    """
+
+    parser = CppParse(text=text, typed_lex=True).parse()
+    parens = parser.find_all(CppParseNodeType.PARENTHESIS)
+    assert(len(parens) == 2)
+    assert(parens[1].parent.is_one_of(CppParseNodeType.BRACES))
+    assert([node.val for node in parser.find_all(CppParseNodeType.TEXT)] ==
+           ['hello', 'x', 'y', 'x', 'y'])
+    assert(parser.find_all(CppParseNodeType.FUNCTION_DEF) == [])
+    # The index is rebuilt after the tree is modified
+    index = parser.get_index()
+    parser.get_root_node().make_tok_child(CppParseNodeType.TEXT, 'z', None)
+    parser.invalidate_index()
+    assert(parser.get_index() is not index)
+    assert(parser.find_all(CppParseNodeType.TEXT)[-1].val == 'z')
+
+def parse_query():
+    text = """
+    int hello(int x, int y[2]) { return (x + y[0]); }
+    """
+
+    parser = CppParse(text=text, typed_lex=True).parse()
+    assert([node.val for node in parser.query("parenthesis > text")] ==
+           ['x', 'y', 'x', 'y'])
+    assert([node.val for node in parser.query("braces text")] == ['x', 'y'])
+    assert(len(parser.query("braces > text")) == 0)
+    assert(len(parser.query("text[val=hello]")) == 1)
+    assert(len(parser.query("braces parenthesis > brackets > *")) == 1)
+    node = parser.query("root > text")[0]
+    node.specifiers = ['RPC']
+    assert(parser.query("text[specifier=RPC]") == [node])
+    # One walk without the index and index lookups with it are the same
+    selectors = ["parenthesis > text", "braces text", "brackets > *"]
+    walked = parser.query_many(selectors)
+    parser.get_index()
+    indexed = parser.query_many(selectors)
+    assert(walked == indexed)
+    assert(len(walked["brackets > *"]) == 2)
+    for bad in ["", "text >", "nothing", "[val=x]"]:
+        try:
+            parser.query(bad)
+            assert(False)
+        except Exception as e:
+            assert("query" in str(e))
+
+def parse_serialize():
+    text = """
+    #include <vector>
+    /* hello */ int x = "1234" + y[2];
+    """
+
+    parser = CppParse(text=text, typed_lex=True).parse()
+    parser.get_root_node()[1].val = 'float'
+    parser.get_root_node()[2].name = 'x'
+    loaded = CppParse.from_bytes(parser.to_bytes())
+    assert(loaded.invert() == text.replace('int', 'float'))
+    assert(loaded.get_root_node()[2].name == 'x')
+    assert(loaded.get_root_node()[2].parent is loaded.get_root_node())
+    assert(len(loaded.find_all(CppParseNodeType.BRACKETS)) == 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'serial.h')
+        with open(path, 'w') as fp:
+            fp.write(text)
+        state = CppParse(path=path, use_mmap=True).parse().state
+        CppParse(text="int y;", state=state).parse()
+        state.save(os.path.join(tmp, 'state.bin'))
+        loaded = CppParseState.load(os.path.join(tmp, 'state.bin'))
+        assert(loaded.parse_trees[path].invert() == text)
+        assert(loaded.parse_trees[None].invert() == "int y;")
+    try:
+        CppParse.from_bytes(b'CPPT\xff\xff\x00\x00\x00\x00\x00\x00')
+        assert(False)
+    except Exception as e:
+        assert("version" in str(e))
+
+def header_texts(count):
+    """
+    :return: the texts of count small headers which declare x0, x1, ...
+    """
+    return [f"int x{i} = (1 + {i});\n" for i in range(count)]
+
+def write_headers(tmp, texts):
+    """
+    Write each text to {i}.h in a directory
+
+    :return: the paths of the headers
+    """
+    paths = []
+    for i, text in enumerate(texts):
+        paths.append(os.path.join(tmp, f"{i}.h"))
+        with open(paths[-1], 'w') as fp:
+            fp.write(text)
+    return paths
+
+def parse_cache():
+    texts = ["int x = (1 + 2);\n", "namespace y { int z[2]; }\n"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_headers(tmp, texts)
+        cache = CppParseCache(os.path.join(tmp, 'cache'))
+        CppParse(paths=paths, cache=cache).parse()
+        assert(cache.misses == 2 and cache.hits == 0)
+        # Unchanged files are loaded instead of parsed
+        state = CppParse(paths=paths, cache=cache).parse().state
+        assert(cache.hits == 2)
+        for path, text in zip(paths, texts):
+            parser = state.parse_trees[path]
+            assert(not hasattr(parser, 'phase0'))
+            assert(parser.invert() == text)
+        # A changed file or configuration is a miss
+        with open(paths[0], 'w') as fp:
+            fp.write("int x;\n")
+        CppParse(path=paths[0], cache=cache).parse()
+        CppParse(path=paths[1], cache=cache, macros={'X': '1'}).parse()
+        assert(cache.misses == 4)
+        # Least recently used entries are evicted past the size limit
+        cache.max_bytes = 1
+        cache.evict()
+        assert(cache.evictions == 4)
+        assert(len(os.listdir(os.path.join(tmp, 'cache'))) == 0)
+
+def parse_jobs():
+    texts = header_texts(8)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_headers(tmp, texts)
+        cache = CppParseCache(os.path.join(tmp, 'cache'))
+        state = CppParse(paths=paths, jobs=4, cache=cache).parse().state
+        assert(list(state.parse_trees) == paths)
+        assert(cache.misses == 8)
+        for path, text in zip(paths, texts):
+            parser = state.parse_trees[path]
+            assert(parser.path == path)
+            assert(parser.invert() == text)
+            assert(len(parser.find_all(CppParseNodeType.PARENTHESIS)) == 1)
+        save_path = os.path.join(tmp, 'state.bin')
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            assert(cpp_parse_cli.main(['-j', '2', '--save', save_path] +
+                                      paths) == 0)
+        assert(out.getvalue().count(" nodes\n") == 8)
+        assert(CppParseState.load(save_path).parse_trees[paths[3]].invert() ==
+               texts[3])
+        # The parsers of the workers' trees keep the configuration, so an
+        # edit matches the same edit of a serial parse
+        macro_paths = []
+        for i in range(4):
+            macro_paths.append(os.path.join(tmp, f"m{i}.h"))
+            with open(macro_paths[-1], 'w') as fp:
+                fp.write(f"int a{i} = X;\n")
+        trees = [CppParse(paths=macro_paths, jobs=jobs,
+                          macros={'X': '7'}).parse().state.parse_trees
+                 for jobs in (2, 1)]
+        for path in macro_paths:
+            parsers = [parse_trees[path] for parse_trees in trees]
+            for parser in parsers:
+                assert(parser.macros == {'X': '7'})
+                parser.apply_edit(0, 3, "long")
+            shapes = [[(node.node_type, node.val,
+                        getattr(node, 'expansion', None))
+                       for node in parser.get_root_node().iter_preorder()]
+                      for parser in parsers]
+            assert(shapes[0] == shapes[1])
+            assert(parsers[0].find_all(CppParseNodeType.TEXT)[-1].expansion
+                   == "7")
+
+def parse_pipeline():
+    texts = header_texts(8)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_headers(tmp, texts)
+        parser = CppParse(paths=paths, prefetch=2).parse()
+        for path, text in zip(paths, texts):
+            assert(parser.state.parse_trees[path].invert() == text)
+        read_stats, parse_stats = parser.pipeline.stats
+        assert(read_stats.count == 8 and parse_stats.count == 8)
+        assert(read_stats.max_depth <= 2)
+        assert(parse_stats.to_dict()['name'] == 'parse')
+        # Errors reading a file are raised by the parse
+        try:
+            CppParse(paths=paths + [os.path.join(tmp, 'missing.h')],
+                     prefetch=2).parse()
+            assert(False)
+        except FileNotFoundError:
+            pass
+
+def parse_async():
+    texts = header_texts(8)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_headers(tmp, texts)
+
+        async def parse_all(executor):
+            return await CppParse(paths=paths).parse_async(executor)
+
+        async def parse_first():
+            parser = CppParse(paths=paths)
+            async for child in parser.iter_parse_async(concurrency=1):
+                break
+            return parser, child
+
+        async def parse_cancel():
+            task = asyncio.ensure_future(CppParse(paths=paths).parse_async())
+            await asyncio.sleep(0)
+            task.cancel()
+            try:
+                await task
+                return False
+            except asyncio.CancelledError:
+                return True
+
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            for executor in [None, pool]:
+                state = asyncio.run(parse_all(executor)).state
+                for path, text in zip(paths, texts):
+                    assert(state.parse_trees[path].invert() == text)
+        parser, child = asyncio.run(parse_first())
+        assert(child.path in paths and child.invert() in texts)
+        assert(len(parser.state.parse_trees) < len(paths))
+        assert(asyncio.run(parse_cancel()))
+        parser = asyncio.run(CppParse(text="int y;").parse_async())
+        assert(parser.invert() == "int y;")
+        # Files with the same content put the same cache key from many
+        # threads at once
+        same = []
+        for i in range(16):
+            same.append(os.path.join(tmp, f"same{i}.h"))
+            with open(same[-1], 'w') as fp:
+                fp.write(texts[0])
+        cache = os.path.join(tmp, "cache")
+        for _ in range(3):
+            shutil.rmtree(cache, ignore_errors=True)
+            state = asyncio.run(CppParse(paths=same, cache=cache).parse_async(
+                concurrency=16)).state
+            for path in same:
+                assert(state.parse_trees[path].invert() == texts[0])
+            assert(not any(name.endswith('.tmp')
+                           for name in os.listdir(cache)))
+
+def parse_apply_edit():
+    text = """
+    #include <vector>
+    namespace hello {
+    int f(int x) { return g(x, "a;b"); }  // f
+    int y[2] = {1, 2};
+    }
+    """
+
+    def shape(parser):
+        return [[(node.node_type, node.val) for node in tree.iter_preorder()]
+                for tree in (parser.get_root_node(),
+                             parser.get_style_nodes())]
+
+    # (old text, new text, whether the edit is applied incrementally)
+    edits = [
+        ("g(x", "h(x + 1", True),
+        ("y[2]", "z[3]", True),
+        ("{1, 2}", "{1, (2), 3}", True),
+        ("// f", "/* f */", True),
+        ("<vector>", "<map>", True),
+        ("int f", "int q; int f", True),
+        # Unbalances the braces
+        ("{ return", "return", False),
+        ("return", "{ return", False),
+        # Opens a comment which is closed after the statement
+        ("int q;", "int q; /*", False),
+        ("/*", "", True),
+    ]
+    parser = CppParse(text=text).parse()
+    for old, new, incremental in edits:
+        start = text.index(old)
+        text = text[:start] + new + text[start + len(old):]
+        counts = dict(parser.edit_counts)
+        parser.apply_edit(start, start + len(old), new)
+        assert(parser.invert() == text)
+        assert(shape(parser) == shape(CppParse(text=text).parse()))
+        kind = 'incremental' if incremental else 'full'
+        assert(parser.edit_counts[kind] == counts[kind] + 1)
+    # The parse tree is saved as if it was parsed from the current text
+    loaded = CppParse.from_bytes(parser.to_bytes())
+    assert(loaded.invert() == text)
+    loaded.apply_edit(0, 0, "int w;")
+    assert(loaded.invert() == "int w;" + text)
+    # The split lexer has no spans, so every edit is a full reparse
+    parser = CppParse(text="int y;", typed_lex=False).parse()
+    parser.apply_edit(0, 0, "int w;")
+    assert(parser.invert() == "int w;int y;")
+    assert(parser.edit_counts['full'] == 1)
+
+def parse_daemon():
+    text = "int f(int x) { return g(x); }\n"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'daemon.h')
+        with open(path, 'w') as fp:
+            fp.write(text)
+        socket_path = os.path.join(tmp, 'daemon.sock')
+        daemon = CppParseDaemon(socket_path, [path], poll_interval=0).start()
+        assert(os.stat(socket_path).st_mode & 0o077 == 0)
+        try:
+            with CppParseClient(socket_path, timeout=10) as client:
+                assert(client.request('ping') == 'pong')
+                nodes = client.request('query', selector='braces text')
+                assert([node['val'] for node in nodes] == ['g', 'x'])
+                # Files are checked before each request, and a change is
+                # applied as an edit of the warm parse tree
+                text = text.replace("g(x)", "h(x, 1)")
+                with open(path, 'w') as fp:
+                    fp.write(text)
+                nodes = client.request('query', selector='braces text',
+                                       paths=[path])
+                assert([node['val'] for node in nodes] == ['h', 'x'])
+                assert(client.request('invert', path=path) == text)
+                status = client.request('status')
+                assert(status['files'] == {path: 'ok'})
+                assert(status['counts']['parses'] == 1)
+                assert(status['counts']['edits'] == 1)
+                # A file which can't be lexed keeps its last parse tree
+                with open(path, 'w') as fp:
+                    fp.write(text + "/* open")
+                assert(client.request('invert', path=path) == text)
+                assert(client.request('status')['files'][path] != 'ok')
+                try:
+                    client.request('invert', path='other.h')
+                    assert(False)
+                except Exception as e:
+                    assert('not watched' in str(e))
+            fp = io.StringIO()
+            with contextlib.redirect_stdout(fp):
+                assert(cpp_parse_client.main(
+                    ['--socket', socket_path, 'query', 'parenthesis > *',
+                     path]) == 0)
+            assert(len(json.loads(fp.getvalue())) == 5)
+        finally:
+            daemon.shutdown()
+        assert(not os.path.exists(socket_path))
+        # The default socket is only put in a directory of the user which
+        # others can't access
+        environ = dict(os.environ)
+        try:
+            os.environ.pop('CPP_PARSE_SOCKET', None)
+            os.environ['XDG_RUNTIME_DIR'] = tmp
+            os.chmod(tmp, 0o700)
+            assert(cpp_parse_client.default_socket_path() ==
+                   os.path.join(tmp, 'cpp_parse_daemon.sock'))
+            os.chmod(tmp, 0o755)
+            try:
+                cpp_parse_client.default_socket_path()
+                assert(False)
+            except Exception as e:
+                assert('only the user' in str(e))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+def parse_memory_budget():
+    texts = [f"int x{i} = (1 + {i});\nnamespace n{i} {{ int y; }}\n"
+             for i in range(4)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_headers(tmp, texts)
+        nodes = CppParse(path=paths[0]).parse().count_nodes()
+        # Two trees fit, so the least recently used ones are evicted
+        state = CppParseState(max_nodes=2 * nodes)
+        CppParse(paths=paths, state=state).parse()
+        stats = state.get_stats()
+        assert(stats['trees'] == 4 and stats['resident'] == 2)
+        assert(stats['evictions'] == 2 and stats['nodes'] <= 2 * nodes)
+        assert(state.parse_trees.peek(paths[0]).parse_tree is None)
+        # Evicted trees are parsed again from their file when used
+        for path, text in reversed(list(zip(paths, texts))):
+            assert(state.parse_trees[path].invert() == text)
+        stats = state.get_stats()
+        assert(stats['misses'] == 2 and stats['hits'] == 2)
+        assert(stats['evictions'] == 4 and stats['resident'] == 2)
+        # A parser which is still held restores its own tree
+        parser = state.parse_trees.peek(paths[3])
+        assert(parser.evicted and parser.invert() == texts[3])
+        # With a cache, trees are evicted to it, including edited ones
+        cache = CppParseCache(os.path.join(tmp, 'cache'))
+        state = CppParseState(max_bytes=1, cache=cache)
+        CppParse(paths=paths, state=state).parse()
+        assert(len(os.listdir(cache.cache_dir)) == 3)
+        parser = state.parse_trees[paths[0]]
+        parser.apply_edit(0, 0, "int w;\n")
+        state.parse_trees[paths[1]]
+        assert(parser.evicted)
+        assert(parser.invert() == "int w;\n" + texts[0])
+        assert(cache.hits == 3 and len(os.listdir(cache.cache_dir)) == 5)
+        # Trees parsed by workers are restored with the options they were
+        # parsed with
+        macro_paths = []
+        for i in range(3):
+            macro_paths.append(os.path.join(tmp, f"m{i}.h"))
+            with open(macro_paths[-1], 'w') as fp:
+                fp.write(f"int a{i} = X;\n")
+        state = CppParseState(max_nodes=5)
+        CppParse(paths=macro_paths, state=state, jobs=2, macros={'X': '7'},
+                 fold_conditionals=True).parse()
+        assert(state.parse_trees.peek(macro_paths[0]).evicted)
+        for path in macro_paths:
+            parser = state.parse_trees[path]
+            assert(parser.fold_conditionals)
+            assert(parser.find_all(CppParseNodeType.TEXT)[-1].expansion ==
+                   "7")
+        assert(state.get_stats()['misses'] >= 2)
+
+def parse_profile():
+    texts = header_texts(3)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_headers(tmp, texts)
+        # Profiling is off by default
+        assert(CppParse(text=texts[0]).parse().stats is None)
+        cache = os.path.join(tmp, 'cache')
+        state = CppParse(paths=paths, profile=True, cache=cache).parse().state
+        stats = state.parse_trees[paths[0]].stats
+        assert(stats.cache == 'miss')
+        assert(list(stats.to_dict()['phases']) ==
+               ['read', 'decode', 'cache_get', 'lex', 'label', 'group',
+                'rewrite', 'cache_put'])
+        assert(stats.tokens > 0 and stats.nodes > 0)
+        assert(stats.phases['lex']['calls'] == 1)
+        # Statistics come back from worker processes, and cache hits skip
+        # the phases
+        state = CppParse(paths=paths, profile=True, cache=cache,
+                         jobs=2).parse().state
+        report = state.get_profile_report()
+        assert(report['totals']['files'] == 3)
+        assert(report['totals']['cache_hits'] == 3)
+        assert('lex' not in report['totals']['phases'])
+        assert(report['files'][0]['nodes'] == stats.nodes)
+        # Memory is traced on request
+        parser = CppParse(text=texts[0], profile_memory=True).parse()
+        assert(parser.stats.phases['lex']['peak'] >= 0)
+        # and only while the phases run
+        assert(not tracemalloc.is_tracing())
+        # The parse of an included header runs inside the rewrite phase of
+        # its includer, whose peak still covers the phases of the header
+        with open(os.path.join(tmp, 'all.h'), 'w') as fp:
+            fp.write("".join(f'#include "{i}.h"\n' for i in range(3)))
+        state = CppParseState()
+        CppParse(paths=[os.path.join(tmp, 'all.h')], state=state,
+                 include_dirs=[], profile_memory=True).parse()
+        outer = state.parse_trees[os.path.join(tmp, 'all.h')].stats
+        inner = state.parse_trees[paths[0]].stats
+        assert(outer.phases['rewrite']['peak'] >=
+               max(totals['peak'] for totals in inner.phases.values()))
+        assert(not tracemalloc.is_tracing())
+        outer = CppParseProfile(memory=True)
+        inner = CppParseProfile(memory=True)
+        with outer.phase('rewrite'):
+            with inner.phase('lex'):
+                buf = bytearray(1 << 20)
+                del buf
+            with inner.phase('label'):
+                pass
+        assert(inner.phases['label']['peak'] < 1 << 20)
+        assert(outer.phases['rewrite']['peak'] >= 1 << 20)
+        report_path = os.path.join(tmp, 'profile.json')
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert(cpp_parse_cli.main(['--profile', report_path] +
+                                      paths) == 0)
+        with open(report_path) as fp:
+            report = json.load(fp)
+        assert(report['totals']['tokens'] ==
+               sum(stats['tokens'] for stats in report['files']))
+        assert(report['totals']['phases']['lex']['calls'] == 3)
+
+def parse_macro_expand():
+    text = """
+    #define ROWS(X) X(a, 1) X(b, 2) X(c, 3)
+    #define FIELD(name, val) int name = val;
+    struct S { ROWS(FIELD) };
+    struct T { ROWS(FIELD) };
+    #undef FIELD
+    #define FIELD(name, val) CAT(name, _)
+    #define CAT(a, b) a ## b
+    #define STR(x) #x
+    ROWS(FIELD)
+    const char *s = STR(f(1,  "x"));
+    int y = MAX + VERSION;
+    #define
+    """
+
+    def expansions(parser):
+        return [node.expansion
+                for node in parser.get_root_node().iter_preorder()
+                if getattr(node, 'expansion', None) is not None]
+
+    parser = CppParse(text=text, macros={'VERSION': 2}).parse()
+    assert(expansions(parser) == [
+        "int a = 1; int b = 2; int c = 3;",
+        "int a = 1; int b = 2; int c = 3;",
+        "a_ b_ c_",
+        '"f(1, \\"x\\")"',
+        "2",
+    ])
+    assert(parser.invert() == text)
+    assert(len(parser.get_errors()) == 1)
+    macros = parser.get_macros()
+    # The second struct reuses the expansions of the first, and #undef
+    # drops them
+    assert(macros.hits == 1 and 'FIELD' in macros)
+    assert(macros.expand_text("FIELD(q, 0)") == "q_")
+    # Expansions are saved with the tree
+    loaded = CppParse.from_bytes(parser.to_bytes())
+    assert(expansions(loaded) == expansions(parser))
+    # Edits of trees with macros are parsed as a whole
+    start = text.index("int y")
+    parser.apply_edit(start, start + 3, "long")
+    assert(parser.edit_counts['full'] == 1)
+    assert(expansions(parser)[-1] == "2")
+
+def parse_macro_rescan():
+    # The examples of C11 6.10.3.5
+    text = """
+    #define x 3
+    #define f(a) f(x * (a))
+    #undef x
+    #define x 2
+    #define g f
+    #define z z[0]
+    #define h g(~
+    #define m(a) a(w)
+    #define w 0,1
+    #define t(a) a
+    #define p() int
+    #define q(x) x
+    #define r(x,y) x ## y
+    #define str(x) # x
+    #define G(x) x+1
+    #define F G
+    int u = F(2) + f(z);
+    """
+    parser = CppParse(text=text).parse()
+    macros = parser.get_macros()
+
+    def expand(text):
+        return " ".join(macros.expand_text(text).split())
+
+    assert(expand("f(y+1) + f(f(z)) % t(t(g)(0) + t)(1);") ==
+           "f(2 * (y+1)) + f(2 * (f(2 * (z[0])))) % f(2 * (0)) + t(1);")
+    assert(expand("g(x+(3,4)-w) | h 5) & m\n(f)^m(m);") ==
+           "f(2 * (2+(3,4)-0,1)) | f(2 * (~ 5)) & f(2 * (0,1))^m(0,1);")
+    assert(expand("p() i[q()] = { q(1), r(2,3), r(4,), r(,5), r(,) };") ==
+           "int i[] = { 1, 23, 4, 5, };")
+    assert(expand("char c[2][6] = { str(hello), str() };") ==
+           'char c[2][6] = { "hello", "" };')
+    # A macro name in its own expansion is never expanded again, even
+    # after being passed through another macro
+    assert(expand("f(z)") == "f(2 * (z[0]))")
+    assert(expand("t(z) t(t(z))") == "z[0] z[0]")
+    # The invocation of G is completed by the text after F
+    assert(expand("F(2)") == "2+1")
+    assert(expand("F") == "G")
+    assert([node.expansion
+            for node in parser.get_root_node().iter_preorder()
+            if getattr(node, 'expansion', None) is not None] ==
+           ["2+1", "f(2 * (z[0]))", "z[0]"])
+    assert(parser.invert() == text)
+
+def parse_includes():
+    files = {
+        "inc/common.h": '#define SQ(x) ((x) * (x))\n#undef GONE\n'
+                        '#include "cycle.h"\n',
+        "inc/cycle.h": '#include "common.h"\n#define CYCLE 1\n',
+        "src/a.h": '#include <common.h>\n#include <vector>\n'
+                   'int a = SQ(2) + CYCLE;\n',
+        "src/b.h": '#define GONE 1\n#define HDR "local.h"\n'
+                   '#include HDR\nint b = SQ(LOCAL) + GONE;\n',
+        "src/local.h": '#include <common.h>\n#define LOCAL 3\n',
+    }
+
+    def expansions(parser):
+        return [node.expansion
+                for node in parser.get_root_node().iter_preorder()
+                if getattr(node, 'expansion', None) is not None]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, text in files.items():
+            os.makedirs(os.path.join(tmp, os.path.dirname(name)),
+                        exist_ok=True)
+            with open(os.path.join(tmp, name), 'w') as fp:
+                fp.write(text)
+        inc = os.path.join(tmp, "inc")
+        paths = [os.path.join(tmp, "src", name) for name in ("a.h", "b.h")]
+        state = CppParseState()
+        CppParse(paths=paths, state=state, include_dirs=[inc]).parse()
+        a = state.parse_trees[paths[0]]
+        b = state.parse_trees[paths[1]]
+        assert(len(a.get_errors()) == 0 and len(b.get_errors()) == 0)
+        # The macros of the headers (and of their includes) are expanded
+        assert(expansions(a) == ["((2) * (2))", "1"])
+        # GONE is undefined by common.h, through local.h
+        assert(expansions(b) == ["((3) * (3))", "3"])
+        # common.h is parsed once, and the cycle back to it stops
+        common = os.path.join(inc, "common.h")
+        assert(a.get_includes() == [common])
+        assert(b.get_includes() == [os.path.join(tmp, "src", "local.h")])
+        assert(state.includes.get_unresolved(paths[0]) == ["vector"])
+        assert(state.includes.get_closure(paths[1]) == [
+            os.path.join(tmp, "src", "local.h"), common,
+            os.path.join(inc, "cycle.h")])
+        assert(state.includes.parses == 3 and state.includes.reuses == 1)
+        # Without include_dirs, includes are not followed
+        parser = CppParse(path=paths[0]).parse()
+        assert(expansions(parser) == [] and parser.get_includes() == [])
+
+def parse_include_guards():
+    files = {
+        "guard.h": "// guard.h\n#ifndef GUARD_H\n#define GUARD_H\n"
+                   "#define G_VAL 1\n#endif  // GUARD_H\n",
+        "once.h": "#pragma once\n#define O_VAL 2\n",
+        "open.h": "#ifndef OPEN_H\n#define OPEN_H\n#endif\nint o;\n",
+        "mid.h": '#include "guard.h"\n#include "once.h"\n',
+        "a.h": '#include "guard.h"\n#include "mid.h"\n#include "once.h"\n'
+               '#include "guard.h"\n#include "open.h"\n#include "open.h"\n'
+               'int a = G_VAL + O_VAL;\n',
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, text in files.items():
+            with open(os.path.join(tmp, name), 'w') as fp:
+                fp.write(text)
+        path = os.path.join(tmp, "a.h")
+        state = CppParseState()
+        parser = CppParse(path=path, state=state, include_dirs=[]).parse()
+        graph = state.includes
+        # The guards are found on the first parse of each header. open.h
+        # has text after its #endif, so it isn't guarded.
+        assert(graph.guards == {os.path.join(tmp, "guard.h"): "GUARD_H",
+                                os.path.join(tmp, "once.h"): None})
+        # once.h through mid.h, and the second guard.h, are skipped
+        assert(graph.skips == 2)
+        # The second open.h finds OPEN_H defined, so it is parsed again
+        # with the macros of a.h
+        assert(graph.parses == 5 and graph.reuses == 1)
+        assert(list(state.variants) == [os.path.join(tmp, "open.h")])
+        expansions = [node.expansion
+                      for node in parser.get_root_node().iter_preorder()
+                      if getattr(node, 'expansion', None) is not None]
+        assert(expansions == ["1", "2"])
+
+def parse_include_imports():
+    files = {
+        "cfg.h": "#ifdef USE_A\n#define MODE 1\n#else\n#define MODE 2\n"
+                 "#endif\n",
+        "table.def": "X(a, 1)\nX(b, 2)\n",
+        "a.c": '#define USE_A\n#include "cfg.h"\nint m = MODE;\n'
+               '#define X(name, val) int name = val;\n'
+               '#include "table.def"\n#undef X\n'
+               '#define X(name, val) #name,\n'
+               'const char *names[] = {\n#include "table.def"\n};\n',
+        "b.c": '#include "cfg.h"\nint m = MODE;\n'
+               '#define X(name, val) int name = val;\n'
+               '#include "table.def"\n',
+    }
+
+    def expansions(parser):
+        return [node.expansion
+                for node in parser.get_root_node().iter_preorder()
+                if getattr(node, 'expansion', None) is not None]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, text in files.items():
+            with open(os.path.join(tmp, name), 'w') as fp:
+                fp.write(text)
+        state = CppParseState()
+        a, b = [CppParse(path=os.path.join(tmp, name), state=state,
+                         include_dirs=[]).parse()
+                for name in ("a.c", "b.c")]
+        # Each header is parsed with the macros of its includer, as they
+        # were looked up by its conditionals and its macros
+        assert(expansions(a) == ["1"] and expansions(b) == ["2"])
+        cfg = state.parse_trees.peek(os.path.join(tmp, "cfg.h"))
+        assert(list(cfg.get_imports()) == ["USE_A"])
+        table = os.path.join(tmp, "table.def")
+        assert(state.parse_trees.peek(table).get_imports()['X'] is None)
+        assert([expansions(parser) for parser in state.variants[table]] ==
+               [["int a = 1;", "int b = 2;"], ['"a",', '"b",']])
+        # Includers which define the imports the same way share a parse
+        graph = state.includes
+        assert(len(state.variants[os.path.join(tmp, "cfg.h")]) == 1)
+        assert(graph.parses == 5 and graph.reuses == 2)
+
+def parse_conditionals():
+    text = """
+    #if defined(LINUX) && VERSION >= 2 * 1
+    int linux_only(int x) { return SQ(x); }
+    #elif defined WINDOWS
+    #define SQ(x) x
+    int windows_only();
+    #else
+    int other();
+    #endif
+    #ifndef LINUX
+    #if 1
+    int dead;
+    #endif
+    #endif
+    #if (-7 / 2 == -3) ? 0x1 : 0
+    int y = SQ(2);
+    #endif
+    #if 1 +
+    #endif
+    """
+
+    def expansions(parser):
+        return [node.expansion
+                for node in parser.get_root_node().iter_preorder()
+                if getattr(node, 'expansion', None) is not None]
+
+    def names(parser):
+        return [node.val for node in parser.find_all(CppParseNodeType.TEXT)
+                if node.val.endswith('only') or
+                node.val in ('other', 'dead', 'y')]
+
+    # The #define of the branch which isn't taken is ignored, and the
+    # macros of inactive text are not expanded
+    macros = {'LINUX': None, 'VERSION': 2}
+    parser = CppParse(text="#define SQ(x) ((x) * (x))\n" + text,
+                      macros=macros).parse()
+    assert(expansions(parser) == ["((x) * (x))", "((2) * (2))"])
+    assert(names(parser) == ["linux_only", "windows_only", "other", "dead",
+                             "y"])
+    assert(len(parser.get_errors()) == 1)
+    # Folded, the inactive branches are opaque spans
+    parser = CppParse(text="#define SQ(x) ((x) * (x))\n" + text,
+                      macros=macros, fold_conditionals=True).parse()
+    assert(names(parser) == ["linux_only", "y"])
+    inactive = parser.find_all(CppParseNodeType.MACRO_INACTIVE)
+    assert(len(inactive) == 2 and "int dead;" in inactive[1].val)
+    assert(parser.invert() == "#define SQ(x) ((x) * (x))\n" + text)
+    loaded = CppParse.from_bytes(parser.to_bytes())
+    assert(loaded.invert() == parser.invert())
+    # Without LINUX, the #ifndef is taken
+    parser = CppParse(text=text, fold_conditionals=True).parse()
+    assert(names(parser) == ["other", "dead", "y"])
+    # The lexer pass skips the inactive text before it is grouped, so a
+    # branch which opens a brace is folded too, and macros expand with
+    # their definition at each use
+    text = """
+    #define N 1
+    #ifdef OLD
+    void f() {
+    #else
+    void f(int n) {
+    #endif
+      return N;
+    }
+    #undef N
+    #define N 2
+    #if N == 2
+    int two = N;
+    #endif
+    """
+    parser = CppParse(text=text, fold_conditionals=True).parse()
+    assert(parser.invert() == text)
+    assert(len(parser.get_errors()) == 0)
+    assert(len(parser.find_all(CppParseNodeType.BRACES)) == 1)
+    inactive = parser.find_all(CppParseNodeType.MACRO_INACTIVE)
+    assert([node.val for node in inactive] == ["\n    void f() {\n    "])
+    assert([node.expansion
+            for node in parser.get_root_node().iter_preorder()
+            if getattr(node, 'expansion', None) is not None] == ["1", "2"])
+    assert(parser.count_nodes() <
+           CppParse(text=text).parse().count_nodes())
+    # The operands of &&, ||, and ?: which aren't taken are not evaluated
+    text = """
+    #if X != 0 && 10 / X > 2
+    int big;
+    #endif
+    #if 0 && 1 / 0
+    #elif 1 || 1 % 0
+    int any;
+    #endif
+    #if X ? 1 >> -1 : (1 ? 2 : 1 / 0)
+    int two;
+    #endif
+    #if X || 1 / X
+    #endif
+    """
+    parser = CppParse(text=text, macros={'X': 0},
+                      fold_conditionals=True).parse()
+    assert([node.val for node in parser.find_all(CppParseNodeType.TEXT)
+            if node.val in ('big', 'any', 'two')] == ["any", "two"])
+    errors = parser.get_errors()
+    assert(len(errors) == 1 and "Division by zero" in str(errors[0]))
+    # Values are 64-bit, and unsigned when either operand is
+    text = """
+    #if -1 < 0u
+    int wrong;
+    #elif -1 > 0u && (0u - 1) >> 63 == 1 && -1 >> 63 == -1
+    int mixed;
+    #endif
+    #if 1u << 63 > 0 && 1 << 63 < 0 && (1 ? -1 : 0u) > 0
+    int shifts;
+    #endif
+    #if 0xFFFFFFFFFFFFFFFF == -1 && 0x7FFFFFFFFFFFFFFF + 1 < 0
+    int wraps;
+    #endif
+    """
+    parser = CppParse(text=text, fold_conditionals=True).parse()
+    assert([node.val for node in parser.find_all(CppParseNodeType.TEXT)
+            if node.val in ('wrong', 'mixed', 'shifts', 'wraps')] ==
+           ["mixed", "shifts", "wraps"])
+    assert(len(parser.get_errors()) == 0)
+
+def parse_snapshot():
+    files = {
+        "inc/config.h": '#ifndef CONFIG_H\n#define CONFIG_H\n'
+                        '#include "base.h"\n#define FEATURE 1\n#endif\n',
+        "inc/base.h": '#pragma once\n#define BASE(x) ((x) + VERSION)\n',
+        "a.h": '#include <config.h>\n#include <base.h>\n#if FEATURE\n'
+               'int a = BASE(2);\n#endif\n',
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, text in files.items():
+            os.makedirs(os.path.join(tmp, os.path.dirname(name)),
+                        exist_ok=True)
+            with open(os.path.join(tmp, name), 'w') as fp:
+                fp.write(text)
+        inc = os.path.join(tmp, "inc")
+        config = os.path.join(inc, "config.h")
+        snapshot = CppParseSnapshot.make([config], macros={'VERSION': 3},
+                                         include_dirs=[inc])
+        assert(snapshot.guards == {config: "CONFIG_H",
+                                   os.path.join(inc, "base.h"): None})
+        assert(sorted(snapshot.files) == sorted(snapshot.guards))
+        path = os.path.join(tmp, "snapshot.json")
+        snapshot.save(path)
+        # The prelude isn't read again: both includes are skipped
+        state = CppParseState()
+        parser = CppParse(path=os.path.join(tmp, "a.h"), state=state,
+                          include_dirs=[inc], snapshot=path).parse()
+        assert(state.includes.parses == 0 and state.includes.skips == 2)
+        expansions = [node.expansion
+                      for node in parser.get_root_node().iter_preorder()
+                      if getattr(node, 'expansion', None) is not None]
+        assert(expansions == ["((2) + 3)"])
+        # Macros given to the parser are defined over those of the snapshot
+        parser = CppParse(text="int b = BASE(1);", macros={'VERSION': 4},
+                          snapshot=snapshot).parse()
+        assert(parser.find_all(CppParseNodeType.TEXT)[1].expansion ==
+               "((1) + 4)")
+        # A snapshot whose files changed is stale
+        with open(config, 'a') as fp:
+            fp.write("#define MORE 1\n")
+        assert(not snapshot.is_valid())
+        assert(CppParseSnapshot.load(path) is None)
+        try:
+            CppParse(text="int c;", snapshot=path)
+            assert(False)
+        except Exception as e:
+            assert("out of date" in str(e))
+        # Relative include directories find the same headers
+        with open(config, 'w') as fp:
+            fp.write(files["inc/config.h"])
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            snapshot = CppParseSnapshot.make(["inc/config.h"],
+                                             macros={'VERSION': 3},
+                                             include_dirs=["inc"])
+            state = CppParseState()
+            CppParse(path="a.h", state=state, include_dirs=["inc"],
+                     snapshot=snapshot).parse()
+            assert(state.includes.parses == 0 and state.includes.skips == 2)
+        finally:
+            os.chdir(cwd)
+
+def node_reparent():
+    old_parent = CppParseNode()
+    new_parent = CppParseNode(CppParseNodeType.BODY)
+    old_parent.make_tok_child(CppParseNodeType.TEXT, 'x', 0)
+    node = old_parent[0]
+
+    # Reparenting happens in place
+    assert(new_parent.add_child_node(node, hidden=True) is node)
+    assert(new_parent[0] is node)
+    assert(node.parent is new_parent and node.hidden)
+
+    # Copies are opt-in
+    node.name = 'x'
+    copy = new_parent.add_child_node(node, copy=True)
+    assert(copy is not node and copy.name == 'x')
+    deep = new_parent.deep_copy()
+    assert(deep[0] is not node and deep[0].parent is deep)
+    assert(deep[0].val == 'x')
+    try:
+        node.unknown = 1
+        assert(False)
+    except AttributeError:
+        pass
+
+def node_replace_children():
+    root = CppParseNode()
+    expected = []
+    for i in range(20):
+        root.make_tok_child(CppParseNodeType.TEXT, str(i), i)
+        expected.append(str(i))
+
+    # Edits at, behind, and ahead of the gap
+    for start, end in [(0, 1), (5, 7), (2, 2), (10, 14), (3, 3), (11, 10)]:
+        node = CppParseNode(CppParseNodeType.TEXT, f"{start}-{end}")
+        root.replace_children(node, start, end)
+        expected[start:end + 1] = [node.val]
+        assert(root.size() == len(expected))
+        assert([root[i].val for i in range(root.size())] == expected)
+        assert(root[-1].val == expected[-1])
+        assert(root.next_child(root.size() - 1) is None)
+    assert([node.val for node in root.get_children()] == expected)
+
+def parse_groupings():
+    text = """
+    int hello(int x, int y[2]) { return (x + y[0]); }
+    """
+
+    for typed_lex in [True, False]:
+        parser = CppParse(text=text, typed_lex=typed_lex)
+        parser.parse()
+        nodes = parser.get_root_node().get_children()
+        assert(len(nodes) == 4)
+        assert(nodes[2].is_one_of(CppParseNodeType.PARENTHESIS))
+        assert(nodes[2][4].is_one_of(CppParseNodeType.TEXT))
+        assert(nodes[2][5].is_one_of(CppParseNodeType.BRACKETS))
+        assert(nodes[3].is_one_of(CppParseNodeType.BRACES))
+        assert(nodes[3][1].is_one_of(CppParseNodeType.PARENTHESIS))
+        assert(nodes[3][1].parent is nodes[3])
+    assert(text == parser.invert())
 
 def parse_strings():
     text = """
@@ -202,6 +1315,35 @@ def parse_templated_class():
     print()
     parser.print()
 
+lex_typed()
+lex_tok_stream()
+parse_typed_invert()
+parse_mmap()
+parse_spans()
+parse_invert_to()
+node_traversal()
+parse_deep_nesting()
+parse_find_all()
+parse_query()
+parse_serialize()
+parse_cache()
+parse_jobs()
+parse_pipeline()
+parse_async()
+parse_apply_edit()
+parse_daemon()
+parse_memory_budget()
+parse_profile()
+parse_macro_expand()
+parse_macro_rescan()
+parse_includes()
+parse_include_guards()
+parse_include_imports()
+parse_conditionals()
+parse_snapshot()
+node_reparent()
+node_replace_children()
+parse_groupings()
 parse_strings()
 #parse_comments()
 #parse_macro()
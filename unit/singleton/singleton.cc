@@ -0,0 +1,4 @@
+#include "singleton.h"
+
+#include <hermes.h>
+template<> std::unique_ptr<hermes::Hermes> test::Singleton<hermes::Hermes>::obj_ = nullptr;
@@ -0,0 +1,9 @@
+#ifndef TEST_SINGLETON_H_
+#define TEST_SINGLETON_H_
+
+#include "singleton.h"
+
+#define HERMES test::Singleton<hermes::Hermes>::GetInstance()
+#define HERMES_T hermes::Hermes*
+
+#endif  // TEST_SINGLETON_H_